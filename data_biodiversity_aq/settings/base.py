@@ -159,6 +159,13 @@ GBIF_USER_EMAIL = 'gbif_user@email.com'
 # Download directory that stores downloaded darwin-core archive
 DOWNLOADS_DIR = 'downloads/'
 
+# Directory that keeps imported darwin-core archives by dataset and payload hash. Do not put it in DOWNLOADS_DIR, all
+# archives in DOWNLOADS_DIR are imported.
+ARCHIVE_CACHE_DIR = 'archive_cache/'
+
+# Maximum size (in bytes) of ARCHIVE_CACHE_DIR, least recently used archives are deleted first
+ARCHIVE_CACHE_MAX_SIZE = 20 * 1024 ** 3
+
 # Fixtures directory for tests
 FIXTURE_DIRS = ['fixtures/']
 
@@ -190,6 +197,8 @@ REST_FRAMEWORK = {
         'rest_framework.renderers.TemplateHTMLRenderer',
     ),
     'PAGE_SIZE': 20,
+    # returns the cost of the searches over the budget, see data_manager.query_cost
+    'EXCEPTION_HANDLER': 'data_manager.query_cost.query_cost_exception_handler',
     'DEFAULT_THROTTLE_CLASSES': (
         'rest_framework.throttling.AnonRateThrottle',
         'rest_framework.throttling.UserRateThrottle'
@@ -335,17 +344,75 @@ MESSAGE_TAGS = {
 DOWNLOAD_FILE_STORAGE_PERIOD = 7
 
 # caching
+# default: LRU in the memory of each process (entries are kept up to LOCAL_TIMEOUT seconds, so a change made by another
+# process can be seen that late) in front of the shared cache
+# shared: Redis database dedicated to the cache, the Redis server is also the broker of Celery
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
-        'LOCATION': 'data_biodiversity_aq_cache',
+        'BACKEND': 'data_manager.cache_backends.TwoTierCache',
+        'LOCATION': 'default',
         'TIMEOUT': None,
         'OPTIONS': {
-            'MAX_ENTRIES': 1000
+            'SHARED': 'shared',
+            'LOCAL_MAX_ENTRIES': 1000,
+            'LOCAL_TIMEOUT': 30,
         }
+    },
+    'shared': {
+        'BACKEND': 'data_manager.cache_backends.RedisCache',
+        'LOCATION': 'redis://localhost:6379/1',
+        'TIMEOUT': None,
     }
 }
 
+# Text search configuration of Dataset.search_vector and dataset search queries
+DATASET_SEARCH_CONFIG = 'english'
+
+# Time (in seconds) the facets of a dataset search are cached, facets are also invalidated when datasets are imported
+DATASET_FACET_CACHE_TIMEOUT = 60 * 60
+
+# Occurrence searches estimated to find more occurrences than this are counted exactly in the background, the estimate
+# is returned meanwhile
+OCCURRENCE_EXACT_COUNT_THRESHOLD = 50000
+
+# Time (in seconds) the exact count of an occurrence search is cached
+OCCURRENCE_COUNT_CACHE_TIMEOUT = 60 * 60 * 24
+
+# The ids of the occurrences found by a search are cached for the other requests of the search page (occurrences, count
+# and grid) if the search finds at most this number of occurrences
+OCCURRENCE_RESULT_CACHE_MAX_IDS = 10000
+
+# Maximum number of occurrences streamed by the occurrence export API, larger searches must be requested as a Download
+OCCURRENCE_EXPORT_MAX_RECORDS = 100000
+
+# Number of rows fetched from the database cursor, and written to the response at once, by the occurrence export API
+OCCURRENCE_EXPORT_CHUNK_SIZE = 2000
+
+# Maximum number of gbifIDs or ids looked up at once by the occurrence lookup API
+OCCURRENCE_LOOKUP_MAX_IDS = 1000
+
+# Maximum number of groups returned by the occurrence aggregation API
+OCCURRENCE_AGGREGATE_MAX_GROUPS = 1000
+
+# Size (in meters) of the depth bins of the occurrence aggregation API
+OCCURRENCE_AGGREGATE_DEPTH_BIN = 100
+
+# Time (in seconds) a reverse proxy may serve a response of the read-only API before revalidating it with its ETag, see
+# data_manager.conditional
+API_CACHE_MAX_AGE = 60
+
+# Budget of the occurrence searches of the API per kind of user, see data_manager.query_cost: searches with a larger
+# cost estimated by the query planner (EXPLAIN) are rejected, queries running longer than timeout (in milliseconds) are
+# cancelled
+OCCURRENCE_QUERY_BUDGET = {
+    'anonymous': {'max_cost': 1000000, 'timeout': 10000},
+    'authenticated': {'max_cost': 10000000, 'timeout': 30000},
+}
+
+# Time (in seconds) the ids and grid counts of an occurrence search are cached, they are also invalidated when the
+# datasets are imported
+OCCURRENCE_RESULT_CACHE_TIMEOUT = 60 * 60
+
 CPU_COUNT = cpu_count()
 
 # url prefix
@@ -398,6 +465,47 @@ PURL_BASE = 'http://purl.org/dc/terms/'
 
 GBIF_API_BASE = 'https://api.gbif.org/v1/'
 
+# maximum number of requests sent to GBIF API at the same time. GBIF limits the API calls, keep this low.
+GBIF_API_MAX_WORKERS = 8
+
+# timeout (in seconds) of a single request to GBIF API
+GBIF_API_TIMEOUT = 60
+
+# timeout (in seconds) of the requests to GBIF API made to render a page (taxon search and taxon detail), the page is
+# rendered without the responses that are not received in time
+GBIF_API_PAGE_TIMEOUT = 10
+
+# Time (in seconds) the responses of GBIF API used to render a page are cached
+GBIF_API_CACHE_TIMEOUT = 60 * 60 * 24
+
+# maximum number of occurrence downloads requested at GBIF at the same time. GBIF only allows a few simultaneous
+# downloads per user.
+GBIF_MAX_CONCURRENT_DOWNLOADS = 3
+
+# maximum number of datasets requested in a single occurrence download. The archive is split by datasetKey on import.
+GBIF_DATASETS_PER_DOWNLOAD = 50
+
+# interval (in seconds) between two polls of the status of occurrence downloads
+GBIF_DOWNLOAD_POLL_INTERVAL = 60
+
+# cancel download request to GBIF if it takes more than 3 hours (in seconds) to generate a download
+GBIF_DOWNLOAD_TIMEOUT = 10800
+
+# number of archives downloaded from GBIF at the same time
+GBIF_DOWNLOAD_WORKERS = 3
+
+# aggregate bandwidth (in bytes per second) of the archives downloaded at the same time, 0 for no limit
+GBIF_DOWNLOAD_MAX_BANDWIDTH = 0
+
+# size (in bytes) of the chunks read from the network and of the write buffer when downloading archives
+GBIF_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# number of attempts to download an archive, a dropped connection is resumed from the partially downloaded file
+GBIF_DOWNLOAD_RETRIES = 3
+
+# delay (in seconds) before retrying a failed archive download, multiplied by the number of attempts
+GBIF_DOWNLOAD_RETRY_DELAY = 30
+
 EML_RESOURCE = 'https://eml.ecoinformatics.org/'
 
 OCCURRENCE_FIELDS = [
@@ -0,0 +1,8 @@
+from .development import *
+
+# tests use a local memory cache as the shared cache, they do not need Redis
+CACHES['shared'] = {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'shared',
+    'TIMEOUT': None,
+}
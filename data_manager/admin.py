@@ -1,6 +1,7 @@
 from django.contrib import admin
+from data_manager.helpers import search_occurrences
 from data_manager.models import Dataset, Project, Person, PersonTypeRole, Publisher, Keyword, BasisOfRecord, \
-    DataType, GBIFVerbatimOccurrence, GBIFOccurrence, HexGrid, Download, HarvestedDataset
+    DataType, GBIFVerbatimOccurrence, GBIFOccurrence, HexGrid, Download, HarvestedDataset, Statistics
 
 
 class DatasetAdmin(admin.ModelAdmin):
@@ -15,7 +16,13 @@ class GBIFOccurrenceAdmin(admin.ModelAdmin):
     list_display = (
         'gbifID', 'dataset'
     )
-    search_fields = ('row_json_text',)
+    search_fields = ('search_document',)
+
+    def get_search_results(self, request, queryset, search_term):
+        """Use the trigram index of search_document instead of UPPER(...) LIKE"""
+        if not search_term:
+            return queryset, False
+        return search_occurrences(queryset, search_term), False
 
 
 class PersonTypeRoleAdmin(admin.ModelAdmin):
@@ -45,3 +52,4 @@ admin.site.register(GBIFOccurrence, GBIFOccurrenceAdmin)
 admin.site.register(HexGrid)
 admin.site.register(Download)
 admin.site.register(HarvestedDataset, HarvestedDatasetAdmin)
+admin.site.register(Statistics)
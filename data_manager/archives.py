@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+import hashlib
+import json
+import logging
+import os
+import requests
+import shutil
+import threading
+import time
+import zipfile
+
+
+logger = logging.getLogger('import_datasets')
+
+# terms of occurrence.txt that GBIF updates at every crawl, even if the record was not changed by the publisher
+VOLATILE_TERMS = {settings.GBIF_RESOURCE + 'lastCrawled', settings.GBIF_RESOURCE + 'lastParsed',
+                  settings.GBIF_RESOURCE + 'lastInterpreted'}
+
+
+class ArchiveNotDownloaded(Exception):
+    """Exception to raise when an archive cannot be downloaded after all retries"""
+    pass
+
+
+class ArchiveCorrupted(Exception):
+    """Exception to raise when a downloaded archive does not match the download metadata"""
+    pass
+
+
+class BandwidthLimiter(object):
+    """
+    Token bucket shared by the threads downloading archives, so that the aggregate download rate stays below
+    max_rate bytes per second. max_rate of 0 or None means no limit.
+    """
+
+    def __init__(self, max_rate=None):
+        self.max_rate = max_rate
+        self.tokens = max_rate or 0
+        self.updated_on = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, size):
+        """
+        Block until size bytes can be transferred within the bandwidth limit
+        :param size: number of bytes transferred
+        """
+        if not self.max_rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            # refill the bucket, at most one second worth of bandwidth
+            self.tokens = min(self.max_rate, self.tokens + (now - self.updated_on) * self.max_rate)
+            self.updated_on = now
+            self.tokens -= size
+            wait = -self.tokens / self.max_rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+        return
+
+
+def verify_archive(file_path, expected_size=None):
+    """
+    Verify a downloaded archive against the download metadata.
+    GBIF does not publish a checksum of the archive, the CRC-32 of every file in the zip is checked instead.
+    :param file_path: full path of the archive
+    :param expected_size: size (in bytes) of the archive in the download metadata
+    :return: None, raise ArchiveCorrupted if the archive is truncated or corrupted
+    """
+    size = os.path.getsize(file_path)
+    if expected_size is not None and size != expected_size:
+        raise ArchiveCorrupted('{}: expected {} bytes, got {} bytes'.format(file_path, expected_size, size))
+    try:
+        with zipfile.ZipFile(file_path) as archive:
+            bad_file = archive.testzip()
+    except zipfile.BadZipFile as e:
+        raise ArchiveCorrupted('{}: {}'.format(file_path, e))
+    if bad_file is not None:
+        raise ArchiveCorrupted('{}: CRC-32 of {} does not match'.format(file_path, bad_file))
+    return
+
+
+def fetch_to_file(url, file_path, limiter=None):
+    """
+    Download url into <file_path>.part, resume from the end of the .part file with an HTTP Range request if it exists.
+    The .part file is renamed to file_path once the response is complete.
+    :param url: url of the file
+    :param file_path: full path of the downloaded file
+    :param limiter: BandwidthLimiter shared with the other downloads
+    :return: file_path
+    """
+    part_path = file_path + '.part'
+    offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+    headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+    with requests.get(url, headers=headers, stream=True, timeout=settings.GBIF_API_TIMEOUT) as response:
+        if response.status_code == 416:  # nothing left to download
+            os.replace(part_path, file_path)
+            return file_path
+        response.raise_for_status()
+        mode = 'ab' if response.status_code == 206 else 'wb'  # server ignored Range header, start over
+        with open(part_path, mode, buffering=settings.GBIF_DOWNLOAD_CHUNK_SIZE) as handle:
+            for chunk in response.iter_content(chunk_size=settings.GBIF_DOWNLOAD_CHUNK_SIZE):
+                if chunk:
+                    if limiter is not None:
+                        limiter.consume(len(chunk))
+                    handle.write(chunk)
+    os.replace(part_path, file_path)
+    return file_path
+
+
+def download_archive(download_key, download_link, expected_size=None, limiter=None):
+    """
+    Download the darwin core archive generated by GBIF and save it to settings.DOWNLOADS_DIR.
+    A dropped connection is resumed and a corrupted archive is downloaded again, up to settings.GBIF_DOWNLOAD_RETRIES
+    times.
+    :param download_key: download key obtained from get_download_key()
+    :param download_link: downloadLink in the metadata of the download
+    :param expected_size: size in the metadata of the download
+    :param limiter: BandwidthLimiter shared with the other downloads
+    :return: full path of the archive downloaded
+    """
+    download_file_path = os.path.join(settings.DOWNLOADS_DIR, download_key + '.zip')
+    for attempt in range(1, settings.GBIF_DOWNLOAD_RETRIES + 1):
+        try:
+            fetch_to_file(download_link, download_file_path, limiter)
+            verify_archive(download_file_path, expected_size)
+        except requests.exceptions.RequestException as e:  # keep .part file to resume
+            logger.warning('[DOWNLOAD]Attempt {} of {} failed: {}'.format(attempt, download_key, e))
+        except ArchiveCorrupted as e:  # download from scratch
+            logger.warning('[DOWNLOAD]Attempt {} of {} failed: {}'.format(attempt, download_key, e))
+            os.unlink(download_file_path)
+        else:
+            logger.info('[DOWNLOAD]Archive downloaded: {}'.format(download_key))
+            return download_file_path
+        time.sleep(settings.GBIF_DOWNLOAD_RETRY_DELAY * attempt)
+    raise ArchiveNotDownloaded('{} failed after {} attempts'.format(download_key, settings.GBIF_DOWNLOAD_RETRIES))
+
+
+def payload_hashes(dwca, import_full_dataset_dict=None):
+    """
+    Compute a SHA-256 of the occurrence payload of each dataset in a darwin core archive in a single pass.
+    The hash covers the terms of the core file (meta.xml), the rows of the dataset without VOLATILE_TERMS and the
+    import_full_dataset flag. Hashes of the rows are summed, so the result does not depend on the order of the rows, nor
+    on the other datasets requested in the same download.
+    :param dwca: DwCAReader object
+    :param import_full_dataset_dict: a dictionary with key = dataset uuid, value = import_full_dataset flag
+    :return: a dictionary with key = dataset uuid, value = hex digest of the payload
+    """
+    import_full_dataset_dict = import_full_dataset_dict or dict()
+    dataset_uuids = list(dwca.source_metadata.keys())
+    terms = sorted(term for term in dwca.descriptor.core.terms if term not in VOLATILE_TERMS)
+    row_sums = dict()
+    for row in dwca:
+        # rows of an archive of several datasets are split by datasetKey, like populate_db()
+        dataset_uuid = row.data.get(settings.GBIF_RESOURCE + 'datasetKey')
+        if not dataset_uuid and len(dataset_uuids) == 1:
+            dataset_uuid = dataset_uuids[0]
+        row_text = json.dumps([row.data.get(term) for term in terms])
+        row_hash = int(hashlib.sha256(row_text.encode('utf-8')).hexdigest(), 16)
+        row_sums[dataset_uuid] = (row_sums.get(dataset_uuid, 0) + row_hash) % 2 ** 256
+    hashes = dict()
+    for dataset_uuid, row_sum in row_sums.items():
+        payload = json.dumps([terms, import_full_dataset_dict.get(dataset_uuid), '{:064x}'.format(row_sum)])
+        hashes[dataset_uuid] = hashlib.sha256(payload.encode('utf-8')).hexdigest()
+    return hashes
+
+
+def cache_archive(archive, hashes):
+    """
+    Keep an imported archive in settings.ARCHIVE_CACHE_DIR/<dataset uuid>/<payload hash>.zip. An archive of several
+    datasets is hard linked (copied if the file system does not support it) under each dataset.
+    :param archive: full path of darwin core archive
+    :param hashes: a dictionary with key = dataset uuid, value = payload hash returned by payload_hashes()
+    :return: list of cached paths
+    """
+    cached = []
+    for dataset_uuid, payload_hash in hashes.items():
+        cache_path = os.path.join(settings.ARCHIVE_CACHE_DIR, dataset_uuid, payload_hash + '.zip')
+        if os.path.isfile(cache_path):  # same content, keep it as recently used
+            os.utime(cache_path)
+        else:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            try:
+                os.link(archive, cache_path)
+            except OSError:
+                shutil.copy2(archive, cache_path)
+        cached.append(cache_path)
+    evict_archive_cache()
+    return cached
+
+
+def evict_archive_cache(max_size=None):
+    """
+    Delete the least recently used archives in settings.ARCHIVE_CACHE_DIR until the cache is smaller than max_size.
+    All the links of an archive are deleted together.
+    :param max_size: maximum size (in bytes) of the cache, default to settings.ARCHIVE_CACHE_MAX_SIZE
+    :return: number of bytes freed
+    """
+    max_size = settings.ARCHIVE_CACHE_MAX_SIZE if max_size is None else max_size
+    files = dict()  # key = (device, inode), value = [last used, size, paths]
+    for root, dirs, filenames in os.walk(settings.ARCHIVE_CACHE_DIR):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            stat = os.stat(path)
+            entry = files.setdefault((stat.st_dev, stat.st_ino), [stat.st_mtime, stat.st_size, []])
+            entry[0] = max(entry[0], stat.st_mtime)
+            entry[2].append(path)
+    total_size = sum(size for last_used, size, paths in files.values())
+    freed = 0
+    for last_used, size, paths in sorted(files.values(), key=lambda entry: entry[0]):
+        if total_size - freed <= max_size:
+            break
+        for path in paths:
+            os.unlink(path)
+        freed += size
+        logger.info('[CACHE]Evicted {}'.format(', '.join(paths)))
+    return freed
@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict, defaultdict
+from django.core.cache import caches
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+import logging
+import math
+import pickle
+import threading
+import time
+import zlib
+
+
+logger = logging.getLogger('data_manager')
+
+# values larger than this (in bytes) are compressed before they are sent to Redis
+COMPRESS_MIN_LENGTH = 1024
+COMPRESSED = b'z'
+
+# local tiers and metrics are shared by all threads of a process, key = LOCATION of the TwoTierCache
+_local_tiers = dict()
+_local_locks = dict()
+_metrics = dict()
+
+
+def serialize(value):
+    """
+    Serialise a cache value. Integers are stored as text so that Redis can increment them, other values are pickled and
+    compressed if they are larger than COMPRESS_MIN_LENGTH.
+    :param value: any picklable object
+    :return: bytes
+    """
+    if isinstance(value, int) and not isinstance(value, bool):
+        return str(value).encode('ascii')
+    data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)  # starts with b'\x80'
+    if len(data) > COMPRESS_MIN_LENGTH:
+        return COMPRESSED + zlib.compress(data)
+    return data
+
+
+def deserialize(data):
+    """
+    Deserialise a value serialised by serialize()
+    :param data: bytes
+    :return: the value
+    """
+    if data.startswith(COMPRESSED):
+        return pickle.loads(zlib.decompress(data[1:]))
+    if data.startswith(b'\x80'):
+        return pickle.loads(data)
+    return int(data)
+
+
+def key_prefix(key):
+    """
+    Return the prefix of a cache key used to group the metrics, e.g. 'occurrence-count' for 'occurrence-count:form:...'
+    :param key: cache key, before KEY_PREFIX and version are added
+    :return: str
+    """
+    return key.split(':', 1)[0].split('.', 1)[0]
+
+
+class RedisCache(BaseCache):
+    """
+    Cache stored in Redis, see serialize() for the format of the values. The Redis database must be dedicated to the
+    cache, clear() flushes it.
+    e.g. 'LOCATION': 'redis://localhost:6379/1'
+    """
+
+    def __init__(self, server, params):
+        super(RedisCache, self).__init__(params)
+        self._server = server
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            import redis
+            self._client = redis.Redis.from_url(self._server)
+        return self._client
+
+    def get_redis_timeout(self, timeout=DEFAULT_TIMEOUT):
+        """Return the expiry of a key in seconds, None to never expire it"""
+        if timeout == DEFAULT_TIMEOUT:
+            timeout = self.default_timeout
+        if timeout is None:
+            return None
+        return max(int(math.ceil(timeout)), 0)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        timeout = self.get_redis_timeout(timeout)
+        if timeout == 0:
+            return False
+        return bool(self.client.set(key, serialize(value), ex=timeout, nx=True))
+
+    def get(self, key, default=None, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        data = self.client.get(key)
+        return default if data is None else deserialize(data)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        timeout = self.get_redis_timeout(timeout)
+        if timeout == 0:
+            self.client.delete(key)
+        else:
+            self.client.set(key, serialize(value), ex=timeout)
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        timeout = self.get_redis_timeout(timeout)
+        if timeout is None:
+            return bool(self.client.persist(key)) or bool(self.client.exists(key))
+        return bool(self.client.expire(key, timeout))
+
+    def delete(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        self.client.delete(key)
+
+    def get_many(self, keys, version=None):
+        keys = list(keys)
+        if not keys:
+            return dict()
+        redis_keys = [self.make_key(key, version=version) for key in keys]
+        for key in redis_keys:
+            self.validate_key(key)
+        return {key: deserialize(data) for key, data in zip(keys, self.client.mget(redis_keys)) if data is not None}
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        timeout = self.get_redis_timeout(timeout)
+        pipeline = self.client.pipeline(transaction=False)
+        for key, value in data.items():
+            key = self.make_key(key, version=version)
+            self.validate_key(key)
+            if timeout == 0:
+                pipeline.delete(key)
+            else:
+                pipeline.set(key, serialize(value), ex=timeout)
+        pipeline.execute()
+        return []
+
+    def delete_many(self, keys, version=None):
+        keys = [self.make_key(key, version=version) for key in keys]
+        if keys:
+            self.client.delete(*keys)
+
+    def has_key(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return bool(self.client.exists(key))
+
+    def incr(self, key, delta=1, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        if not self.client.exists(key):
+            raise ValueError("Key '%s' not found" % key)
+        return self.client.incrby(key, delta)
+
+    def clear(self):
+        self.client.flushdb()
+
+
+class TwoTierCache(BaseCache):
+    """
+    Cache with a bounded LRU in the memory of each process in front of a cache shared by all processes (Redis).
+    Reads are served by the local tier for at most LOCAL_TIMEOUT seconds, writes go to both tiers, add() and incr() go
+    to the shared tier only so that they stay atomic across processes. get_or_set() computes a missing value once: the
+    other callers wait for it instead of computing it too. Hits and misses are counted per key prefix and logged every
+    METRICS_INTERVAL seconds.
+    e.g. 'OPTIONS': {'SHARED': 'shared', 'LOCAL_MAX_ENTRIES': 1000, 'LOCAL_TIMEOUT': 30}
+    """
+
+    def __init__(self, name, params):
+        super(TwoTierCache, self).__init__(params)
+        options = params.get('OPTIONS', {})
+        self._shared_alias = options.get('SHARED', 'shared')
+        self._local_max_entries = int(options.get('LOCAL_MAX_ENTRIES', 1000))
+        self._local_timeout = options.get('LOCAL_TIMEOUT', 30)
+        self._lock_timeout = options.get('LOCK_TIMEOUT', 30)
+        self._metrics_interval = options.get('METRICS_INTERVAL', 60 * 5)
+        self._local = _local_tiers.setdefault(name, OrderedDict())
+        self._lock = _local_locks.setdefault(name, threading.Lock())
+        self._metrics = _metrics.setdefault(name, {'counts': defaultdict(lambda: [0, 0, 0]),
+                                                   'reported_at': time.monotonic()})
+
+    @property
+    def shared(self):
+        return caches[self._shared_alias]
+
+    # ----------
+    # local tier
+    # ----------
+
+    def _local_get(self, key):
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is None:
+                return None
+            expiry, data = entry
+            if expiry < time.monotonic():
+                del self._local[key]
+                return None
+            self._local.move_to_end(key)
+        return data
+
+    def _local_set(self, key, value, timeout=DEFAULT_TIMEOUT):
+        if timeout == DEFAULT_TIMEOUT:
+            timeout = self.default_timeout
+        local_timeout = self._local_timeout if timeout is None else min(timeout, self._local_timeout)
+        if local_timeout <= 0:
+            self._local_delete(key)
+            return
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)  # callers cannot modify the cached value
+        with self._lock:
+            self._local[key] = (time.monotonic() + local_timeout, data)
+            self._local.move_to_end(key)
+            while len(self._local) > self._local_max_entries:
+                self._local.popitem(last=False)
+
+    def _local_delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._local.pop(key, None)
+
+    # -------
+    # metrics
+    # -------
+
+    def _record(self, key, tier):
+        """
+        Count a read of key
+        :param key: cache key
+        :param tier: 0 for a hit in the local tier, 1 for a hit in the shared tier, 2 for a miss
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._metrics['counts'][key_prefix(key)][tier] += 1
+            report = now - self._metrics['reported_at'] >= self._metrics_interval
+            if report:
+                self._metrics['reported_at'] = now
+        if report:
+            for prefix, (local, shared, misses) in sorted(self.metrics().items()):
+                logger.info('[CACHE]{}: {} local hits, {} shared hits, {} misses'.format(prefix, local, shared, misses))
+
+    def metrics(self):
+        """
+        Return the number of reads of this process per key prefix
+        :return: a dictionary with key = key prefix, value = (local hits, shared hits, misses)
+        """
+        with self._lock:
+            return {prefix: tuple(counts) for prefix, counts in self._metrics['counts'].items()}
+
+    # ---------
+    # cache API
+    # ---------
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        added = self.shared.add(key, value, timeout, version=version)
+        if added:
+            self._local_set(self.shared.make_key(key, version=version), value, timeout)
+        return added
+
+    def get(self, key, default=None, version=None):
+        local_key = self.shared.make_key(key, version=version)
+        data = self._local_get(local_key)
+        if data is not None:
+            self._record(key, 0)
+            return pickle.loads(data)
+        sentinel = object()
+        value = self.shared.get(key, sentinel, version=version)
+        if value is sentinel:
+            self._record(key, 2)
+            return default
+        self._record(key, 1)
+        self._local_set(local_key, value)
+        return value
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.shared.set(key, value, timeout, version=version)
+        self._local_set(self.shared.make_key(key, version=version), value, timeout)
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        self._local_delete(self.shared.make_key(key, version=version))
+        return self.shared.touch(key, timeout, version=version)
+
+    def delete(self, key, version=None):
+        self._local_delete(self.shared.make_key(key, version=version))
+        self.shared.delete(key, version=version)
+
+    def get_many(self, keys, version=None):
+        values = dict()
+        missing = []
+        for key in keys:
+            data = self._local_get(self.shared.make_key(key, version=version))
+            if data is None:
+                missing.append(key)
+            else:
+                self._record(key, 0)
+                values[key] = pickle.loads(data)
+        if missing:
+            shared_values = self.shared.get_many(missing, version=version)
+            for key in missing:
+                if key in shared_values:
+                    self._record(key, 1)
+                    self._local_set(self.shared.make_key(key, version=version), shared_values[key])
+                else:
+                    self._record(key, 2)
+            values.update(shared_values)
+        return values
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        failed = self.shared.set_many(data, timeout, version=version)
+        for key, value in data.items():
+            if key not in failed:
+                self._local_set(self.shared.make_key(key, version=version), value, timeout)
+        return failed
+
+    def delete_many(self, keys, version=None):
+        keys = list(keys)
+        self._local_delete(*[self.shared.make_key(key, version=version) for key in keys])
+        self.shared.delete_many(keys, version=version)
+
+    def has_key(self, key, version=None):
+        return self._local_get(self.shared.make_key(key, version=version)) is not None or \
+            self.shared.has_key(key, version=version)
+
+    def incr(self, key, delta=1, version=None):
+        self._local_delete(self.shared.make_key(key, version=version))
+        return self.shared.incr(key, delta, version=version)
+
+    def get_or_set(self, key, default, timeout=DEFAULT_TIMEOUT, version=None):
+        """
+        Return the value of key. If it is missing, only one caller computes default (if callable) and caches it, the
+        other callers wait up to LOCK_TIMEOUT seconds for the value instead of computing it at the same time.
+        """
+        sentinel = object()
+        value = self.get(key, sentinel, version=version)
+        if value is not sentinel:
+            return value
+        lock_key = '{}:lock'.format(key)
+        locked = self.shared.add(lock_key, True, self._lock_timeout, version=version)
+        if not locked:
+            deadline = time.monotonic() + self._lock_timeout
+            while time.monotonic() < deadline and self.shared.has_key(lock_key, version=version):
+                time.sleep(0.05)
+                value = self.shared.get(key, sentinel, version=version)
+                if value is not sentinel:
+                    self._local_set(self.shared.make_key(key, version=version), value, timeout)
+                    return value
+        try:
+            if callable(default):
+                default = default()
+            if default is not None:
+                self.set(key, default, timeout, version=version)
+        finally:
+            if locked:
+                self.shared.delete(lock_key, version=version)
+        return default
+
+    def clear(self):
+        with self._lock:
+            self._local.clear()
+        self.shared.clear()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+from data_manager.generations import get_epoch
+from django.conf import settings
+from django.utils.cache import add_never_cache_headers, get_conditional_response, patch_cache_control, \
+    patch_vary_headers
+from django.utils.decorators import method_decorator
+from django.utils.http import http_date, quote_etag
+from functools import wraps
+import hashlib
+
+
+def data_etag(request, epoch):
+    """
+    Return the ETag of a response built from the data of the database. The data only changes when datasets are
+    imported, which bumps the data epoch (see data_manager.generations), so the ETag of a URL changes with the epoch.
+    :param request: HttpRequest
+    :param epoch: data epoch, see get_epoch()
+    :return: weak ETag, a quoted string
+    """
+    value = '{}|{}|{}'.format(epoch, request.get_full_path(), request.META.get('HTTP_ACCEPT', ''))
+    return 'W/{}'.format(quote_etag(hashlib.sha1(value.encode('utf-8')).hexdigest()))
+
+
+def data_last_modified(epoch):
+    """
+    Return the Last-Modified time of a response built from the data of the database, the time of the data epoch
+    :param epoch: data epoch, see get_epoch()
+    :return: timestamp in seconds
+    """
+    return epoch // 10 ** 6
+
+
+def conditional_data_view(view):
+    """
+    Decorator of the read-only API views. A GET or HEAD request whose If-None-Match or If-Modified-Since matches the data
+    epoch returns 304 Not Modified before the view is called. Successful responses get an ETag, a Last-Modified and a
+    Cache-Control header, so that a reverse proxy can serve them for settings.API_CACHE_MAX_AGE seconds. A view sets
+    its own Cache-Control header (e.g. never_cache_estimate()) to opt out.
+    :param view: view function
+    :return: view function
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return view(request, *args, **kwargs)
+        epoch = get_epoch()
+        etag, last_modified = data_etag(request, epoch), data_last_modified(epoch)
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = view(request, *args, **kwargs)
+        if response.status_code in (200, 304) and not response.has_header('Cache-Control'):
+            response['ETag'] = etag
+            response['Last-Modified'] = http_date(last_modified)
+            patch_cache_control(response, public=True, max_age=settings.API_CACHE_MAX_AGE)
+            patch_vary_headers(response, ('Accept',))
+        return response
+    return wrapper
+
+
+def never_cache_estimate(response, estimated):
+    """
+    Prevent the caching of a response that contains an estimated count, which is replaced by the exact count without
+    changing the data epoch (see get_occurrence_count())
+    :param response: HttpResponse
+    :param estimated: True if the response contains an estimated count
+    :return: response
+    """
+    if estimated:
+        add_never_cache_headers(response)
+    return response
+
+
+class ConditionalDataMixin(object):
+    """
+    Conditional GET of the read-only API viewsets, see conditional_data_view()
+    """
+
+    @method_decorator(conditional_data_view)
+    def dispatch(self, request, *args, **kwargs):
+        return super(ConditionalDataMixin, self).dispatch(request, *args, **kwargs)
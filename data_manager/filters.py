@@ -1,4 +1,5 @@
 import django_filters as filters
+from data_manager.helpers import search_datasets, search_occurrences
 from data_manager.models import Dataset, BasisOfRecord, GBIFOccurrence, DataType, Keyword, Publisher, Person, Project
 
 
@@ -27,7 +28,9 @@ class DatasetFilter(filters.FilterSet):
     """
     FilterSet for Dataset instances
     """
-    q = filters.CharFilter(field_name='eml_text', lookup_expr='icontains', label='Search term')
+    q = filters.CharFilter(method='search', label='Search term',
+                           help_text='Full text search on title, keywords, project, personnel, publisher and abstract. '
+                                     'Supports "quoted phrase", or and -negation.')
     data_type = filters.ModelMultipleChoiceFilter(
         field_name='data_type', queryset=DataType.objects.all(), label='Data type',
         help_text='A list of integer values identifying the DataType.')
@@ -46,12 +49,18 @@ class DatasetFilter(filters.FilterSet):
         label='Project personnel', help_text='https://eml.ecoinformatics.org/schema/eml-project_xsd.html#ResearchProjectType_personnel'
     )
 
+    def search(self, queryset, name, value):
+        return search_datasets(queryset, value)
+
 
 class OccurrenceFilter(filters.FilterSet):
     """
     FilterSet for GBIFOccurrence instances
     """
-    q = filters.CharFilter(field_name='row_json_text', lookup_expr='icontains', label='Search term')
+    q = filters.CharFilter(method='search', label='Search term',
+                           help_text='Partial match on scientific name, taxonomy, locality, country, water body, '
+                                     'institution, collection, catalog number, recorder, basis of record, sampling '
+                                     'protocol, occurrence ID, event ID and dataset title.')
     # Taxon
     scientific_name = filters.CharFilter(
         field_name='scientificName', lookup_expr='icontains', label='Scientific name',
@@ -95,3 +104,6 @@ class OccurrenceFilter(filters.FilterSet):
     basis_of_record = filters.ModelMultipleChoiceFilter(
         field_name='basis_of_record', queryset=BasisOfRecord.objects.all(), label='Basis of record',
         help_text='A list of integer values identifying the BasisOfRecord.')
+
+    def search(self, queryset, name, value):
+        return search_occurrences(queryset, value)
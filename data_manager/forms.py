@@ -1,4 +1,4 @@
-from data_manager.models import BasisOfRecord, DataType, Person, Dataset, Publisher
+from data_manager.models import BasisOfRecord, Dataset
 from django import forms
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth import get_user_model
@@ -10,21 +10,19 @@ from psycopg2.extras import NumericRange
 class DatasetFilterForm(forms.Form):
     """
     Filter form for refined search on dataset listview page (search result)
-    Queryset for multiple choice field will be override in views because they are dependent on the search parameter
+    Choices for multiple choice field will be override in views because they are dependent on the search parameter
 
     """
     # Faceted search form
     q = forms.CharField(required=False, max_length=100, widget=forms.TextInput(attrs={'placeholder': ' search'}))
 
-    # Queryset for data_type, keyword, project_contact will be override in views before form validation
-    data_type = forms.ModelMultipleChoiceField(label='Data types', queryset=DataType.objects.all(), required=False,
-                                               widget=forms.CheckboxSelectMultiple())
-    publisher = forms.ModelMultipleChoiceField(label='Publisher', queryset=Publisher.objects.all(), required=False,
-                                               widget=forms.CheckboxSelectMultiple())
+    # Choices for data_type, publisher, keyword, project_contact will be override in views before form validation with
+    # the facets of datasets, so that validation does not query the database
+    data_type = forms.MultipleChoiceField(label='Data types', required=False, widget=forms.CheckboxSelectMultiple())
+    publisher = forms.MultipleChoiceField(label='Publisher', required=False, widget=forms.CheckboxSelectMultiple())
     keyword = forms.MultipleChoiceField(label='Keywords', required=False, widget=forms.SelectMultiple())
-    project_contact = forms.ModelMultipleChoiceField(label='Project contacts', required=False,
-                                                     queryset=Person.objects.all(),
-                                                     widget=forms.CheckboxSelectMultiple())
+    project_contact = forms.MultipleChoiceField(label='Project contacts', required=False,
+                                                widget=forms.CheckboxSelectMultiple())
     # Text input
     project = forms.CharField(label='Project', required=False,
                               widget=forms.TextInput(attrs={'placeholder': ' search project title'}))
@@ -53,6 +51,10 @@ class OccurrenceFilterForm(forms.Form):
                                        initial=NumericRange(-90.0, 90.0, '[)'))
     decimal_longitude = FloatRangeField(widget=RangeWidget({'type': 'number', 'step': 'any'}), required=False,
                                         initial=NumericRange(-180.0, 180.0, '[)'))
+    # keys of OCCURRENCE_SORT_FIELDS in data_manager.pagination
+    sort = forms.ChoiceField(label='Sort by', required=False, choices=[
+        ('id', 'Record'), ('-year', 'Year (newest first)'), ('year', 'Year (oldest first)'),
+        ('scientific_name', 'Scientific name (A-Z)'), ('-scientific_name', 'Scientific name (Z-A)')])
 
     def __init__(self, *args, **kwargs):
         kwargs.setdefault('label_suffix', '')
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+from concurrent.futures import ThreadPoolExecutor, wait
+from django.conf import settings
+from django.core.cache import cache
+import hashlib
+import json
+import logging
+
+
+logger = logging.getLogger('data_manager')
+
+# shared by all requests of a process, so a slow GBIF API holds at most GBIF_API_MAX_WORKERS threads
+executor = ThreadPoolExecutor(max_workers=settings.GBIF_API_MAX_WORKERS)
+
+
+def gbif_cache_key(func, kwargs):
+    """
+    Build the cache key of a call to GBIF API
+    :param func: pygbif function, e.g. species.name_usage
+    :param kwargs: keyword arguments of the function
+    :return: cache key
+    """
+    call = json.dumps([func.__module__, func.__name__, kwargs], sort_keys=True, default=str)
+    return 'gbif-api:{}'.format(hashlib.sha1(call.encode('utf-8')).hexdigest())
+
+
+def fetch_concurrently(calls):
+    """
+    Call pygbif functions concurrently in a bounded thread pool. Responses are memoised in the cache for
+    settings.GBIF_API_CACHE_TIMEOUT, only the calls that are not cached are sent to GBIF. The calls that fail or do not
+    respond within settings.GBIF_API_PAGE_TIMEOUT return their default value, so that a page can still be rendered.
+    e.g. fetch_concurrently({'parents': (species.name_usage, {'key': 1, 'data': 'parents'}, [])})
+    :param calls: a dictionary with key = name of the call, value = (pygbif function, keyword arguments, default)
+    :return: a dictionary with key = name of the call, value = response of GBIF API or default
+    """
+    cache_keys = {name: gbif_cache_key(func, kwargs) for name, (func, kwargs, default) in calls.items()}
+    cached = cache.get_many(list(cache_keys.values()))
+    results = dict()
+    futures = dict()
+    for name, (func, kwargs, default) in calls.items():
+        if cache_keys[name] in cached:
+            results[name] = cached[cache_keys[name]]
+        else:
+            futures[name] = executor.submit(func, timeout=settings.GBIF_API_PAGE_TIMEOUT, **kwargs)
+    done, not_done = wait(futures.values(), timeout=settings.GBIF_API_PAGE_TIMEOUT)
+    responses = dict()
+    for name, future in futures.items():
+        if future in done and future.exception() is None:
+            results[name] = responses[cache_keys[name]] = future.result()
+        else:
+            future.cancel()  # not started yet
+            error = future.exception() if future in done else 'no response after {} seconds'.format(
+                settings.GBIF_API_PAGE_TIMEOUT)
+            logger.warning('[GBIF API]{} {}: {}'.format(calls[name][0].__name__, calls[name][1], error))
+            results[name] = calls[name][2]
+    cache.set_many(responses, settings.GBIF_API_CACHE_TIMEOUT)
+    return results
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+from django.core.cache import cache
+import hashlib
+import logging
+import time
+
+
+logger = logging.getLogger('data_manager')
+
+EPOCH_KEY = 'generation:epoch'
+DATASET_GENERATION_KEY = 'generation:dataset:{}'
+
+
+def new_generation():
+    """
+    Return a new generation number. Generations are timestamps, so a generation that is evicted from the cache is
+    recreated with a new value and never matches the keys of entries cached before.
+    :return: int
+    """
+    return time.time_ns() // 1000
+
+
+def get_epoch():
+    """
+    Return the data epoch, the generation of the data shared by all datasets
+    :return: int
+    """
+    epoch = cache.get(EPOCH_KEY)
+    if epoch is None:
+        epoch = new_generation()
+        if not cache.add(EPOCH_KEY, epoch, None):  # set by another process in the meantime
+            epoch = cache.get(EPOCH_KEY, epoch)
+    return epoch
+
+
+def get_dataset_generations(dataset_ids):
+    """
+    Return the generation of each dataset
+    :param dataset_ids: an iterable of Dataset ids
+    :return: a dictionary with key = Dataset id, value = generation
+    """
+    keys = {DATASET_GENERATION_KEY.format(dataset_id): dataset_id for dataset_id in set(dataset_ids)}
+    generations = {keys[key]: generation for key, generation in cache.get_many(list(keys)).items()}
+    missing = {key: new_generation() for key, dataset_id in keys.items() if dataset_id not in generations}
+    if missing:
+        cache.set_many(missing, None)
+        generations.update({keys[key]: generation for key, generation in missing.items()})
+    return generations
+
+
+def bump_epoch():
+    """
+    Invalidate the cache entries built from the data of all datasets, see versioned_key()
+    :return: the new epoch
+    """
+    epoch = new_generation()
+    cache.set(EPOCH_KEY, epoch, None)
+    logger.info('[CACHE]Data epoch: {}'.format(epoch))
+    return epoch
+
+
+def bump_dataset_generations(dataset_ids):
+    """
+    Invalidate the cache entries built from the data of these datasets and the data epoch. Entries of other datasets
+    are kept.
+    :param dataset_ids: an iterable of Dataset ids that were imported, updated or deleted
+    :return: None
+    """
+    dataset_ids = set(dataset_ids)
+    if dataset_ids:
+        generation = new_generation()
+        cache.set_many({DATASET_GENERATION_KEY.format(dataset_id): generation for dataset_id in dataset_ids}, None)
+        logger.info('[CACHE]Datasets {}: generation {}'.format(sorted(dataset_ids), generation))
+    bump_epoch()
+    return
+
+
+def versioned_key(key, dataset_ids=None):
+    """
+    Add the generations of the data to a cache key, so that the entry is invalidated when the data changes instead of
+    clearing the cache after each import.
+    e.g. versioned_key('occurrence-count:form:...', [1, 2]) is invalidated when dataset 1 or 2 is imported.
+    :param key: cache key
+    :param dataset_ids: ids of the datasets the entry is built from, None if the entry is built from all datasets
+    :return: cache key
+    """
+    if dataset_ids is None:
+        return '{}:e{}'.format(key, get_epoch())
+    generations = sorted(get_dataset_generations(dataset_ids).items())
+    digest = hashlib.sha1(repr(generations).encode('utf-8')).hexdigest()
+    return '{}:d{}'.format(key, digest)
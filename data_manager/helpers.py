@@ -1,19 +1,31 @@
 # -*- coding: utf-8 -*-
+from array import array
+from collections import OrderedDict
 from data_manager.forms import DatasetFilterForm, OccurrenceFilterForm
+from data_manager.generations import versioned_key
 from data_manager.models import Download
 from django.apps import apps
-from django.contrib.postgres.search import SearchQuery
+from django.contrib.postgres.search import SearchQuery, SearchRank
 from django.conf import settings
+from django.core.cache import cache
 from django.core.files import File
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import connection
-from django.db.models import Count
-from pygbif import species
+from django.db.models import Count, F, Func, Q, Sum, TextField, Value
+from django.db.models.functions import Floor
+from django.utils.html import escape, strip_tags
+from django.utils.safestring import mark_safe
+from djangorestframework_camel_case.util import camelize
 import csv
+import hashlib
+import io
+import json
 import logging
 import os
 import psycopg2
 import tempfile
 import zipfile
+import zlib
 
 
 # LOGGING CONFIGURATION
@@ -30,6 +42,85 @@ class CouldNotCreateDownload(Exception):
     pass
 
 
+class WebSearchQuery(SearchQuery):
+    """SearchQuery with web search syntax: "quoted phrase", or, -negation (websearch_to_tsquery, PostgreSQL 11+)"""
+    SEARCH_TYPES = dict(SearchQuery.SEARCH_TYPES, websearch='websearch_to_tsquery')
+
+    def __init__(self, value, **kwargs):
+        kwargs.setdefault('search_type', 'websearch')
+        super(WebSearchQuery, self).__init__(value, **kwargs)
+
+
+class SearchHeadline(Func):
+    """ts_headline(config, document, query, options)"""
+    function = 'ts_headline'
+    output_field = TextField()
+
+    def __init__(self, expression, query, config, options):
+        super(SearchHeadline, self).__init__(Value(config), expression, query, Value(options))
+
+
+# markers of matching words in ts_headline, replaced by <mark> after the headline is escaped
+HEADLINE_START = '[[['
+HEADLINE_STOP = ']]]'
+
+
+def search_datasets(dataset_queryset, q):
+    """Full text search on Dataset.search_vector, ranked by relevance
+
+    :param dataset_queryset: Dataset queryset
+    :param q: search terms in web search syntax
+    :return: Dataset queryset matching q, ordered by rank
+    """
+    query = WebSearchQuery(q, config=settings.DATASET_SEARCH_CONFIG)
+    return dataset_queryset.filter(search_vector=query)\
+        .annotate(rank=SearchRank(F('search_vector'), query)).order_by('-rank', '-filtered_record_count')
+
+
+def search_occurrences(occurrence_queryset, q):
+    """Partial match search on GBIFOccurrence.search_document, backed by a trigram index
+
+    :param occurrence_queryset: GBIFOccurrence queryset
+    :param q: search term
+    :return: GBIFOccurrence queryset which search document contains q
+    """
+    # search_document is lower case, LIKE on the column itself uses the gin_trgm_ops index
+    return occurrence_queryset.filter(search_document__contains=' '.join(q.lower().split()))
+
+
+def filter_occurrences_by_taxon(occurrence_queryset, taxon_key):
+    """Select the occurrences of a taxon and all its lower taxa, with the GIN index of GBIFOccurrence.taxon_ancestry
+
+    :param occurrence_queryset: GBIFOccurrence queryset
+    :param taxon_key: GBIF key of the taxon, of any rank
+    :return: GBIFOccurrence queryset, empty if taxon_key is not an integer
+    """
+    try:
+        return occurrence_queryset.filter(taxon_ancestry__contains=[int(taxon_key)])
+    except (TypeError, ValueError):
+        return occurrence_queryset.none()
+
+
+def get_dataset_headlines(dataset_ids, q):
+    """Highlight q in the abstract of datasets
+
+    ts_headline is costly, only use it for the datasets displayed on a page.
+
+    :param dataset_ids: list of Dataset id
+    :param q: search terms in web search syntax
+    :return: a dictionary with key = Dataset id, value = safe html snippet with matching words in <mark>
+    """
+    Dataset = apps.get_model(app_label='data_manager', model_name='Dataset')
+    query = WebSearchQuery(q, config=settings.DATASET_SEARCH_CONFIG)
+    options = 'StartSel="{}", StopSel="{}", MaxWords=40, MinWords=15'.format(HEADLINE_START, HEADLINE_STOP)
+    headlines = Dataset.objects.filter(id__in=dataset_ids, abstract__isnull=False)\
+        .annotate(headline=SearchHeadline('abstract', query, settings.DATASET_SEARCH_CONFIG, options))\
+        .values_list('id', 'headline')
+    return {dataset_id: mark_safe(escape(strip_tags(headline)).replace(HEADLINE_START, '<mark>')
+                                  .replace(HEADLINE_STOP, '</mark>'))
+            for dataset_id, headline in headlines}
+
+
 def count_occurrence_per_hexgrid():
     """Compute number of occurrences per hexagon grid for all sizes using raw sql queries
 
@@ -106,26 +197,91 @@ def count_occurrence_per_hexgrid():
     return
 
 
+def dataset_filter_cache_key(cleaned_data=None):
+    """Build the cache key of the facets of a dataset search
+
+    The filter is normalised so that the same search in a different order or case shares the same key.
+
+    :param cleaned_data: cleaned_data of a valid DatasetFilterForm, None for all datasets
+    :return: cache key
+    """
+    normalised = dict()
+    for field, value in (cleaned_data or dict()).items():
+        if isinstance(value, (list, tuple)):
+            value = sorted(str(v) for v in value)
+        else:
+            value = ' '.join(str(value).lower().split())
+        if value:
+            normalised[field] = value
+    digest = hashlib.sha1(json.dumps(normalised, sort_keys=True).encode('utf-8')).hexdigest()
+    return versioned_key('dataset-facets:{}'.format(digest))
+
+
+def get_dataset_facets(dataset_queryset, cache_key=None):
+    """Compute the facets of a Dataset queryset
+
+    Each facet is a single grouped query on the ids of the datasets, the number of queries does not depend on the number
+    of filters applied on dataset_queryset. Facets are cached with cache_key for settings.DATASET_FACET_CACHE_TIMEOUT.
+
+    :param dataset_queryset: Dataset queryset
+    :param cache_key: key returned by dataset_filter_cache_key()
+    :return: a dictionary with key = form field name, value = list of (value, label, count) tuples
+    """
+    if cache_key is not None:
+        facets = cache.get(cache_key)
+        if facets is not None:
+            return facets
+    Dataset = apps.get_model(app_label='data_manager', model_name='Dataset')
+    Keyword = apps.get_model(app_label='data_manager', model_name='Keyword')
+    PersonTypeRole = apps.get_model(app_label='data_manager', model_name='PersonTypeRole')
+    dataset_ids = dataset_queryset.order_by().values('id')
+    datasets = Dataset.objects.filter(id__in=dataset_ids).order_by()
+    facets = {
+        'data_type': list(datasets.filter(data_type__isnull=False)
+                          .values_list('data_type_id', 'data_type__data_type').annotate(count=Count('id'))
+                          .order_by('data_type__data_type')),
+        'publisher': list(datasets.filter(publisher__isnull=False)
+                          .values_list('publisher_id', 'publisher__publisher_name').annotate(count=Count('id'))
+                          .order_by('publisher__publisher_name')),
+        'keyword': [(keyword, keyword, count) for keyword, count in Keyword.objects.filter(dataset__in=dataset_ids)
+                    .values_list('keyword').annotate(count=Count('dataset', distinct=True)).order_by('keyword')],
+        'project_contact': list(PersonTypeRole.objects.filter(person_type='personnel', dataset__in=dataset_ids,
+                                                              person__isnull=False)
+                                .values_list('person_id', 'person__full_name')
+                                .annotate(count=Count('dataset', distinct=True)).order_by('person__full_name')),
+    }
+    if cache_key is not None:
+        cache.set(cache_key, facets, settings.DATASET_FACET_CACHE_TIMEOUT)
+    return facets
+
+
+def set_dataset_form_choices(form, facets):
+    """Populate the choices of the multiple choice fields of DatasetFilterForm with facets
+
+    :param form: DatasetFilterForm
+    :param facets: facets returned by get_dataset_facets()
+    """
+    for field, values in facets.items():
+        form.fields[field].choices = [(str(value), label) for value, label, count in values]
+    return
+
+
 def get_dataset_queryset_from_form(request):
     """Get Dataset queryset from DatasetFilterForm
 
-    Filter Dataset Queryset based on the form field selected by user.
+    Filter Dataset Queryset based on the form field selected by user. Choices of the form are the facets of all datasets
+    for validation and the facets of the filtered datasets for rendering, both are cached.
 
     :param request: QueryDict - a HTTP GET request
-    :return: Dataset queryset and DatasetFilterForm populated with corresponding form queryset
+    :return: Dataset queryset and DatasetFilterForm populated with corresponding form choices
 
     """
     Dataset = apps.get_model(app_label='data_manager', model_name='Dataset')
-    DataType = apps.get_model(app_label='data_manager', model_name='DataType')
-    Keyword = apps.get_model(app_label='data_manager', model_name='Keyword')
-    Person = apps.get_model(app_label='data_manager', model_name='Person')
-    Publisher = apps.get_model(app_label='data_manager', model_name='Publisher')
     qs = Dataset.objects.all()
     form = DatasetFilterForm(request, initial=request)
-    # keyword choices cannot be empty
-    keywords_qs = Keyword.objects.filter(dataset__in=qs).values('keyword').annotate(count=Count('keyword'))
-    keywords = [(q['keyword'], q['keyword']) for q in keywords_qs]
-    form.fields['keyword'].choices = keywords  # zip(keywords, keywords)
+    # choices cannot be empty, a value selected by user must be a facet of all datasets
+    cache_key = dataset_filter_cache_key()
+    set_dataset_form_choices(form, get_dataset_facets(qs, cache_key))
     if form.is_valid():
         # form only have cleaned_data attribute after is_valid() is called
         q = form.cleaned_data.get('q', '')
@@ -136,8 +292,7 @@ def get_dataset_queryset_from_form(request):
         publisher = form.cleaned_data.get('publisher', '')
         # filter search results by chaining queryset
         if q:
-            # Ranking search results (SearchRank) imposes high cost
-            qs = qs.filter(eml_text__icontains=q)
+            qs = search_datasets(qs, q)
         if data_type:
             qs = qs.filter(data_type_id__in=data_type)
         if keyword:
@@ -149,14 +304,9 @@ def get_dataset_queryset_from_form(request):
             qs = qs.filter(personTypeRole__person_type='personnel', personTypeRole__person_id__in=project_contact)
         if publisher:
             qs = qs.filter(publisher_id__in=publisher)
-    # populate queryset for form field based on the queryset of full text search
-    keywords_qs = Keyword.objects.filter(dataset__in=qs).values('keyword').annotate(count=Count('keyword'))
-    keywords = [(q['keyword'], q['keyword']) for q in keywords_qs]
-    form.fields['keyword'].choices = keywords  # list of (keywords, keywords) tuples
-    form.fields['data_type'].queryset = DataType.objects.filter(dataset__in=qs).annotate(count=Count('id'))
-    form.fields['publisher'].queryset = Publisher.objects.filter(dataset__in=qs).annotate(count=Count('id'))
-    form.fields['project_contact'].queryset = Person.objects.filter(
-        personTypeRole__person_type='personnel', personTypeRole__dataset__in=qs).annotate(count=Count('id'))
+        cache_key = dataset_filter_cache_key(form.cleaned_data)
+    # populate choices of form field based on the queryset of full text search
+    set_dataset_form_choices(form, get_dataset_facets(qs, cache_key))
     return qs, form
 
 
@@ -183,7 +333,7 @@ def get_occurrence_queryset_from_form(get_request):
         qs = GBIFOccurrence.objects.all()
         # filter search by chaining queryset
         if q:
-            qs = qs.filter(row_json_text__icontains=q)
+            qs = search_occurrences(qs, q)
         if dataset:
             qs = qs.filter(dataset_id=dataset)
         if basis_of_record:
@@ -194,19 +344,239 @@ def get_occurrence_queryset_from_form(get_request):
             qs = qs.filter(decimalLongitude__contained_by=decimal_longitude)
         if taxon:
             # AQ OCCURRENCES
-            taxon_result = species.name_usage(key=taxon)
-            rank = taxon_result.get('rank')  # rank returned is uppercase
-            if rank in ['KINGDOM', 'PHYLUM', 'CLASS', 'ORDER', 'FAMILY', 'GENUS', 'SUBGENUS', 'SPECIES']:
-                rank = rank.lower()
-                field = '{}Key'.format(rank)
-                kwargs = {'{}'.format(field): taxon}
-                qs = qs.filter(**kwargs)
+            qs = filter_occurrences_by_taxon(qs, taxon)
         # form fields queryset
         form.fields['basis_of_record'].queryset = BasisOfRecord.objects.all()
         form.fields['dataset'].queryset = Dataset.objects.all()
         return qs, form, decimal_latitude, decimal_longitude
 
 
+# query parameters that do not change the occurrences found by a search
+OCCURRENCE_COUNT_IGNORED_PARAMS = {'count', 'cursor', 'extent', 'fields', 'format', 'group_by', 'limit', 'offset',
+                                   'output', 'page', 'sort', 'type', 'zoom'}
+# time (in seconds) after which a count_occurrences task that did not cache its count is started again
+OCCURRENCE_COUNT_PENDING_TIMEOUT = 60 * 10
+
+
+def occurrence_count_cache_key(query_dict, source='form', prefix='occurrence-count'):
+    """Build the cache key of the exact count, or another result, of an occurrence search
+
+    Pagination, sort and format parameters are ignored and the other parameters are sorted, so that every page of the
+    same search shares the same key. The key of a search filtered by dataset only changes when one of these datasets is
+    imported, the key of other searches when any dataset is imported.
+
+    :param query_dict: QueryDict of the search
+    :param source: 'form' if occurrences are filtered by get_occurrence_queryset_from_form, 'filter' by OccurrenceFilter
+    :param prefix: prefix of the key, the kind of result cached
+    :return: cache key
+    """
+    normalised = dict()
+    for param in query_dict.keys():
+        values = sorted(value for value in query_dict.getlist(param) if value)
+        if param not in OCCURRENCE_COUNT_IGNORED_PARAMS and values:
+            normalised[param] = values
+    digest = hashlib.sha1(json.dumps(normalised, sort_keys=True).encode('utf-8')).hexdigest()
+    return versioned_key('{}:{}:{}'.format(prefix, source, digest), occurrence_search_datasets(query_dict))
+
+
+def occurrence_search_datasets(query_dict):
+    """Return the ids of the datasets of an occurrence search filtered by dataset only
+
+    :param query_dict: QueryDict of the search
+    :return: a list of Dataset ids, None if the search is not filtered by dataset or has other filters
+    """
+    params = {param for param in query_dict.keys() if param not in OCCURRENCE_COUNT_IGNORED_PARAMS and
+              any(query_dict.getlist(param))}
+    values = [value for value in query_dict.getlist('dataset') if value]
+    if params == {'dataset'} and all(value.isdigit() for value in values):
+        return [int(value) for value in values]
+    return None
+
+
+def explain_queryset(queryset):
+    """Return the plan of the query planner for the rows of a queryset, without executing it
+
+    :param queryset: QuerySet object
+    :return: a dictionary, the top node of the plan with its 'Plan Rows' and 'Total Cost'
+    """
+    sql, params = queryset.order_by().values('id').query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):  # json is not decoded by the database adapter
+        plan = json.loads(plan)
+    return plan[0]['Plan']
+
+
+def estimate_queryset_count(queryset):
+    """Estimate the number of rows of a queryset from the statistics of the query planner, without executing it
+
+    :param queryset: QuerySet object
+    :return: estimated number of rows
+    """
+    return int(explain_queryset(queryset)['Plan Rows'])
+
+
+def precomputed_occurrence_count(query_dict):
+    """Estimate the number of occurrences of a search from Dataset.filtered_record_count, counted at import
+
+    Only searches without filter or filtered by dataset only can be estimated this way.
+
+    :param query_dict: QueryDict of the search
+    :return: estimated number of occurrences, None if the search has other filters
+    """
+    Dataset = apps.get_model(app_label='data_manager', model_name='Dataset')
+    params = {param for param in query_dict.keys() if param not in OCCURRENCE_COUNT_IGNORED_PARAMS and
+              any(query_dict.getlist(param))}
+    dataset_ids = occurrence_search_datasets(query_dict)
+    if not params:
+        datasets = Dataset.objects.all()
+    elif dataset_ids is not None:
+        datasets = Dataset.objects.filter(id__in=dataset_ids)
+    else:
+        return None
+    return datasets.aggregate(count=Sum('filtered_record_count'))['count'] or 0
+
+
+def get_occurrence_count(queryset, query_dict, source='form'):
+    """Count the occurrences of a search, without running an exact COUNT(*) over a large result set
+
+    1. the exact count cached for settings.OCCURRENCE_COUNT_CACHE_TIMEOUT is returned if it exists.
+    2. otherwise the count is estimated from Dataset.filtered_record_count or the query planner.
+    3. estimates up to settings.OCCURRENCE_EXACT_COUNT_THRESHOLD are replaced by the exact count. Above it, the estimate
+    is returned and the exact count is computed by the count_occurrences task for the next requests.
+
+    :param queryset: GBIFOccurrence queryset of the search
+    :param query_dict: QueryDict of the search
+    :param source: 'form' if queryset is filtered by get_occurrence_queryset_from_form, 'filter' by OccurrenceFilter
+    :return: a tuple of the number of occurrences and True if the number is estimated
+    """
+    cache_key = occurrence_count_cache_key(query_dict, source)
+    count = cache.get(cache_key)
+    if count is not None:
+        return count, False
+    estimate = precomputed_occurrence_count(query_dict)
+    if estimate is None:
+        estimate = estimate_queryset_count(queryset)
+    if estimate <= settings.OCCURRENCE_EXACT_COUNT_THRESHOLD:
+        count = queryset.order_by().values('id').count()
+        cache.set(cache_key, count, settings.OCCURRENCE_COUNT_CACHE_TIMEOUT)
+        return count, False
+    # only one task per search, until the exact count is cached
+    if cache.add(cache_key + ':pending', True, OCCURRENCE_COUNT_PENDING_TIMEOUT):
+        from data_manager.tasks import count_occurrences
+        count_occurrences.apply_async((query_dict.urlencode(), source))
+    return estimate, True
+
+
+def get_occurrence_search_result(queryset, query_dict):
+    """Return the occurrences of a search filtered by their ids, cached for the other requests of the same search
+
+    The search page requests the occurrences, their count and their grid with the same query string. The ids of the
+    occurrences found are cached by the first request, the others filter GBIFOccurrence by primary key instead of
+    running the search again. Concurrent requests wait for the first one (see TwoTierCache.get_or_set). The ids of
+    searches that find more than settings.OCCURRENCE_RESULT_CACHE_MAX_IDS occurrences are not cached.
+
+    :param queryset: GBIFOccurrence queryset returned by get_occurrence_queryset_from_form
+    :param query_dict: QueryDict of the search
+    :return: a tuple of GBIFOccurrence queryset and number of occurrences, None if the ids are not cached
+    """
+    GBIFOccurrence = apps.get_model(app_label='data_manager', model_name='GBIFOccurrence')
+
+    def search():
+        ids = queryset.order_by('id').values_list('id', flat=True)[:settings.OCCURRENCE_RESULT_CACHE_MAX_IDS + 1]
+        ids = array('q', ids)  # 8 bytes per id
+        return ids if len(ids) <= settings.OCCURRENCE_RESULT_CACHE_MAX_IDS else False
+
+    ids = cache.get_or_set(occurrence_count_cache_key(query_dict, 'form', 'occurrence-ids'), search,
+                           settings.OCCURRENCE_RESULT_CACHE_TIMEOUT)
+    if ids is False:  # too many occurrences
+        return queryset, None
+    return GBIFOccurrence.objects.filter(id__in=ids), len(ids)
+
+
+def get_occurrence_grid_counts(queryset, query_dict, size):
+    """Count the occurrences of a search per HexGrid of a size. Counts are cached, concurrent requests wait for the
+    first one.
+
+    :param queryset: GBIFOccurrence queryset of the search
+    :param query_dict: QueryDict of the search
+    :param size: size of HexGrid
+    :return: a dictionary with key = HexGrid id, value = number of occurrences
+    """
+    HexGrid = apps.get_model(app_label='data_manager', model_name='HexGrid')
+
+    def count():
+        return dict(HexGrid.objects.filter(size=size, GBIFOccurrence__in=queryset).values('id')
+                    .annotate(count=Count('GBIFOccurrence')).values_list('id', 'count'))
+
+    return cache.get_or_set(occurrence_count_cache_key(query_dict, 'form', 'occurrence-grid:{}'.format(size)), count,
+                            settings.OCCURRENCE_RESULT_CACHE_TIMEOUT)
+
+
+# dimensions of the occurrence aggregation API: key = group_by parameter, value = field of GBIFOccurrence
+OCCURRENCE_AGGREGATE_DIMENSIONS = OrderedDict([
+    ('year', 'year'), ('month', 'month'), ('basis_of_record', 'basis_of_record'), ('dataset', 'dataset'),
+    ('kingdom_key', 'kingdomKey'), ('phylum_key', 'phylumKey'), ('class_key', 'classKey'), ('order_key', 'orderKey'),
+    ('family_key', 'familyKey'), ('genus_key', 'genusKey'), ('species_key', 'speciesKey'), ('depth', 'depth'),
+])
+# dimensions and filters of OccurrenceCube, fields have the same names as in GBIFOccurrence
+OCCURRENCE_CUBE_DIMENSIONS = {'year', 'month', 'basis_of_record', 'dataset', 'species_key'}
+OCCURRENCE_CUBE_FILTERS = {'year_min', 'year_max', 'month_min', 'month_max', 'basis_of_record', 'dataset'}
+
+
+def occurrence_cube_applicable(query_dict, group_by):
+    """Return True if an aggregation can be computed from OccurrenceCube instead of GBIFOccurrence
+
+    :param query_dict: QueryDict of the search
+    :param group_by: a list of keys of OCCURRENCE_AGGREGATE_DIMENSIONS
+    :return: boolean
+    """
+    params = {param for param in query_dict.keys() if param not in OCCURRENCE_COUNT_IGNORED_PARAMS and
+              any(query_dict.getlist(param))}
+    return set(group_by) <= OCCURRENCE_CUBE_DIMENSIONS and params <= OCCURRENCE_CUBE_FILTERS
+
+
+def get_occurrence_aggregates(queryset, query_dict, group_by):
+    """Count the occurrences and the distinct species of a search per group, with a single GROUP BY query
+
+    Groups are ordered by their dimensions, at most settings.OCCURRENCE_AGGREGATE_MAX_GROUPS groups are returned. Depth
+    is grouped by bins of settings.OCCURRENCE_AGGREGATE_DEPTH_BIN meters, the value of a bin is its lower bound.
+    Results are cached per normalised query, concurrent requests wait for the first one.
+
+    :param queryset: GBIFOccurrence or OccurrenceCube queryset of the search, see occurrence_cube_applicable()
+    :param query_dict: QueryDict of the search
+    :param group_by: a list of keys of OCCURRENCE_AGGREGATE_DIMENSIONS
+    :return: a tuple of a list of dictionaries (dimensions, count and species_count) and True if groups were truncated
+    """
+    # aliases of the dimensions, which must not clash with the fields of the model
+    aliases = OrderedDict(('group_{}'.format(dimension), dimension) for dimension in group_by)
+    expressions = dict()
+    for alias, dimension in aliases.items():
+        field = OCCURRENCE_AGGREGATE_DIMENSIONS[dimension]
+        if field == 'depth':
+            size = settings.OCCURRENCE_AGGREGATE_DEPTH_BIN
+            expressions[alias] = Floor(F(field) / Value(size)) * Value(size)
+        else:
+            expressions[alias] = F(field)
+    if queryset.model._meta.model_name == 'occurrencecube':
+        count = Sum('occurrence_count')
+    else:
+        count = Count('id')
+
+    def aggregate():
+        max_groups = settings.OCCURRENCE_AGGREGATE_MAX_GROUPS
+        rows = list(queryset.order_by().values(**expressions)
+                    .annotate(count=count, species_count=Count('speciesKey', distinct=True, filter=~Q(speciesKey='')))
+                    .order_by(*aliases)[:max_groups + 1])
+        results = [OrderedDict([(dimension, row[alias]) for alias, dimension in aliases.items()] +
+                               [('count', row['count']), ('species_count', row['species_count'])]) for row in rows]
+        return results[:max_groups], len(results) > max_groups
+
+    cache_key = occurrence_count_cache_key(query_dict, 'filter', 'occurrence-aggregate:{}'.format(','.join(group_by)))
+    return cache.get_or_set(cache_key, aggregate, settings.OCCURRENCE_RESULT_CACHE_TIMEOUT)
+
+
 def write_file(queryset, field_names, download, prepare_download_id):
     """
     Write Download file
@@ -221,7 +591,6 @@ def write_file(queryset, field_names, download, prepare_download_id):
     download.task_id = prepare_download_id
     download.record_count = queryset.count()
     download.save()
-    datasets = set()
     # write regular files in temporary dictionary
     with tempfile.TemporaryDirectory() as tmpdir:
         csv_file_path = os.path.join(tmpdir, csv_file_name)
@@ -230,21 +599,52 @@ def write_file(queryset, field_names, download, prepare_download_id):
             # create a plain csv in the tmp dir with the requested occurrences
             writer = csv.writer(outfile)
             writer.writerow(field_names)
-            for occ in queryset.iterator():
-                datasets.add(occ.dataset)
-                # Because all strings are returned from the database as str objects, model fields that are character
-                # based (CharField, TextField, URLField, etc.) will contain Unicode values when Django retrieves data
-                # from the database. This is always the case, even if the data could fit into an ASCII bytestring.
-                writer.writerow(occ.to_csv_tuple())
+            # only the requested columns are read from the database, rows are tuples instead of model instances
+            writer.writerows(queryset.values_list(*field_names).iterator())
         with zipfile.ZipFile(zip_file_path, mode='w') as zf:
             # write csv file above into ZipFile, arcname specifies the name of the csv file within this ZipFile
             zf.write(csv_file_path, arcname=csv_file_name, compress_type=zipfile.ZIP_DEFLATED)
         with open(zip_file_path, 'rb') as zf:
             download.file.save(zip_file_name, File(zf), save=True)
-        download.dataset.set(datasets)
+        download.dataset.set(queryset.order_by().values_list('dataset_id', flat=True).distinct())
     return
 
 
+def stream_occurrences(queryset, field_names, output='csv', compress=False):
+    """
+    Yield the occurrences of a queryset as CSV or newline delimited JSON. Rows are read from a server-side cursor and
+    yielded by chunks of settings.OCCURRENCE_EXPORT_CHUNK_SIZE rows, so memory does not grow with the number of rows.
+    NDJSON keys are the camelCase keys of the occurrence API.
+    :param queryset: GBIFOccurrence queryset
+    :param field_names: a list of field names of GBIFOccurrence
+    :param output: 'csv' or 'ndjson'
+    :param compress: True to gzip the output
+    :return: a generator of bytes
+    """
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS) if compress else None
+    buffer = io.StringIO()
+    if output == 'ndjson':
+        keys = list(camelize(OrderedDict.fromkeys(field_names)))
+        encoder = DjangoJSONEncoder(ensure_ascii=False)
+    else:
+        writer = csv.writer(buffer)
+        writer.writerow(field_names)
+    rows = queryset.values_list(*field_names).iterator(chunk_size=settings.OCCURRENCE_EXPORT_CHUNK_SIZE)
+    for i, row in enumerate(rows, 1):
+        if output == 'ndjson':
+            buffer.write(encoder.encode(dict(zip(keys, row))))
+            buffer.write('\n')
+        else:
+            writer.writerow(row)
+        if i % settings.OCCURRENCE_EXPORT_CHUNK_SIZE == 0:
+            data = buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+            yield compressor.compress(data) if compressor else data
+    data = buffer.getvalue().encode('utf-8')
+    yield compressor.compress(data) + compressor.flush() if compressor else data
+
+
 def create_download_file(queryset, field_names, download):
     """
     todo: To be deprecated in the future.
@@ -253,7 +653,6 @@ def create_download_file(queryset, field_names, download):
     task_id = download.task_id
     csv_file_name = '{}.csv'.format(task_id)
     zip_file_name = '{}.zip'.format(task_id)
-    datasets = set()
     # write regular files in temporary dictionary
     with tempfile.TemporaryDirectory() as tmpdir:
         csv_file_path = os.path.join(tmpdir, csv_file_name)
@@ -262,18 +661,14 @@ def create_download_file(queryset, field_names, download):
             # create a plain csv in the tmp dir with the requested occurrences
             writer = csv.writer(outfile)
             writer.writerow(field_names)
-            for occ in queryset.iterator():
-                datasets.add(occ.dataset)
-                # Because all strings are returned from the database as str objects, model fields that are character
-                # based (CharField, TextField, URLField, etc.) will contain Unicode values when Django retrieves data
-                # from the database. This is always the case, even if the data could fit into an ASCII bytestring.
-                writer.writerow(occ.to_csv_tuple())
+            # only the requested columns are read from the database, rows are tuples instead of model instances
+            writer.writerows(queryset.values_list(*field_names).iterator())
         with zipfile.ZipFile(zip_file_path, mode='w') as zf:
             # write csv file above into ZipFile, arcname specifies the name of the csv file within this ZipFile
             zf.write(csv_file_path, arcname=csv_file_name, compress_type=zipfile.ZIP_DEFLATED)
         with open(zip_file_path, 'rb') as zf:
             download.file.save(zip_file_name, File(zf), save=True)
-        download.dataset.set(datasets)
+        download.dataset.set(queryset.order_by().values_list('dataset_id', flat=True).distinct())
     return download
 
 
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+from data_manager.helpers import search_occurrences
+from data_manager.models import GBIFOccurrence
+from django.core.management.base import BaseCommand
+from statistics import median
+from timeit import default_timer
+import re
+
+
+def get_lookups(term):
+    """
+    Return the partial match lookups of occurrence search for a search term
+    :param term: search term
+    :return: a list of (name, GBIFOccurrence queryset) tuples
+    """
+    return [
+        ('q (row_json_text icontains)', GBIFOccurrence.objects.filter(row_json_text__icontains=term)),
+        ('q (search_document)', search_occurrences(GBIFOccurrence.objects.all(), term)),
+        ('scientific_name', GBIFOccurrence.objects.filter(scientificName__icontains=term)),
+        ('locality', GBIFOccurrence.objects.filter(locality__icontains=term)),
+        ('sampling_protocol', GBIFOccurrence.objects.filter(samplingProtocol__icontains=term)),
+    ]
+
+
+def time_queryset(queryset, repeat):
+    """
+    Time the first page of a queryset
+    :param queryset: QuerySet object
+    :param repeat: number of times the query is executed
+    :return: median time in milliseconds
+    """
+    timings = []
+    for i in range(repeat):
+        start = default_timer()
+        list(queryset.only('id')[:20])
+        timings.append((default_timer() - start) * 1000)
+    return median(timings)
+
+
+class Command(BaseCommand):
+    """
+    Example usage:
+        python manage.py benchmark_occurrence_search --term antarctica --term "south georgia" --repeat 5
+    """
+    help = """
+    Measure the latency of partial match lookups of occurrence search (first page of 20 records) and list the indexes
+    used by the query plan.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--term', action='append', required=True, help='search term, can be repeated')
+        parser.add_argument('--repeat', type=int, default=5, help='number of runs per lookup, median is reported')
+
+    def handle(self, *args, **options):
+        for term in options['term']:
+            self.stdout.write('term: {}'.format(term))
+            for name, queryset in get_lookups(term):
+                plan = queryset.only('id')[:20].explain()
+                indexes = sorted(set(re.findall(r'Index (?:Only )?Scan (?:using|on) (\w+)', plan))) or ['-']
+                self.stdout.write('  {:<30} {:>10.1f} ms  index: {}'.format(
+                    name, time_queryset(queryset, options['repeat']), ', '.join(indexes)))
+        return
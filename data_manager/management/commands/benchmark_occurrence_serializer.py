@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+from data_manager.models import GBIFOccurrence
+from data_manager.renderers import CamelizedJSONRenderer
+from data_manager.serializers import OccurrenceSerializer
+from django.core.management.base import BaseCommand, CommandError
+from djangorestframework_camel_case.render import CamelCaseJSONRenderer
+from statistics import median
+from timeit import default_timer
+
+
+def render_serializer(queryset):
+    """
+    Render a page of occurrences with OccurrenceSerializer and CamelCaseJSONRenderer
+    :param queryset: GBIFOccurrence queryset
+    :return: bytes
+    """
+    data = OccurrenceSerializer(list(queryset), many=True).data
+    return CamelCaseJSONRenderer().render({'results': data})
+
+
+def render_values(queryset):
+    """
+    Render a page of occurrences as OccurrenceViewSet.list does
+    :param queryset: GBIFOccurrence queryset
+    :return: bytes
+    """
+    rows = queryset.values(*OccurrenceSerializer.Meta.fields)
+    return CamelizedJSONRenderer().render({'results': OccurrenceSerializer.serialize_values(rows)})
+
+
+class Command(BaseCommand):
+    """
+    Example usage:
+        python manage.py benchmark_occurrence_serializer --limit 1000 --repeat 5
+    """
+    help = """
+    Measure the throughput (rows per second) of the occurrence list serialization: OccurrenceSerializer with
+    CamelCaseJSONRenderer against QuerySet.values() with OccurrenceSerializer.serialize_values(). Both must render the
+    same JSON.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=1000, help='number of occurrences per page')
+        parser.add_argument('--repeat', type=int, default=5, help='number of runs per path, median is reported')
+
+    def handle(self, *args, **options):
+        queryset = GBIFOccurrence.objects.order_by('id')[:options['limit']]
+        rows = queryset.count()
+        if render_serializer(queryset) != render_values(queryset):
+            raise CommandError('OccurrenceSerializer.serialize_values() does not render the same JSON')
+        for name, render in [('serializer', render_serializer), ('values', render_values)]:
+            timings = []
+            for i in range(options['repeat']):
+                start = default_timer()
+                render(queryset)
+                timings.append(default_timer() - start)
+            self.stdout.write('{:<12} {:>10.0f} rows/s'.format(name, rows / median(timings)))
+        return
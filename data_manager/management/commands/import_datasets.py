@@ -1,16 +1,21 @@
 # -*- coding: utf-8 -*-
+import functools
 import multiprocessing as mp
 import requests
+from concurrent.futures import ThreadPoolExecutor
 import defusedxml.ElementTree as ET
 from dwca.exceptions import InvalidArchive
 from dwca.read import DwCAReader
+from data_manager.archives import payload_hashes
 from data_manager.models import *
+from data_manager.generations import bump_dataset_generations, bump_epoch
 from data_manager.helpers import count_occurrence_per_hexgrid, vacuum
 from django.conf import settings
-from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
 from django.core.management.base import BaseCommand, CommandError
 from django.db import IntegrityError, connections
+from django.db.models import Q
+from pygbif import registry
 from shapely.geometry import shape, Point
 
 
@@ -129,18 +134,65 @@ def get_eml_of_metadata_only_datasets(dataset_key):
     return uuid_eml_dict
 
 
+def get_registry_records(dataset_keys):
+    """
+    Get the GBIF registry record of each dataset, with at most settings.GBIF_API_MAX_WORKERS requests sent to GBIF at
+    the same time.
+    :param dataset_keys: an iterable of dataset uuid
+    :return: a dict with key = dataset uuid, value = registry record (dict) or None if it could not be retrieved
+    """
+    def get_registry_record(dataset_key):
+        try:
+            # if dataset_key is None, response will return all datasets
+            uuid.UUID(dataset_key)  # raise ValueError if dataset_key is not a proper UUID
+            return dataset_key, registry.datasets(uuid=dataset_key, timeout=settings.GBIF_API_TIMEOUT)
+        except Exception as e:
+            logger.warning('[REGISTRY]Could not get registry record of dataset {}: {}'.format(dataset_key, e))
+            return dataset_key, None
+
+    with ThreadPoolExecutor(max_workers=settings.GBIF_API_MAX_WORKERS) as executor:
+        return dict(executor.map(get_registry_record, set(dataset_keys)))
+
+
+def detect_dataset_changes(dataset_queryset):
+    """
+    Classify each Dataset as deleted, modified or unchanged on GBIF with a single registry request per dataset.
+    HarvestedDataset of deleted datasets are flagged deleted_from_gbif=True and include_in_antabif=False in bulk.
+    A Dataset which registry record could not be retrieved is considered unchanged, it will be checked again in the
+    next cycle.
+    :param dataset_queryset: QuerySet object of Dataset model
+    :return: a dict with key = Dataset.DELETED, Dataset.MODIFIED or Dataset.UNCHANGED, value = a set of dataset uuid
+    """
+    if dataset_queryset.model != Dataset:
+        raise WrongModelException('Expect a data_manager.models.Dataset QuerySet')
+    datasets = list(dataset_queryset.only('id', 'dataset_key', 'download_on'))
+    registry_records = get_registry_records(dataset.dataset_key for dataset in datasets)
+    changes = {Dataset.DELETED: set(), Dataset.MODIFIED: set(), Dataset.UNCHANGED: set()}
+    for dataset in datasets:
+        registry_record = registry_records.get(dataset.dataset_key)
+        if registry_record is None:
+            status = Dataset.UNCHANGED
+        else:
+            status = dataset.compare_with_registry(registry_record)
+        changes[status].add(dataset.dataset_key)
+    if changes[Dataset.DELETED]:
+        HarvestedDataset.objects.filter(key__in=changes[Dataset.DELETED])\
+            .update(deleted_from_gbif=True, include_in_antabif=False)
+    logger.info('[REGISTRY]Deleted: {}, modified: {}, unchanged: {}'.format(
+        len(changes[Dataset.DELETED]), len(changes[Dataset.MODIFIED]), len(changes[Dataset.UNCHANGED])))
+    return changes
+
+
 def get_metadata_dataset_to_download():
     """
     Get a set of new and outdated metadata-only HarvestedDataset
     :return: HarvestedDataset QuerySet
     """
-    # new metadata-only dataset to be downloaded and imported
-    metadata_datasets = HarvestedDataset.objects.filter(include_in_antabif=True, type='METADATA',
-                                                        dataset__isnull=True)
     # check metadata only datasets has new version
-    for dataset in Dataset.objects.filter(data_type__data_type='Metadata'):
-        if dataset.has_new_version():
-            metadata_datasets | HarvestedDataset.objects.filter(key=dataset.dataset_key)  # merge queryset
+    changes = detect_dataset_changes(Dataset.objects.filter(data_type__data_type='Metadata'))
+    # new metadata-only dataset to be downloaded and imported, together with the outdated ones
+    metadata_datasets = HarvestedDataset.objects.filter(include_in_antabif=True, type='METADATA')\
+        .filter(Q(dataset__isnull=True) | Q(key__in=changes[Dataset.MODIFIED]))
     return metadata_datasets
 
 
@@ -164,10 +216,11 @@ def import_metadata_only_datasets(harvested_datasets):
     return
 
 
-def import_eml(uuid_eml_dict):
+def import_eml(uuid_eml_dict, keep_occurrences=False):
     """
     Import EML to database
     :param uuid_eml_dict: a dictionary with key = dataset uuid, value = xml Element object (use defusedxml to parse xml)
+    :param keep_occurrences: do not delete the occurrence records of the dataset, only update the metadata
     """
     if not isinstance(uuid_eml_dict, dict):
         raise TypeError('Requires a dict, not a {}'.format(type(uuid_eml_dict)))
@@ -180,7 +233,7 @@ def import_eml(uuid_eml_dict):
         # delete occurrence records of datasets to be updated. Keep the rest, do not delete the full dataset and all
         # other cascade delete records - need to keep the id for Download objects
         old_occurrences = GBIFOccurrence.objects.filter(dataset__dataset_key=dataset_uuid)
-        if old_occurrences.exists():
+        if not keep_occurrences and old_occurrences.exists():
             delete_by_batch(old_occurrences)
         # create objects using model managers
         project_object = Project.objects.from_gbif_dwca_eml(eml_tree)
@@ -188,6 +241,9 @@ def import_eml(uuid_eml_dict):
         HarvestedDataset.objects.filter(key=dataset_uuid).update(dataset=dataset_object)
         Keyword.objects.from_gbif_dwca_eml(eml_tree, dataset_object)
         add_person_from_gbif_dwca_eml(eml_tree, dataset_object, project_object)
+        Dataset.objects.update_search_vector(pk=dataset_object.pk)
+        Dataset.objects.update_detail(pk=dataset_object.pk)
+        bump_dataset_generations([dataset_object.pk])
     return dataset_object
 
 
@@ -215,6 +271,8 @@ def update_dataset_with_gbif_api(dataset_queryset):
             dataset.publisher = publisher
             dataset.count_occurrence_per_dataset()
             dataset.save()
+            Dataset.objects.update_search_vector(pk=dataset.pk)  # publisher is part of the search vector
+        bump_dataset_generations(dataset.pk for dataset in dataset_queryset)
     return
 
 
@@ -239,7 +297,9 @@ def join_hexgrid_occurrence():
     Assign HexGrid which contains the GBIFOccurrence's geopoint to the GBIFOccurrence.
     """
     qs = GBIFOccurrence.objects.exclude(geopoint__isnull=True).filter(hexgrid__isnull=True)
+    dataset_ids = set()
     for occ in qs.iterator():
+        dataset_ids.add(occ.dataset_id)
         try:
             grid = HexGrid.objects.filter(geom__contains=occ.geopoint)
         except ObjectDoesNotExist:
@@ -251,6 +311,8 @@ def join_hexgrid_occurrence():
         except Exception as e:
             logger.error(e, "[HEXBIN]Occurrence id: {}".format(occ.id))
             pass
+    Dataset.objects.update_has_grid()
+    bump_dataset_generations(dataset_ids)
     return
 
 
@@ -288,32 +350,53 @@ def get_core_gbifID_with_verbatim(verbatim_row, gbif_ids):
 def populate_db(archive, **options):
     """
     Populate database
+    A GBIF download can contain records of multiple datasets, with the EML of each dataset in dataset/ folder of the
+    archive. Records are split by their datasetKey and imported into their own Dataset.
+    Occurrences of a dataset are not imported again if the hash of its payload matches the one last imported, unless
+    options["force"] is set. Only the EML of the dataset is updated.
     :param archive: the name of darwin-core archive
     :param options: kwargs from handle()
-    :return:
+    :return: a dictionary with key = dataset uuid, value = payload hash of the datasets imported
     """
     bulk_create_count = 0
     try:
         dwca = DwCAReader(archive)
     except InvalidArchive:
         return
-    # get dataset uuid of the archive being processed. Each dwca archive will only have 1 dataset.
-    try:
-        uuid = [key for key in dwca.source_metadata.keys()][0]
-    except IndexError as e:  # sometimes dwca downloaded is empty - empty occurrence.txt, no EML file
-        logger.warning('[IMPORT][FAIL]{}, message: {}'.format(archive, e))
+    # get dataset uuids of the archive being processed, one EML per dataset: dataset/<datasetKey>.xml
+    dataset_uuids = list(dwca.source_metadata.keys())
+    if not dataset_uuids:  # sometimes dwca downloaded is empty - empty occurrence.txt, no EML file
+        logger.warning('[IMPORT][FAIL]{}, message: no dataset metadata in archive'.format(archive))
+        dwca.close()
         return
     # only import records if the core type is Occurrence
     if not dwca.descriptor.core.type == 'http://rs.tdwg.org/dwc/terms/Occurrence':
+        dwca.close()
         return
-    try:
-        import_all_rows = HarvestedDataset.objects.get(key=uuid).import_full_dataset
-    except HarvestedDataset.DoesNotExist:
-        return
+    # only import datasets which are harvested
+    import_all_rows_dict = dict(HarvestedDataset.objects.filter(key__in=dataset_uuids)
+                                .values_list('key', 'import_full_dataset'))
+    # compare the occurrence payload with the last import, metadata-only edits do not need to re-import occurrences
+    hashes = payload_hashes(dwca, import_all_rows_dict)
+    if options.get('force'):
+        unchanged = set()
+    else:
+        unchanged = set(HarvestedDataset.objects.filter(key__in=import_all_rows_dict.keys(), dataset__isnull=False)
+                        .values_list('key', 'payload_hash')) & set(hashes.items())
+        unchanged = {dataset_uuid for dataset_uuid, payload_hash in unchanged}
     # ----------------------------
     #  import eml: <datasetKey>.xml
     # ----------------------------
-    dataset_object = import_eml(dwca.source_metadata)
+    dataset_objects = dict()
+    for dataset_uuid in dataset_uuids:
+        if dataset_uuid in unchanged:
+            logger.info('[IMPORT]Occurrences of dataset {} unchanged, update metadata only'.format(dataset_uuid))
+            import_eml({dataset_uuid: dwca.source_metadata[dataset_uuid]}, keep_occurrences=True)
+        elif dataset_uuid in import_all_rows_dict:
+            dataset_objects[dataset_uuid] = import_eml({dataset_uuid: dwca.source_metadata[dataset_uuid]})
+    if not dataset_objects:
+        dwca.close()
+        return {dataset_uuid: hashes[dataset_uuid] for dataset_uuid in unchanged}
     # -----------------------
     #  import occurrence.txt
     # -----------------------
@@ -322,12 +405,20 @@ def populate_db(archive, **options):
     # read occurrence.txt line by line to prevent overloading of memory
     for i, row in enumerate(dwca):
         interpreted_data = row.data
+        # split records by dataset
+        if len(dataset_uuids) == 1:
+            dataset_uuid = dataset_uuids[0]
+        else:
+            dataset_uuid = interpreted_data.get('http://rs.gbif.org/terms/1.0/datasetKey')
+        dataset_object = dataset_objects.get(dataset_uuid)
+        if dataset_object is None:  # dataset not harvested
+            continue
         gbif_id = interpreted_data.get('http://rs.gbif.org/terms/1.0/gbifID')
         # prevent duplicated record
         if GBIFOccurrence.objects.filter(gbifID=gbif_id).exists() or gbif_id in gbif_ids:
             continue
         # Filter out non subantarctic/antarctic occurrences
-        if import_all_rows:
+        if import_all_rows_dict.get(dataset_uuid):
             gbif_ids.add(gbif_id)
             occ_object = GBIFOccurrence.objects.instantiate(interpreted_data, dataset_object)
         elif occurrence_is_antarctic(row, subantarctic_polygon):
@@ -340,7 +431,7 @@ def populate_db(archive, **options):
         if len(list_of_occ) != 0 and len(list_of_occ) % 5000 == 0:
             GBIFOccurrence.objects.bulk_create(list_of_occ)
             bulk_create_count += 1
-            logger.info('[IMPORT]Row: {}, Dataset: {}'.format(i, uuid))
+            logger.info('[IMPORT]Row: {}, Dataset: {}'.format(i, dataset_uuid))
             list_of_occ = []
             gbif_ids = set()
         # vacuum when there is too many insert/update
@@ -349,10 +440,15 @@ def populate_db(archive, **options):
     # remainder
     GBIFOccurrence.objects.bulk_create(list_of_occ)
     bulk_create_count += 1
-    # update fk for HarvestedDataset
-    HarvestedDataset.objects.filter(key=uuid).update(dataset=dataset_object)
+    # update fk and payload hash for HarvestedDataset
+    for dataset_uuid, dataset_object in dataset_objects.items():
+        HarvestedDataset.objects.filter(key=dataset_uuid).update(dataset=dataset_object,
+                                                                  payload_hash=hashes.get(dataset_uuid))
+    OccurrenceCube.objects.rebuild(dataset_object.pk for dataset_object in dataset_objects.values())
+    bump_dataset_generations(dataset_object.pk for dataset_object in dataset_objects.values())
     dwca.close()
-    return
+    return {dataset_uuid: hashes[dataset_uuid] for dataset_uuid in set(dataset_objects) | unchanged
+            if dataset_uuid in hashes}
 
 
 # subantarctic polygon
@@ -377,9 +473,10 @@ class Command(BaseCommand):
                             help='perform hexbin on occurrences')
         parser.add_argument('--full-text-index', dest='full-text-index', action='store_true', required=False,
                             help='create index for full text search')
+        parser.add_argument('--force', dest='force', action='store_true', required=False,
+                            help='import occurrences even if the payload of the dataset did not change')
 
     def handle(self, *args, **options):
-        cache.clear()
         # delete dataset in database which should not be imported
         for harvested_dataset in HarvestedDataset.objects.filter(include_in_antabif=False):
             harvested_dataset.delete_related_objects()
@@ -397,7 +494,7 @@ class Command(BaseCommand):
             connections.close_all()
             with mp.Pool(processes=settings.CPU_COUNT, maxtasksperchild=1) as pool:
                 # chops the iterable into a number of chunks which it submits to the process pool as separate tasks.
-                pool.map(populate_db, archives, chunksize=settings.CPU_COUNT)
+                pool.map(functools.partial(populate_db, **options), archives, chunksize=settings.CPU_COUNT)
                 pool.close()
                 pool.join()
         metadata_datasets = get_metadata_dataset_to_download()
@@ -418,5 +515,6 @@ class Command(BaseCommand):
             join_hexgrid_occurrence()  # assign HexGrid to each GBIFOccurrence record.
             count_occurrence_per_hexgrid()  # for home page map
         vacuum()
-        cache.clear()
+        Statistics.objects.compute()  # for home page and db-statistics
+        bump_epoch()  # imported and deleted datasets bumped their own generation
         return 'done'
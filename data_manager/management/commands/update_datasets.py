@@ -2,15 +2,21 @@
 import os
 import time
 import logging
+import multiprocessing as mp
 import requests
 
-from data_manager.management.commands.import_datasets import join_hexgrid_occurrence
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from data_manager.archives import ArchiveNotDownloaded, BandwidthLimiter, cache_archive, download_archive
+from data_manager.management.commands.import_datasets import join_hexgrid_occurrence, detect_dataset_changes, \
+    populate_db
+from data_manager.generations import bump_epoch
 from data_manager.helpers import count_occurrence_per_hexgrid
 from data_manager.models import Dataset, HarvestedDataset
-from django.core.cache import cache
 from django.core.management.base import BaseCommand
 from django.core.management import call_command
 from django.conf import settings
+from django.db import connections
 from pygbif import occurrences
 from urllib.parse import urljoin
 
@@ -32,21 +38,23 @@ def delete_files_in_directory(directory):
     return
 
 
-def get_download_key(dataset_uuid):
+def get_download_key(dataset_uuids):
     """
     Return a single download key from GBIF API.
-    Uses pygbif.occurrences.download to spin up a download request for GBIF occurrence data.
-    :param dataset_uuid: A set of dataset keys (uuid)
+    Uses pygbif.occurrences.download to spin up a download request for GBIF occurrence data. Multiple datasets are
+    requested in a single download with datasetKey predicates combined by "or".
+    :param dataset_uuids: a dataset key (uuid) or an iterable of dataset keys
     :return: single download key for the request (e.g. 0098562-160910150852091)
     """
-
-    query = ['datasetKey = {}'.format(dataset_uuid)]
-    logger.debug('[DOWNLOAD]Obtaining download key for dataset: {}'.format(dataset_uuid))
+    if isinstance(dataset_uuids, str):
+        dataset_uuids = [dataset_uuids]
+    query = ['datasetKey = {}'.format(dataset_uuid) for dataset_uuid in sorted(dataset_uuids)]
+    logger.debug('[DOWNLOAD]Obtaining download key for dataset: {}'.format(', '.join(sorted(dataset_uuids))))
     try:
         request_result = occurrences.download(query, user=settings.GBIF_USER, pwd=settings.GBIF_USER_PASSWORD,
-                                              email=settings.GBIF_USER_EMAIL)
+                                              email=settings.GBIF_USER_EMAIL, pred_type='or')
     except Exception as e:  # Too many simultaneous downloads throws Exception instead of a subclass of Exception
-        logger.warning(e, dataset_uuid)
+        logger.warning('[DOWNLOAD]{}: {}'.format(e, ', '.join(sorted(dataset_uuids))))
         return None
     download_key = request_result[0]
     return download_key
@@ -66,49 +74,118 @@ def update_harvested_dataset_fk():
     return
 
 
-def request_download(download_key, counter, total_downloads):
+def cancel_download(download_key):
     """
-    Performs polling based on a single download_key obtained from get_download_key()
-    Once status of polling result status is 'SUCCEEDED', archive will be downloaded and save to
-    settings.DOWNLOADS_DIR.
+    Cancel a download request at GBIF
+    :param download_key: download key obtained from get_download_key()
     """
-    dataset_ok = False
-    start_time = time.time()
-    while not dataset_ok:
-        polling_duration = time.time() - start_time
-        if polling_duration > 10800:  # if polling last more than 3 hours
-            download_resource_url = 'occurrence/download/request/{}'.format(download_key)
-            download_url = urljoin(settings.GBIF_API_BASE, download_resource_url)
-            requests.delete(download_url, auth=(settings.GBIF_USER_EMAIL, settings.GBIF_USER_PASSWORD))
-            return dataset_ok
-        try:
-            results = occurrences.download_meta(key=download_key)
-        except Exception as e:
-            logger.error(e, download_key)
-            return False
-        if results['status'] == 'PREPARING' or results['status'] == 'RUNNING' or results['status'] == 'UNAVAILABLE':
-            logger.debug('[DOWNLOAD]Polling {}/{} [{}] {}: {}'.format(
-                counter, total_downloads, results['status'], results['key'], results['downloadLink']))
-            time.sleep(60)  # wait for 60 seconds before requesting the status again
-        elif results['status'] == 'SUCCEEDED':
-            # status can be 'CANCELLED', 'KILLED' or 'RUNNING', only download when status is 'SUCCEEDED'
-            dataset_ok = True
-            filename = download_key + '.zip'
-            logger.info('[DOWNLOAD]Downloading darwin core archive {}/{}'.format(counter, total_downloads))
-            # retrieve archive and save to DOWNLOADS_DIR
-            download_file_path = os.path.join(settings.DOWNLOADS_DIR, filename)
-            download_link = results.get('downloadLink')
-            response = requests.get(download_link, stream=True)
-            handle = open(download_file_path, 'wb')
-            for chunk in response.iter_content(chunk_size=512):  # write file by chunk
-                if chunk:
-                    handle.write(chunk)
-            handle.close()
-            logger.info('[DOWNLOAD]Archive downloaded: {}'.format(download_key))
-        else:
-            logger.info('[DOWNLOAD][{}] {}: {}'.format(results['status'], results['key'], results['downloadLink']))
-            dataset_ok = True
-    return True
+    download_resource_url = 'occurrence/download/request/{}'.format(download_key)
+    download_url = urljoin(settings.GBIF_API_BASE, download_resource_url)
+    requests.delete(download_url, auth=(settings.GBIF_USER_EMAIL, settings.GBIF_USER_PASSWORD))
+    return
+
+
+def import_archive(archive):
+    """
+    Import a darwin core archive, keep it in settings.ARCHIVE_CACHE_DIR and delete it from settings.DOWNLOADS_DIR, so
+    that it will not be imported again by import_datasets.
+    Run in a separate process.
+    :param archive: full path of darwin core archive
+    """
+    try:
+        hashes = populate_db(archive)
+        if hashes:
+            cache_archive(archive, hashes)
+    except Exception as e:
+        logger.error('[IMPORT][FAIL]{}, message: {}'.format(archive, e))
+    finally:
+        if os.path.isfile(archive):
+            os.unlink(archive)
+    return
+
+
+def download_and_import(dataset_uuids, datasets_per_download=1):
+    """
+    Request GBIF downloads for the datasets and import each archive as soon as it is downloaded.
+
+    Datasets are grouped into batches of datasets_per_download, one GBIF download per batch. The archive of a batch
+    is split by datasetKey in populate_db().
+
+    Download requests are submitted up front, up to settings.GBIF_MAX_CONCURRENT_DOWNLOADS at a time. All outstanding
+    download keys are polled together every settings.GBIF_DOWNLOAD_POLL_INTERVAL seconds and a download which takes
+    more than settings.GBIF_DOWNLOAD_TIMEOUT seconds is cancelled. Archives are downloaded by
+    settings.GBIF_DOWNLOAD_WORKERS threads sharing settings.GBIF_DOWNLOAD_MAX_BANDWIDTH, and imported by a pool of
+    processes while the other downloads are still being generated by GBIF.
+    :param dataset_uuids: an iterable of dataset uuid
+    :param datasets_per_download: maximum number of datasets in a single download
+    :return: number of archives downloaded
+    """
+    dataset_uuids = sorted(dataset_uuids)
+    datasets_per_download = max(1, datasets_per_download)
+    pending = deque(dataset_uuids[i:i + datasets_per_download]
+                    for i in range(0, len(dataset_uuids), datasets_per_download))
+    total_downloads = len(pending)
+    outstanding = dict()  # key = download key, value = (batch of dataset uuids, time of request)
+    downloading = dict()  # key = future of download_archive(), value = (download key, batch of dataset uuids)
+    downloaded = 0
+    limiter = BandwidthLimiter(settings.GBIF_DOWNLOAD_MAX_BANDWIDTH)
+    # forked import processes must not share the database connections of this process
+    connections.close_all()
+    with mp.Pool(processes=settings.CPU_COUNT, maxtasksperchild=1) as pool, \
+            ThreadPoolExecutor(max_workers=settings.GBIF_DOWNLOAD_WORKERS) as executor:
+        while pending or outstanding or downloading:
+            # submit download requests within the number of simultaneous downloads allowed by GBIF
+            while pending and len(outstanding) < settings.GBIF_MAX_CONCURRENT_DOWNLOADS:
+                batch = pending.popleft()
+                logger.info('[DOWNLOAD]Requesting download {}/{} dataset uuid: {}'.format(
+                    total_downloads - len(pending), total_downloads, ', '.join(batch)))
+                download_key = get_download_key(batch)
+                if download_key is not None:
+                    outstanding[download_key] = (batch, time.time())
+            # poll all outstanding downloads
+            for download_key, (batch, requested_on) in list(outstanding.items()):
+                try:
+                    results = occurrences.download_meta(key=download_key, timeout=settings.GBIF_API_TIMEOUT)
+                except Exception as e:  # try again in the next round
+                    logger.warning('[DOWNLOAD]Polling {} failed: {}'.format(download_key, e))
+                    results = {'status': 'UNAVAILABLE'}
+                status = results.get('status')
+                if status in ['PREPARING', 'RUNNING', 'UNAVAILABLE']:
+                    if time.time() - requested_on > settings.GBIF_DOWNLOAD_TIMEOUT:
+                        logger.warning('[DOWNLOAD]Cancelling {} of {} datasets'.format(download_key, len(batch)))
+                        cancel_download(download_key)
+                        del outstanding[download_key]
+                    continue
+                del outstanding[download_key]
+                if status == 'SUCCEEDED':
+                    # status can be 'CANCELLED', 'KILLED' or 'RUNNING', only download when status is 'SUCCEEDED'
+                    future = executor.submit(download_archive, download_key, results.get('downloadLink'),
+                                             results.get('size'), limiter)
+                    downloading[future] = (download_key, batch)
+                else:
+                    logger.info('[DOWNLOAD][{}] {}: {}'.format(status, download_key, ', '.join(batch)))
+            # hand the downloaded archives to the import pool
+            for future in [future for future in downloading if future.done()]:
+                download_key, batch = downloading.pop(future)
+                try:
+                    archive = future.result()
+                except ArchiveNotDownloaded as e:
+                    logger.error('[DOWNLOAD][FAIL]{}'.format(e))
+                    continue
+                except (OSError, requests.RequestException) as e:  # e.g. disk full, connection reset
+                    logger.error('[DOWNLOAD][FAIL]{}: {} ({})'.format(download_key, ', '.join(batch), e))
+                    continue
+                downloaded += 1
+                logger.info('[DOWNLOAD]Downloaded {}/{}, importing {}'.format(downloaded, total_downloads, archive))
+                pool.apply_async(import_archive, (archive,))
+            if downloading:  # wake up as soon as an archive is downloaded
+                wait(downloading, timeout=settings.GBIF_DOWNLOAD_POLL_INTERVAL, return_when=FIRST_COMPLETED)
+            elif outstanding:
+                logger.debug('[DOWNLOAD]Polling {} downloads, {} pending'.format(len(outstanding), len(pending)))
+                time.sleep(settings.GBIF_DOWNLOAD_POLL_INTERVAL)  # wait before requesting the status again
+        pool.close()
+        pool.join()
+    return downloaded
 
 
 class Command(BaseCommand):
@@ -124,10 +201,19 @@ class Command(BaseCommand):
     - GBIF_USER_EMAIL: email to which GBIF will send a notification email when the download is ready. Specifying the 
         email address here seems mandatory.
     - DOWNLOADS_DIR: the directory to save downloaded darwin-core archive
+    - GBIF_MAX_CONCURRENT_DOWNLOADS: number of downloads requested at GBIF at the same time
+    - GBIF_DATASETS_PER_DOWNLOAD: number of datasets requested in a single download, can be overridden with 
+        --datasets-per-download
     
-    It will then call the other command "python manage.py import_datasets" to import the downloaded datasets.
+    Each archive is imported as soon as it is downloaded. It will then call the other command
+    "python manage.py import_datasets" to import metadata-only datasets and update the imported datasets.
     '''
 
+    def add_arguments(self, parser):
+        parser.add_argument('--datasets-per-download', type=int, default=settings.GBIF_DATASETS_PER_DOWNLOAD,
+                            help='Number of datasets requested in a single GBIF download, 1 to request a download '
+                                 'per dataset')
+
     def handle(self, *args, **options):
         if not os.path.isdir(settings.DOWNLOADS_DIR):
             os.mkdir(settings.DOWNLOADS_DIR)
@@ -136,9 +222,9 @@ class Command(BaseCommand):
         # -----------------
         # DELETED DATASETS
         # -----------------
-        # flag Dataset and HarvestedDataset objects if corresponding uuid is deleted from GBIF
-        for dataset in Dataset.objects.all():
-            dataset.deleted_on_gbif()  # check if dataset is deleted on GBIF
+        # get registry record of every dataset once, flag HarvestedDataset objects if corresponding uuid is deleted
+        # from GBIF and find the datasets which have new version
+        changes = detect_dataset_changes(Dataset.objects.all())
         # delete Dataset that has HarvestedDataset instance include_in_antabif changed to False <- this action can be
         # performed by admin or dataset.deleted_on_gbif() function
         for harvested_dataset in HarvestedDataset.objects.filter(include_in_antabif=False):
@@ -146,12 +232,9 @@ class Command(BaseCommand):
         # -------------------------------
         # GET DATASET UUIDS FOR DOWNLOAD
         # -------------------------------
-        to_download = set()
-        all_datasets = Dataset.objects.exclude(data_type__data_type='Metadata')
-        # check if datasets have new version. If so, get those uuid
-        for dataset in all_datasets:
-            if dataset.has_new_version():
-                to_download.add(dataset.dataset_key)
+        # datasets which have new version, metadata-only datasets are updated by import_datasets
+        to_download = set(Dataset.objects.filter(dataset_key__in=changes[Dataset.MODIFIED])
+                          .exclude(data_type__data_type='Metadata').values_list('dataset_key', flat=True))
         # get the uuid of datasets discovered in harvest cycle that needs to be imported
         update_harvested_dataset_fk()
         # Metadata dataset will be updated/downloaded separately - occurrences.download() does not work for metadata
@@ -160,25 +243,14 @@ class Command(BaseCommand):
             .filter(include_in_antabif=True, dataset__isnull=True, import_full_dataset__isnull=False, recordCount__gt=0)
         for dataset in new_datasets_to_download:
             to_download.add(dataset.key)
-        # ------------------
-        # DOWNLOAD DATASETS
-        # ------------------
-        i = 1
-        for uuid in to_download:
-            logger.info('[DOWNLOAD]Requesting download {}/{} dataset uuid: {}'.format(i, len(to_download), uuid))
-            download_key = get_download_key(uuid)
-            if download_key is not None:
-                logger.debug(download_key)
-                request_download(download_key, i, len(to_download))
-                i += 1
-            else:
-                continue
-            if i % 5 == 0:
-                # import datasets
-                call_command('import_datasets')
-                delete_files_in_directory(settings.DOWNLOADS_DIR)
-        call_command('import_datasets')  # remainder
+        # -----------------------------
+        # DOWNLOAD AND IMPORT DATASETS
+        # -----------------------------
+        # archives are imported while the other downloads are in progress
+        download_and_import(to_download, options['datasets_per_download'])
+        # metadata-only datasets, DataType, Publisher and clean up
+        call_command('import_datasets')
         join_hexgrid_occurrence()  # assign HexGrid to each GBIFOccurrence record.
         count_occurrence_per_hexgrid()  # for home page map
-        cache.clear()
+        bump_epoch()
         return 'Done!'
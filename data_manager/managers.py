@@ -6,8 +6,12 @@ from django.conf import settings
 from django.contrib.gis.db import models
 from django.contrib.gis.geos import GEOSGeometry, Polygon
 from django.contrib.gis.utils import LayerMapping
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.search import SearchVector
 from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned, ValidationError
 from django.core.validators import URLValidator
+from django.db import transaction
+from django.db.models import Count, Exists, OuterRef, Subquery, Sum, TextField
 from django.db.utils import IntegrityError
 from pygbif import registry, occurrences
 from requests.exceptions import HTTPError
@@ -162,6 +166,56 @@ class DatasetManager(models.Manager):
                                                          'tag': []})[0]
         return dataset_object
 
+    def update_search_vector(self, **filters):
+        """
+        Build Dataset.search_vector in a single UPDATE. Weights: title (A), keywords and project title (B), project
+        personnel and publisher (C), abstract (D).
+
+        :param filters: keyword arguments to select the Dataset objects to update, all Dataset objects if empty
+        :return: number of Dataset objects updated
+        """
+        Keyword = apps.get_model(app_label='data_manager', model_name='Keyword')
+        PersonTypeRole = apps.get_model(app_label='data_manager', model_name='PersonTypeRole')
+        Project = apps.get_model(app_label='data_manager', model_name='Project')
+        Publisher = apps.get_model(app_label='data_manager', model_name='Publisher')
+        config = settings.DATASET_SEARCH_CONFIG
+        keywords = Keyword.objects.filter(dataset=OuterRef('pk')).order_by().values('dataset')\
+            .annotate(text=StringAgg('keyword', delimiter=' ')).values('text')
+        personnel = PersonTypeRole.objects.filter(dataset=OuterRef('pk'), person_type='personnel').order_by()\
+            .values('dataset').annotate(text=StringAgg('person__full_name', delimiter=' ')).values('text')
+        project = Project.objects.filter(pk=OuterRef('project_id')).values('title')
+        publisher = Publisher.objects.filter(pk=OuterRef('publisher_id')).values('publisher_name')
+        search_vector = SearchVector('title', weight='A', config=config) + \
+            SearchVector(Subquery(keywords, output_field=TextField()), Subquery(project, output_field=TextField()),
+                         weight='B', config=config) + \
+            SearchVector(Subquery(personnel, output_field=TextField()), Subquery(publisher, output_field=TextField()),
+                         weight='C', config=config) + \
+            SearchVector('abstract', weight='D', config=config)
+        return self.filter(**filters).update(search_vector=search_vector)
+
+    def update_detail(self, **filters):
+        """
+        Rebuild Dataset.detail, the document displayed on the dataset page. Run when the EML of a dataset is imported.
+
+        :param filters: keyword arguments to select the Dataset objects to update, all Dataset objects if empty
+        :return: number of Dataset objects updated
+        """
+        count = 0
+        for dataset in self.filter(**filters):
+            count += self.filter(pk=dataset.pk).update(detail=dataset.build_detail())
+        return count
+
+    def update_has_grid(self, **filters):
+        """
+        Set Dataset.has_grid in a single UPDATE. Run after the occurrences are assigned to HexGrid.
+
+        :param filters: keyword arguments to select the Dataset objects to update, all Dataset objects if empty
+        :return: number of Dataset objects updated
+        """
+        HexGrid = apps.get_model(app_label='data_manager', model_name='HexGrid')
+        grids = HexGrid.objects.filter(GBIFOccurrence__dataset_id=OuterRef('pk'))
+        return self.filter(**filters).update(has_grid=Exists(grids))
+
 
 class ProjectManager(models.Manager):
     """ Manage Project object """
@@ -350,7 +404,11 @@ class GBIFOccurrenceManager(DarwinCoreManager):
         occ_row_dict['basis_of_record'] = BasisOfRecord.objects.create_from_row(interpreted_data=interpreted_data)
         occ_row_dict['dataset'] = dataset_object
         occ_row_dict['dataset_title'] = dataset_object.title
-        return self.model(**occ_row_dict)
+        occ_object = self.model(**occ_row_dict)
+        # bulk_create() does not call save()
+        occ_object.search_document = occ_object.build_search_document()
+        occ_object.taxon_ancestry = occ_object.build_taxon_ancestry()
+        return occ_object
 
 
 class GBIFVerbatimOccurrenceManager(DarwinCoreManager):
@@ -512,3 +570,63 @@ class HarvestedDatasetManager(models.Manager):
                 except IntegrityError:  # other process can insert the record into database already
                     pass
         return
+
+
+class StatisticsManager(models.Manager):
+
+    def compute(self):
+        """
+        Compute a snapshot of the content of the database, at the end of import_datasets
+        :return: Statistics object
+        """
+        DataType = apps.get_model(app_label='data_manager', model_name='DataType')
+        Dataset = apps.get_model(app_label='data_manager', model_name='Dataset')
+        GBIFOccurrence = apps.get_model(app_label='data_manager', model_name='GBIFOccurrence')
+        Publisher = apps.get_model(app_label='data_manager', model_name='Publisher')
+        datasets_per_data_type = dict(
+            DataType.objects.annotate(num_datasets=Count('dataset')).values_list('data_type', 'num_datasets'))
+        statistics = self.create(
+            dataset_count=Dataset.objects.count(),
+            datasets_per_data_type=datasets_per_data_type,
+            occurrence_count=Dataset.objects.aggregate(count=Sum('filtered_record_count'))['count'] or 0,
+            species_count=GBIFOccurrence.objects.exclude(speciesKey__isnull=True).exclude(speciesKey='')
+            .values('speciesKey').distinct().count(),
+            publisher_count=Publisher.objects.count())
+        logger.info('[STATISTICS]{} datasets, {} occurrences'.format(statistics.dataset_count,
+                                                                      statistics.occurrence_count))
+        return statistics
+
+    def current(self):
+        """
+        Return the latest snapshot, compute one if there is none
+        :return: Statistics object
+        """
+        try:
+            return self.latest()
+        except self.model.DoesNotExist:
+            return self.compute()
+
+
+class OccurrenceCubeManager(models.Manager):
+
+    def rebuild(self, dataset_ids=None):
+        """
+        Count the occurrences of datasets per year, month, basis of record and species again, after their occurrences
+        were imported
+        :param dataset_ids: an iterable of Dataset ids, None to rebuild all datasets
+        :return: number of OccurrenceCube objects created
+        """
+        GBIFOccurrence = apps.get_model(app_label='data_manager', model_name='GBIFOccurrence')
+        cubes = self.all()
+        occurrences = GBIFOccurrence.objects.filter(dataset__isnull=False)
+        if dataset_ids is not None:
+            dataset_ids = list(dataset_ids)
+            cubes = cubes.filter(dataset_id__in=dataset_ids)
+            occurrences = occurrences.filter(dataset_id__in=dataset_ids)
+        rows = occurrences.order_by().values('dataset_id', 'year', 'month', 'basis_of_record_id', 'speciesKey') \
+            .annotate(occurrence_count=Count('id'))
+        with transaction.atomic():
+            cubes.delete()
+            created = self.bulk_create((self.model(**row) for row in rows.iterator()), batch_size=5000)
+        logger.info('[CUBE]Datasets: {}, rows: {}'.format('all' if dataset_ids is None else dataset_ids, len(created)))
+        return len(created)
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.20 on 2026-10-19 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_manager', '0105_auto_20200904_0512'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='harvesteddataset',
+            name='payload_hash',
+            field=models.CharField(blank=True, help_text='SHA-256 of the occurrence payload of the last imported archive', max_length=64, null=True),
+        ),
+    ]
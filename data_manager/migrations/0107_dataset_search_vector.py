@@ -0,0 +1,42 @@
+# Generated by Django 2.2.20 on 2026-10-19 10:05
+
+import django.contrib.postgres.search
+from django.conf import settings
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_manager', '0106_harvesteddataset_payload_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dataset',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(blank=True, editable=False, help_text='Weighted full text search document of title, keywords, project, personnel, publisher and abstract', null=True),
+        ),
+        migrations.RunSQL("DROP INDEX IF EXISTS dataset_search_vector_gin_idx;"),
+        migrations.RunSQL("CREATE INDEX dataset_search_vector_gin_idx ON data_manager_dataset USING GIN (search_vector);",
+                          reverse_sql="DROP INDEX IF EXISTS dataset_search_vector_gin_idx;"),
+        # build the search vector of existing datasets, same as DatasetManager.update_search_vector() with the text
+        # search configuration settings.DATASET_SEARCH_CONFIG
+        migrations.RunSQL(
+            [("""
+            UPDATE data_manager_dataset d SET search_vector =
+                setweight(to_tsvector(%s, COALESCE(d.title, '')), 'A') ||
+                setweight(to_tsvector(%s, COALESCE(
+                    (SELECT string_agg(k.keyword, ' ') FROM data_manager_keyword k
+                     JOIN data_manager_keyword_dataset kd ON kd.keyword_id = k.id WHERE kd.dataset_id = d.id), '') ||
+                    ' ' || COALESCE((SELECT p.title FROM data_manager_project p WHERE p.id = d.project_id), '')), 'B') ||
+                setweight(to_tsvector(%s, COALESCE(
+                    (SELECT string_agg(pe.full_name, ' ') FROM data_manager_persontyperole r
+                     JOIN data_manager_person pe ON pe.id = r.person_id
+                     WHERE r.dataset_id = d.id AND r.person_type = 'personnel'), '') ||
+                    ' ' || COALESCE((SELECT pu.publisher_name FROM data_manager_publisher pu
+                                     WHERE pu.id = d.publisher_id), '')), 'C') ||
+                setweight(to_tsvector(%s, COALESCE(d.abstract, '')), 'D');
+            """, [settings.DATASET_SEARCH_CONFIG] * 4)],
+            reverse_sql=migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 2.2.20 on 2026-10-19 11:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_manager', '0107_dataset_search_vector'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gbifoccurrence',
+            name='search_document',
+            field=models.TextField(blank=True, editable=False, null=True),
+        ),
+        # same as GBIFOccurrence.build_search_document()
+        migrations.RunSQL(
+            """
+            UPDATE data_manager_gbifoccurrence SET search_document = lower(concat_ws(' ',
+                "scientificName", "kingdom", "phylum", "_class", "order", "family", "genus", "locality", "country",
+                "waterBody", "institutionCode", "collectionCode", "catalogNumber", "recordedBy", "basisOfRecord",
+                "samplingProtocol", "occurrenceID", "eventID", "dataset_title"));
+            """,
+            reverse_sql=migrations.RunSQL.noop),
+        # q: LIKE '%term%' on the lower case search document, replaces the index on UPPER(row_json_text)
+        migrations.RunSQL("DROP INDEX IF EXISTS occurrence_trgm_upper_gin_idx;",
+                          reverse_sql="CREATE INDEX occurrence_trgm_upper_gin_idx ON data_manager_gbifoccurrence USING GIN ((UPPER(row_json_text)) gin_trgm_ops);"),
+        migrations.RunSQL("CREATE INDEX occurrence_search_document_trgm_idx ON data_manager_gbifoccurrence USING GIN (search_document gin_trgm_ops);",
+                          reverse_sql="DROP INDEX IF EXISTS occurrence_search_document_trgm_idx;"),
+        # indexes of 0098 are built on string literals (e.g. UPPER('locality')) instead of the columns, the planner
+        # never uses them. icontains and iexact lookups are UPPER("column") LIKE/= UPPER(%s). The reverse recreates
+        # the indexes of 0098 as they were
+        migrations.RunSQL("DROP INDEX IF EXISTS upper_occurrence_status_idx, upper_sampling_protocol_idx, upper_locality_idx, upper_scientific_name_idx;",
+                          reverse_sql=[
+                              "CREATE INDEX upper_occurrence_status_idx on data_manager_gbifoccurrence ((UPPER('occurrenceStatus')));",
+                              "CREATE INDEX upper_sampling_protocol_idx on data_manager_gbifoccurrence USING GIN (UPPER('samplingProtocol') gin_trgm_ops);",
+                              "CREATE INDEX upper_locality_idx on data_manager_gbifoccurrence USING GIN (UPPER('locality') gin_trgm_ops);",
+                              "CREATE INDEX upper_scientific_name_idx on data_manager_gbifoccurrence USING GIN (UPPER('scientificName') gin_trgm_ops);",
+                          ]),
+        migrations.RunSQL("CREATE INDEX upper_occurrence_status_idx ON data_manager_gbifoccurrence ((UPPER(\"occurrenceStatus\")));",
+                          reverse_sql="DROP INDEX IF EXISTS upper_occurrence_status_idx;"),
+        migrations.RunSQL("CREATE INDEX upper_sampling_protocol_idx ON data_manager_gbifoccurrence USING GIN ((UPPER(\"samplingProtocol\")) gin_trgm_ops);",
+                          reverse_sql="DROP INDEX IF EXISTS upper_sampling_protocol_idx;"),
+        migrations.RunSQL("CREATE INDEX upper_locality_idx ON data_manager_gbifoccurrence USING GIN ((UPPER(\"locality\")) gin_trgm_ops);",
+                          reverse_sql="DROP INDEX IF EXISTS upper_locality_idx;"),
+        migrations.RunSQL("CREATE INDEX upper_scientific_name_idx ON data_manager_gbifoccurrence USING GIN ((UPPER(\"scientificName\")) gin_trgm_ops);",
+                          reverse_sql="DROP INDEX IF EXISTS upper_scientific_name_idx;"),
+    ]
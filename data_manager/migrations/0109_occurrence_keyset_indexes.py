@@ -0,0 +1,21 @@
+# Generated by Django 2.2.20 on 2026-10-19 09:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_manager', '0108_gbifoccurrence_search_document'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='gbifoccurrence',
+            index=models.Index(fields=['year', 'id'], name='occurrence_year_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='gbifoccurrence',
+            index=models.Index(fields=['scientificName', 'id'], name='occurrence_sciname_id_idx'),
+        ),
+    ]
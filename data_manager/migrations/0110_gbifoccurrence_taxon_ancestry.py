@@ -0,0 +1,37 @@
+# Generated by Django 2.2.20 on 2026-10-19 13:05
+
+import django.contrib.postgres.fields
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_manager', '0109_occurrence_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gbifoccurrence',
+            name='taxon_ancestry',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), blank=True, editable=False, null=True, size=None),
+        ),
+        # same as GBIFOccurrence.build_taxon_ancestry()
+        migrations.RunSQL(
+            """
+            UPDATE data_manager_gbifoccurrence SET taxon_ancestry = ARRAY(
+                SELECT trim(value)::integer
+                FROM unnest(ARRAY["kingdomKey", "phylumKey", "classKey", "orderKey", "familyKey", "genusKey",
+                                  "subgenusKey", "speciesKey", "taxonKey"]) WITH ORDINALITY AS keys(value, position)
+                WHERE trim(value) ~ '^[0-9]+$'
+                GROUP BY trim(value)::integer
+                ORDER BY min(position)
+            );
+            """,
+            reverse_sql=migrations.RunSQL.noop),
+        migrations.AddIndex(
+            model_name='gbifoccurrence',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['taxon_ancestry'], name='occurrence_taxon_ancestry_idx'),
+        ),
+    ]
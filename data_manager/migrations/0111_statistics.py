@@ -0,0 +1,30 @@
+# Generated by Django 2.2.20 on 2026-10-19 14:30
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_manager', '0110_gbifoccurrence_taxon_ancestry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Statistics',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dataset_count', models.IntegerField(default=0)),
+                ('datasets_per_data_type', django.contrib.postgres.fields.jsonb.JSONField(default=dict, help_text='the number of datasets per DataType.data_type')),
+                ('occurrence_count', models.BigIntegerField(default=0, help_text='the sum of Dataset.filtered_record_count')),
+                ('species_count', models.IntegerField(default=0, help_text='the number of distinct speciesKey of GBIFOccurrence')),
+                ('publisher_count', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                'verbose_name_plural': 'statistics',
+                'get_latest_by': 'created_at',
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 2.2.20 on 2026-10-19 15:10
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_manager', '0111_statistics'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dataset',
+            name='detail',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, editable=False, help_text='contacts, keywords and contributors displayed on the dataset page, built by build_detail() when the EML is imported', null=True),
+        ),
+        migrations.AddField(
+            model_name='dataset',
+            name='has_grid',
+            field=models.BooleanField(default=False, editable=False, help_text='True if occurrences of this dataset are assigned to HexGrid'),
+        ),
+        # detail is built on the first view of the dataset page, has_grid is backfilled here
+        migrations.RunSQL(
+            sql='UPDATE data_manager_dataset SET has_grid = EXISTS ('
+                'SELECT 1 FROM data_manager_gbifoccurrence o '
+                'JOIN data_manager_gbifoccurrence_hexgrid h ON h.gbifoccurrence_id = o.id '
+                'WHERE o.dataset_id = data_manager_dataset.id)',
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 2.2.20 on 2026-10-19 16:40
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_manager', '0112_dataset_detail'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='download',
+            name='fields',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.TextField(), blank=True, help_text='columns of the download file, all OCCURRENCE_FIELDS if empty', null=True, size=None),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 2.2.20 on 2026-10-19 17:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_manager', '0113_download_fields'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OccurrenceCube',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.PositiveSmallIntegerField(blank=True, null=True)),
+                ('month', models.PositiveSmallIntegerField(blank=True, null=True)),
+                ('speciesKey', models.TextField(blank=True, null=True)),
+                ('occurrence_count', models.IntegerField(default=0)),
+                ('basis_of_record', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='OccurrenceCube', to='data_manager.BasisOfRecord')),
+                ('dataset', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='OccurrenceCube', to='data_manager.Dataset')),
+            ],
+        ),
+        # count the occurrences imported before, see OccurrenceCubeManager.rebuild()
+        migrations.RunSQL(
+            sql='INSERT INTO data_manager_occurrencecube '
+                '(dataset_id, year, month, basis_of_record_id, "speciesKey", occurrence_count) '
+                'SELECT dataset_id, year, month, basis_of_record_id, "speciesKey", COUNT(id) '
+                'FROM data_manager_gbifoccurrence WHERE dataset_id IS NOT NULL '
+                'GROUP BY dataset_id, year, month, basis_of_record_id, "speciesKey"',
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -8,7 +8,8 @@ import uuid
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.gis.db import models
-from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.fields import ArrayField, JSONField
+from django.contrib.postgres.indexes import GinIndex
 from django.contrib.postgres.search import SearchVectorField
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.http import QueryDict
@@ -17,9 +18,10 @@ from django.utils import timezone
 from django.utils.dateparse import parse_datetime
 from time import strftime
 
+from data_manager.generations import bump_dataset_generations
 from data_manager.managers import PublisherManager, DatasetManager, ProjectManager, KeywordManager, \
     GBIFOccurrenceManager, GBIFVerbatimOccurrenceManager, HexGridManager, DataTypeManager, HarvestedDatasetManager, \
-    BasisOfRecordManager
+    BasisOfRecordManager, StatisticsManager, OccurrenceCubeManager
 from django_celery_results.models import TaskResult
 from pygbif import registry, occurrences
 
@@ -83,6 +85,8 @@ class HarvestedDataset(models.Model):
                                 help_text='The Dataset instance associated with the HarvestedDataset instance')
     harvested_on = models.DateTimeField(auto_now_add=True, null=True, blank=True,
                                         help_text='The date time when the HarvestedDataset instance is first created')
+    payload_hash = models.CharField(max_length=64, null=True, blank=True,
+                                    help_text='SHA-256 of the occurrence payload of the last imported archive')
     objects = HarvestedDatasetManager()
 
     def __str__(self):
@@ -91,8 +95,10 @@ class HarvestedDataset(models.Model):
     def delete_related_objects(self):
         """Delete all objects related to this HarvestedDataset except the HarvestedDataset instance"""
         if self.dataset:
+            dataset_id = self.dataset.pk
             delete_by_batch(GBIFOccurrence.objects.filter(dataset=self.dataset))
             Dataset.objects.filter(dataset_key=self.key).delete()
+            bump_dataset_generations([dataset_id])
         return
 
 
@@ -260,8 +266,21 @@ class Dataset(models.Model):
                                                     help_text='the percentage of records associated with this dataset '
                                                               'imported into the database, derived using '
                                                               'filtered_record_count/full_record_count*100')
+    search_vector = SearchVectorField(null=True, blank=True, editable=False,
+                                      help_text='Weighted full text search document of title, keywords, project, '
+                                                'personnel, publisher and abstract')
+    detail = JSONField(null=True, blank=True, editable=False,
+                       help_text='contacts, keywords and contributors displayed on the dataset page, built by '
+                                 'build_detail() when the EML is imported')
+    has_grid = models.BooleanField(default=False, editable=False,
+                                   help_text='True if occurrences of this dataset are assigned to HexGrid')
     objects = DatasetManager()
 
+    # status of a Dataset compared to its record in GBIF registry
+    DELETED = 'deleted'
+    MODIFIED = 'modified'
+    UNCHANGED = 'unchanged'
+
     class Meta:
         ordering = ['-filtered_record_count']
 
@@ -271,6 +290,35 @@ class Dataset(models.Model):
     def get_keywords(self):
         return ', '.join([x.keyword for x in self.keyword_set.all()])
 
+    def build_detail(self):
+        """
+        Build the detail document of the dataset page from its PersonTypeRole and Keyword objects.
+        Contributors are ordered by number of roles, as in the EML.
+        :return: a dictionary with keys contacts, keywords and contributors
+        """
+        contacts = []
+        contributors = dict()
+        for person_type_role in self.personTypeRole.select_related('person').order_by('person__full_name', 'id'):
+            person = person_type_role.person
+            if person is None:
+                continue
+            if person_type_role.person_type == 'contact' and {'full_name': person.full_name} not in contacts:
+                contacts.append({'full_name': person.full_name})
+            contributor = contributors.setdefault(person.id, {
+                'full_name': person.full_name, 'email': person.email, 'roles': [], 'organizations': []})
+            contributor['roles'].append({'person_type': person_type_role.person_type, 'role': person_type_role.role})
+            organization = person_type_role.organization
+            if organization and organization not in contributor['organizations']:
+                contributor['organizations'].append(organization)
+        keywords = dict()
+        for keyword in self.keyword_set.order_by('id'):
+            keywords.setdefault(keyword.thesaurus or '', []).append(keyword.keyword)
+        return {
+            'contacts': contacts,
+            'keywords': keywords,
+            'contributors': sorted(contributors.values(), key=lambda c: -len(c['roles'])),
+        }
+
     def count_occurrence_per_dataset(self):
         """
         Update the count for GBIFOccurrence associated with this dataset.
@@ -289,21 +337,34 @@ class Dataset(models.Model):
         self.save()
         return
 
-    def has_new_version(self):
+    def compare_with_registry(self, registry_record):
         """
-        Check if Dataset is modified on GBIF.
-        :return: Union [bool, str]
+        Compare Dataset with its record in GBIF registry. No request is sent to GBIF.
+        :param registry_record: a dict, response of pygbif.registry.datasets(uuid=self.dataset_key)
+        :return: (str) Dataset.DELETED, Dataset.MODIFIED or Dataset.UNCHANGED
         """
-        response = registry.datasets(uuid=self.dataset_key)
-        modified_timestamp = response.get('modified', None)  # dataset does not necessarily has timestamp
-        if self.deleted_on_gbif():
-            return False
+        if registry_record.get('deleted', False):
+            return self.DELETED
+        modified_timestamp = registry_record.get('modified', None)  # dataset does not necessarily has timestamp
         if modified_timestamp:
             modified_on = parse_datetime(modified_timestamp)
             modified_datetime = modified_on.replace(tzinfo=None)
-            if modified_datetime > self.download_on:  # raise TypeError if dataset.download_on is None
-                return True
-        return False  # not deleted, no modified timestamp
+            if self.download_on is None or modified_datetime > self.download_on:
+                return self.MODIFIED
+        return self.UNCHANGED
+
+    def has_new_version(self):
+        """
+        Check if Dataset is modified on GBIF.
+        Flag HarvestedDataset deleted_from_gbif=True and include_in_antabif=False if Dataset is deleted on GBIF.
+        :return: (Boolean) True if dataset is modified on GBIF, False if it is deleted or not modified.
+        """
+        uuid.UUID(self.dataset_key)  # raise ValueError if dataset_key is not a proper UUID
+        response = registry.datasets(uuid=self.dataset_key, timeout=settings.GBIF_API_TIMEOUT)
+        status = self.compare_with_registry(response)
+        if status == self.DELETED:
+            self.harvesteddataset_set.update(deleted_from_gbif=True, include_in_antabif=False)
+        return status == self.MODIFIED
 
     def deleted_on_gbif(self):
         """
@@ -314,9 +375,8 @@ class Dataset(models.Model):
         # ensure that self.dataset_key is a valid uuid, because if dataset_key is None, response will return all
         # datasets
         uuid.UUID(self.dataset_key)  # raise ValueError if dataset_key is not a proper UUID
-        response = registry.datasets(uuid=self.dataset_key)
-        deleted = response.get('deleted', False)
-        if deleted:
+        response = registry.datasets(uuid=self.dataset_key, timeout=settings.GBIF_API_TIMEOUT)
+        if self.compare_with_registry(response) == self.DELETED:
             self.harvesteddataset_set.update(deleted_from_gbif=True, include_in_antabif=False)
             return True
         else:
@@ -622,12 +682,60 @@ class GBIFOccurrence(DarwinCoreOccurrence):
     hexgrid = models.ManyToManyField(HexGrid, related_name="GBIFOccurrence")
     # add dataset title here, faster performance
     dataset_title = models.TextField(blank=True, null=True)
+    # lower case text of SEARCH_DOCUMENT_FIELDS for partial match search, indexed with gin_trgm_ops
+    search_document = models.TextField(blank=True, null=True, editable=False)
+    # GBIF keys of the taxon and all its higher taxa (TAXON_ANCESTRY_FIELDS), "any record under taxon X" is
+    # taxon_ancestry @> ARRAY[X], indexed with GIN
+    taxon_ancestry = ArrayField(models.IntegerField(), blank=True, null=True, editable=False)
     # manager
     objects = GBIFOccurrenceManager()
 
+    # fields of search_document, same order as in migration 0108_gbifoccurrence_search_document
+    SEARCH_DOCUMENT_FIELDS = ['scientificName', 'kingdom', 'phylum', '_class', 'order', 'family', 'genus', 'locality',
+                              'country', 'waterBody', 'institutionCode', 'collectionCode', 'catalogNumber',
+                              'recordedBy', 'basisOfRecord', 'samplingProtocol', 'occurrenceID', 'eventID',
+                              'dataset_title']
+
+    class Meta:
+        # keyset pagination on (sort field, id), see OCCURRENCE_SORT_FIELDS in data_manager.pagination
+        indexes = [
+            models.Index(fields=['year', 'id'], name='occurrence_year_id_idx'),
+            models.Index(fields=['scientificName', 'id'], name='occurrence_sciname_id_idx'),
+            GinIndex(fields=['taxon_ancestry'], name='occurrence_taxon_ancestry_idx'),
+        ]
+
+    # fields of taxon_ancestry, same order as in migration 0110_gbifoccurrence_taxon_ancestry
+    TAXON_ANCESTRY_FIELDS = ['kingdomKey', 'phylumKey', 'classKey', 'orderKey', 'familyKey', 'genusKey',
+                             'subgenusKey', 'speciesKey', 'taxonKey']
+
+    def build_taxon_ancestry(self):
+        """
+        Build taxon_ancestry from the GBIF keys of the taxon and its higher taxa, keys that are not integers are skipped
+        :return: list of unique integers, in the order of TAXON_ANCESTRY_FIELDS
+        """
+        ancestry = []
+        for field in self.TAXON_ANCESTRY_FIELDS:
+            value = str(getattr(self, field) or '').strip()
+            if value.isdigit() and int(value) not in ancestry:
+                ancestry.append(int(value))
+        return ancestry
+
     def __str__(self):
         return '{}--{}'.format(self.scientificName, self.gbifID)
 
+    def save(self, *args, **kwargs):
+        self.search_document = self.build_search_document()
+        self.taxon_ancestry = self.build_taxon_ancestry()
+        super(GBIFOccurrence, self).save(*args, **kwargs)
+
+    def build_search_document(self):
+        """
+        Build search_document, equivalent to lower(concat_ws(' ', <SEARCH_DOCUMENT_FIELDS>)) in PostgreSQL
+        :return: lower case string
+        """
+        values = [getattr(self, field) for field in self.SEARCH_DOCUMENT_FIELDS]
+        return ' '.join(str(value) for value in values if value is not None).lower()
+
     def human_readable_basis_of_record(self):
         if self.basisOfRecord:
             return self.basisOfRecord.replace('_', ' ').lower()
@@ -702,6 +810,45 @@ class GBIFVerbatimOccurrence(DarwinCoreOccurrence):
         return self.gbifID
 
 
+class Statistics(models.Model):
+    """
+    Snapshot of the content of the database, computed at the end of import_datasets. Served by the home page and
+    db-statistics without aggregate queries.
+    """
+    dataset_count = models.IntegerField(default=0)
+    datasets_per_data_type = JSONField(default=dict, help_text='the number of datasets per DataType.data_type')
+    occurrence_count = models.BigIntegerField(default=0, help_text='the sum of Dataset.filtered_record_count')
+    species_count = models.IntegerField(default=0, help_text='the number of distinct speciesKey of GBIFOccurrence')
+    publisher_count = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)  # last update of the database
+    objects = StatisticsManager()
+
+    class Meta:
+        get_latest_by = 'created_at'
+        verbose_name_plural = 'statistics'
+
+    def __str__(self):
+        return '{}'.format(self.created_at)
+
+
+class OccurrenceCube(models.Model):
+    """
+    Number of occurrences per dataset, year, month, basis of record and species, rebuilt when a dataset is imported.
+    Serves the occurrence aggregation API without scanning GBIFOccurrence when a query only uses these dimensions.
+    """
+    dataset = models.ForeignKey(Dataset, related_name='OccurrenceCube', on_delete=models.CASCADE)
+    year = models.PositiveSmallIntegerField(blank=True, null=True)
+    month = models.PositiveSmallIntegerField(blank=True, null=True)
+    basis_of_record = models.ForeignKey(BasisOfRecord, related_name='OccurrenceCube', null=True,
+                                        on_delete=models.SET_NULL)
+    speciesKey = models.TextField(blank=True, null=True)
+    occurrence_count = models.IntegerField(default=0)
+    objects = OccurrenceCubeManager()
+
+    def __str__(self):
+        return '{} {}-{} {}: {}'.format(self.dataset_id, self.year, self.month, self.speciesKey, self.occurrence_count)
+
+
 class Download(models.Model):
     """
     A Download based on a query from a User
@@ -721,6 +868,8 @@ class Download(models.Model):
     dataset = models.ManyToManyField('Dataset', related_name='Download', blank=True)
     query = models.TextField(blank=True, null=True)
     record_count = models.IntegerField(null=True, blank=True)  # number of occurrence records
+    fields = ArrayField(models.TextField(), blank=True, null=True,
+                        help_text='columns of the download file, all OCCURRENCE_FIELDS if empty')
 
     class Meta:
         ordering = ['-created_at']
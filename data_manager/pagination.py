@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+from data_manager.helpers import get_occurrence_count
+from django.db.models import Q
+from rest_framework.compat import coreapi, coreschema
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, _positive_int
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+import binascii
+import json
+
+# key = value of sort parameter, value = GBIFOccurrence field. Each field is backed by an index on (field, id)
+OCCURRENCE_SORT_FIELDS = {
+    'id': 'id',
+    'year': 'year',
+    'scientific_name': 'scientificName',
+}
+
+
+class InvalidCursor(Exception):
+    """Exception to raise when a cursor cannot be decoded or was created for another sort order"""
+    pass
+
+
+def encode_cursor(sort, value, pk, reverse):
+    """
+    Encode the position of a row in a keyset pagination
+    :param sort: sort parameter, e.g. '-year'
+    :param value: value of the sort field of the row
+    :param pk: id of the row
+    :param reverse: True if the cursor points to the page before the row, False if it points to the page after the row
+    :return: url safe string
+    """
+    return urlsafe_b64encode(json.dumps([sort, value, pk, reverse]).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, sort):
+    """
+    Decode a cursor created by encode_cursor()
+    :param cursor: url safe string
+    :param sort: sort parameter of the request, must be the sort parameter of the cursor
+    :return: a tuple of value of the sort field, id and reverse flag
+    """
+    try:
+        cursor_sort, value, pk, reverse = json.loads(urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (binascii.Error, UnicodeError, ValueError, TypeError):
+        raise InvalidCursor(cursor)
+    if cursor_sort != sort or not isinstance(pk, int) or not isinstance(reverse, bool):
+        raise InvalidCursor(cursor)
+    return value, pk, reverse
+
+
+def after_position(field, descending, value, pk):
+    """
+    Return a Q object that selects the rows after (value, pk) when ordered by (field, id).
+    As in PostgreSQL, NULL sorts last in ascending order and first in descending order.
+    :param field: sort field
+    :param descending: True if rows are ordered by descending (field, id)
+    :param value: value of the sort field of the last row of the previous page
+    :param pk: id of the last row of the previous page
+    :return: Q object
+    """
+    lookup = 'lt' if descending else 'gt'
+    id_q = Q(**{'id__{}'.format(lookup): pk})
+    if field == 'id':
+        return id_q
+    if value is None:
+        q = Q(**{'{}__isnull'.format(field): True}) & id_q
+        return q | Q(**{'{}__isnull'.format(field): False}) if descending else q
+    q = Q(**{'{}__{}'.format(field, lookup): value}) | (Q(**{field: value}) & id_q)
+    return q if descending else q | Q(**{'{}__isnull'.format(field): True})
+
+
+def row_value(row, field):
+    """
+    Return the value of a field of a row
+    :param row: model instance or dictionary returned by QuerySet.values()
+    :param field: field name
+    :return: value
+    """
+    return row[field] if isinstance(row, dict) else getattr(row, field)
+
+
+def keyset_page(queryset, sort, cursor=None, page_size=api_settings.PAGE_SIZE, sort_fields=None):
+    """
+    Return a page of queryset ordered by (sort field, id) with keyset pagination. The page is fetched with a single
+    query of page_size + 1 rows that starts from the position in the cursor, so its cost does not depend on how deep
+    the page is.
+    :param queryset: QuerySet object, or QuerySet.values() that selects the sort field and id
+    :param sort: key of sort_fields, prefixed with '-' for descending order
+    :param cursor: cursor returned with the previous or next page, None for the first page
+    :param page_size: number of rows per page
+    :param sort_fields: a dictionary with key = sort parameter, value = field name, default to OCCURRENCE_SORT_FIELDS
+    :return: a tuple of list of rows, cursor of the next page and cursor of the previous page (None if no such page)
+    """
+    sort_fields = sort_fields or OCCURRENCE_SORT_FIELDS
+    field = sort_fields[sort.lstrip('-')]
+    descending = sort.startswith('-')
+    position, reverse = None, False
+    if cursor:
+        value, pk, reverse = decode_cursor(cursor, sort)
+        position = (value, pk)
+    # previous page is fetched in the opposite order then reversed
+    backward = descending != reverse
+    order_by = ['id'] if field == 'id' else [field, 'id']
+    if backward:
+        order_by = ['-{}'.format(f) for f in order_by]
+    if position:
+        queryset = queryset.filter(after_position(field, backward, *position))
+    rows = list(queryset.order_by(*order_by)[:page_size + 1])
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if reverse:
+        rows.reverse()
+    has_next = position is not None if reverse else has_more
+    has_previous = has_more if reverse else position is not None
+    next_cursor, previous_cursor = None, None
+    if rows and has_next:
+        next_cursor = encode_cursor(sort, row_value(rows[-1], field), row_value(rows[-1], 'id'), False)
+    if rows and has_previous:
+        previous_cursor = encode_cursor(sort, row_value(rows[0], field), row_value(rows[0], 'id'), True)
+    return rows, next_cursor, previous_cursor
+
+
+class KeysetPagination(BasePagination):
+    """
+    Keyset (cursor) pagination on (sort field, id). Unlike LimitOffsetPagination, it does not count the rows and does
+    not skip the rows of the previous pages, so every page costs the same.
+    e.g. ?sort=-year&limit=50, then follow the `next` and `previous` links.
+    """
+    cursor_query_param = 'cursor'
+    cursor_query_description = 'The pagination cursor value.'
+    sort_query_param = 'sort'
+    sort_query_description = 'Sort order, one of {}. Prefix with "-" for descending order.'
+    page_size_query_param = 'limit'
+    page_size_query_description = 'Number of results to return per page.'
+    page_size = api_settings.PAGE_SIZE
+    max_page_size = 1000
+    sort_fields = OCCURRENCE_SORT_FIELDS
+    default_sort = 'id'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.base_url = request.build_absolute_uri()
+        self.sort = self.get_sort(request)
+        try:
+            page, self.next_cursor, self.previous_cursor = keyset_page(
+                queryset, self.sort, request.query_params.get(self.cursor_query_param),
+                self.get_page_size(request), self.sort_fields)
+        except InvalidCursor:
+            raise NotFound(self.invalid_cursor_message)
+        return page
+
+    def get_sort(self, request):
+        """Return the sort parameter of the request, default_sort if it is not a key of sort_fields"""
+        sort = request.query_params.get(self.sort_query_param, self.default_sort)
+        return sort if sort.lstrip('-') in self.sort_fields else self.default_sort
+
+    def get_page_size(self, request):
+        try:
+            return _positive_int(request.query_params[self.page_size_query_param], strict=True,
+                                 cutoff=self.max_page_size)
+        except (KeyError, ValueError):
+            return self.page_size
+
+    def get_link(self, cursor):
+        if cursor is None:
+            return None
+        return replace_query_param(self.base_url, self.cursor_query_param, cursor)
+
+    def get_next_link(self):
+        return self.get_link(self.next_cursor)
+
+    def get_previous_link(self):
+        return self.get_link(self.previous_cursor)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data)
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {'type': 'string', 'nullable': True},
+                'previous': {'type': 'string', 'nullable': True},
+                'results': schema,
+            },
+        }
+
+    def get_schema_fields(self, view):
+        assert coreapi is not None, 'coreapi must be installed to use `get_schema_fields()`'
+        assert coreschema is not None, 'coreschema must be installed to use `get_schema_fields()`'
+        return [
+            coreapi.Field(name=self.cursor_query_param, required=False, location='query',
+                          schema=coreschema.String(title='Cursor', description=self.cursor_query_description)),
+            coreapi.Field(name=self.sort_query_param, required=False, location='query',
+                          schema=coreschema.String(title='Sort', description=self.sort_query_description.format(
+                              ', '.join(sorted(self.sort_fields))))),
+            coreapi.Field(name=self.page_size_query_param, required=False, location='query',
+                          schema=coreschema.Integer(title='Limit', description=self.page_size_query_description)),
+        ]
+
+
+class OccurrencePagination(KeysetPagination):
+    """
+    KeysetPagination of GBIFOccurrence filtered by OccurrenceFilter, with the count of the search. Large counts are
+    estimated, see get_occurrence_count().
+    """
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.count, self.count_estimated = get_occurrence_count(queryset, request.query_params, 'filter')
+        return super(OccurrencePagination, self).paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('count', self.count),
+            ('count_estimated', self.count_estimated),
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data)
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        response_schema = super(OccurrencePagination, self).get_paginated_response_schema(schema)
+        response_schema['properties'].update({'count': {'type': 'integer'}, 'count_estimated': {'type': 'boolean'}})
+        return response_schema
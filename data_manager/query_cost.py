@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+from contextlib import contextmanager
+from data_manager.helpers import OCCURRENCE_COUNT_IGNORED_PARAMS, explain_queryset, occurrence_search_datasets
+from django.conf import settings
+from django.db import connection
+from django.db.utils import OperationalError
+from functools import wraps
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from rest_framework.views import exception_handler
+import logging
+import psycopg2
+
+
+logger = logging.getLogger('data_manager')
+
+
+class QueryTooExpensive(APIException):
+    """
+    The occurrence search of a request is over the budget of the user, see OCCURRENCE_QUERY_BUDGET
+    """
+    status_code = status.HTTP_400_BAD_REQUEST
+    default_detail = 'This search is too expensive. Narrow it with more selective filters (dataset, taxon, a smaller ' \
+                     'area or period), or request a download of its occurrences.'
+    default_code = 'query_too_expensive'
+
+    def __init__(self, detail=None, code=None, **extra):
+        """
+        :param detail: message of the error
+        :param code: code of the error
+        :param extra: other keys of the error response, e.g. cost, returned as they are. None values are omitted
+        """
+        super(QueryTooExpensive, self).__init__(detail, code)
+        self.extra = {key: value for key, value in extra.items() if value is not None}
+
+
+def query_cost_exception_handler(exc, context):
+    """
+    Exception handler of Django REST framework (see settings.REST_FRAMEWORK), which adds the extra keys of
+    QueryTooExpensive to its error response. The default handler would turn them into strings.
+    :param exc: exception raised by the view
+    :param context: context of the view
+    :return: Response, None if the exception is not handled
+    """
+    response = exception_handler(exc, context)
+    if response is not None and isinstance(exc, QueryTooExpensive):
+        response.data.update(exc.extra)
+    return response
+
+
+def get_query_budget(request):
+    """
+    Return the budget of the occurrence searches of a request
+    :param request: HttpRequest or Request
+    :return: a dictionary with max_cost (planner cost) and timeout (statement_timeout in milliseconds)
+    """
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return settings.OCCURRENCE_QUERY_BUDGET['authenticated']
+    return settings.OCCURRENCE_QUERY_BUDGET['anonymous']
+
+
+def check_query_cost(queryset, request, query_dict, download=None):
+    """
+    Reject a search that the query planner estimates over the budget of the request, before it is executed. Searches
+    without filters or filtered by dataset only are not checked: their counts are precomputed and their pages are read
+    from indexes.
+    :param queryset: GBIFOccurrence queryset of the search
+    :param request: HttpRequest or Request
+    :param query_dict: QueryDict of the search
+    :param download: how to request a download of the search, returned in the error, e.g. a URL
+    :return: estimated cost, None if the search is not checked
+    """
+    params = {param for param in query_dict.keys() if param not in OCCURRENCE_COUNT_IGNORED_PARAMS and
+              any(query_dict.getlist(param))}
+    if not params or occurrence_search_datasets(query_dict) is not None:
+        return None
+    budget = get_query_budget(request)
+    cost = explain_queryset(queryset)['Total Cost']
+    if cost > budget['max_cost']:
+        logger.info('[QUERY COST]{:.0f} > {}: {}'.format(cost, budget['max_cost'], request.get_full_path()))
+        raise QueryTooExpensive(cost=int(cost), max_cost=budget['max_cost'], download=download)
+    return cost
+
+
+@contextmanager
+def statement_timeout(milliseconds):
+    """
+    Cancel the queries that run longer than a timeout in this block, the timeout of the connection is restored after
+    :param milliseconds: statement_timeout
+    """
+    in_transaction = connection.in_atomic_block
+    with connection.cursor() as cursor:
+        # SET LOCAL ends with the transaction, which can not run other statements once a query is cancelled
+        cursor.execute('SET {} statement_timeout = %s'.format('LOCAL' if in_transaction else 'SESSION'), [milliseconds])
+    try:
+        yield
+    finally:
+        if not in_transaction:
+            with connection.cursor() as cursor:
+                cursor.execute('SET SESSION statement_timeout = DEFAULT')
+
+
+def query_budget(view):
+    """
+    Decorator of the occurrence API views, which must be called by the view of Django REST framework (below @api_view
+    or with method_decorator on a handler) so that QueryTooExpensive is returned as an error response. The queries of
+    the view are cancelled after the statement_timeout of the budget of the request.
+    :param view: view function
+    :return: view function
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        try:
+            with statement_timeout(get_query_budget(request)['timeout']):
+                return view(request, *args, **kwargs)
+        except OperationalError as e:
+            if isinstance(e.__cause__, psycopg2.extensions.QueryCanceledError):
+                logger.info('[QUERY COST]Timeout: {}'.format(request.get_full_path()))
+                raise QueryTooExpensive()
+            raise
+    return wrapper
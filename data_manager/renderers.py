@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+from djangorestframework_camel_case.render import CamelCaseJSONRenderer
+from djangorestframework_camel_case.util import camelize, camelize_re, underscore_to_camel
+import re
+
+
+def camelize_key(key):
+    """
+    Return the camelCase key rendered by CamelCaseJSONRenderer, e.g. 'dataset_id' -> 'datasetId'
+    :param key: str
+    :return: str
+    """
+    return re.sub(camelize_re, underscore_to_camel, key) if '_' in key else key
+
+
+class CamelizedList(list):
+    """A list of items whose keys are already camelCase, e.g. the results of a page"""
+    pass
+
+
+class CamelizedJSONRenderer(CamelCaseJSONRenderer):
+    """
+    CamelCaseJSONRenderer which renders the CamelizedList values of a response as they are, instead of copying every
+    item to rewrite its keys
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if isinstance(data, dict) and any(isinstance(value, CamelizedList) for value in data.values()):
+            data = OrderedDict((camelize_key(key), value if isinstance(value, CamelizedList) else camelize(value))
+                               for key, value in data.items())
+            # skip CamelCaseJSONRenderer.render
+            return super(CamelCaseJSONRenderer, self).render(data, accepted_media_type, renderer_context)
+        return super(CamelizedJSONRenderer, self).render(data, accepted_media_type, renderer_context)
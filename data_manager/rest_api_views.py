@@ -1,52 +1,76 @@
 # -*- coding: utf-8 -*-
 import json
 import logging
-import re
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from django.conf import settings
-from django.core.cache import cache
 from django.core.serializers import serialize
-from django.db.models import Sum, Count
+from django.conf import settings
+from django.db.models import Count, Prefetch
+from django.http import StreamingHttpResponse
+from django.urls import reverse
+from django.utils.cache import patch_vary_headers
+from django.utils.decorators import method_decorator
 from django_filters.rest_framework import DjangoFilterBackend
+from djangorestframework_camel_case.render import CamelCaseBrowsableAPIRenderer
 from drf_yasg.utils import swagger_auto_schema
 from rest_framework import viewsets, filters, generics, permissions
 from rest_framework.response import Response
 from rest_framework.decorators import api_view, renderer_classes
+from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework.permissions import IsAdminUser
 from rest_framework.renderers import JSONRenderer, TemplateHTMLRenderer
+from .conditional import ConditionalDataMixin, conditional_data_view, never_cache_estimate
 from .filters import OccurrenceFilter, HarvestedDatasetFilter, DatasetFilter
-from .helpers import get_occurrence_queryset_from_form
+from .helpers import OCCURRENCE_AGGREGATE_DIMENSIONS, get_occurrence_aggregates, get_occurrence_count, \
+    get_occurrence_grid_counts, get_occurrence_queryset_from_form, get_occurrence_search_result, \
+    occurrence_cube_applicable, stream_occurrences
+from .pagination import InvalidCursor, KeysetPagination, OccurrencePagination, keyset_page
 from .models import DataType, Dataset, HarvestedDataset, HexGrid, Keyword, Project, BasisOfRecord, \
-    Publisher, GBIFOccurrence, Download, Person
+    Publisher, GBIFOccurrence, Download, Person, PersonTypeRole, Statistics, OccurrenceCube
 from .permissions import IsAuthenticatedAndIsOwner
+from .query_cost import check_query_cost, query_budget
+from .renderers import CamelizedJSONRenderer
 from .serializers import HarvestedDatasetSerializer, DatasetSerializer, KeywordSerializer, \
     ProjectSerializer, BasisOfRecordSerializer, PublisherSerializer, OccurrenceSerializer, \
-    DataTypeSerializer, DownloadSerializer, ProjectPersonnelSerializer
+    DataTypeSerializer, DownloadSerializer, ProjectPersonnelSerializer, OccurrenceLookupSerializer, \
+    get_filter_field_name, validate_occurrence_fields
 
 
 logger = logging.getLogger('data_manager')
 
 
+def legacy_download_url(request):
+    """
+    Return the URL of the portal that requests a Download of the occurrences of a legacy occurrence search
+    :param request: Request of occurrence_search_view, occurrence_count or occurrence_grid
+    :return: absolute URL
+    """
+    return '{}?{}'.format(request.build_absolute_uri(reverse('occurrence-download')), request.GET.urlencode())
+
+
 @swagger_auto_schema(methods=['get'], auto_schema=None)
+@conditional_data_view
 @api_view(['GET'])
 def database_statistics(request):
     """
     A view that returns the database content statistics. *Will be deprecated in future version*
     """
-    qs = Dataset.objects.all().prefetch_related('data_type')
-    d = DataType.objects.annotate(num_datasets=Count('dataset'))
+    statistics = Statistics.objects.current()  # computed at the end of import_datasets
     content = {
-        'total number of datasets': qs.only('pk').count(),
-        'total number of occurrence records': qs.aggregate(Sum('filtered_record_count'))['filtered_record_count__sum'],
-        'number of datasets per data type': {}
+        'total number of datasets': statistics.dataset_count,
+        'total number of occurrence records': statistics.occurrence_count,
+        'total number of species': statistics.species_count,
+        'total number of publishers': statistics.publisher_count,
+        'number of datasets per data type': statistics.datasets_per_data_type,
+        'last updated': statistics.created_at
     }
-    for data_type in d:
-        content['number of datasets per data type'][data_type.data_type] = data_type.num_datasets
     return Response(content)
 
 
 @swagger_auto_schema(methods=['get'], auto_schema=None)
+@conditional_data_view
 @api_view(['GET'])
+@query_budget
 def occurrence_grid(request):
     """
     Process queries for HexGrid objects. *Will be deprecated in future version*
@@ -60,81 +84,84 @@ def occurrence_grid(request):
                            '6': 25000}
     # OCCURRENCE
     occ_qs, form, latitude_range, longitude_range = get_occurrence_queryset_from_form(request.query_params)
+    check_query_cost(occ_qs, request, request.query_params, legacy_download_url(request))
+    occ_qs, occ_count = get_occurrence_search_result(occ_qs, request.query_params)
     zoom = request.query_params.get('zoom', '3')
     extent = request.query_params.get('extent', '')
     # False to return geojson, True to return pk & count of a hexgrid
     count = request.query_params.get('count', False)
-    qs = HexGrid.objects.filter(size=zoom_grid_size_dict[zoom]).only('id', 'geom')
+    # counts of the whole grid are cached for the search, the extent only selects the HexGrid returned
+    grid_counts = get_occurrence_grid_counts(occ_qs, request.query_params, zoom_grid_size_dict[zoom])
+    qs = HexGrid.objects.filter(size=zoom_grid_size_dict[zoom], id__in=list(grid_counts)).only('id', 'geom')
     if extent:
         extent_array = extent.split(',')
         extent = [float(p) for p in extent_array]
         qs = qs.filter(left__gte=extent[0]).filter(bottom__gte=extent[1]).filter(right__lte=extent[2]).filter(top__lte=extent[3])
-    qs = qs.filter(GBIFOccurrence__in=occ_qs).annotate(count=Count('GBIFOccurrence'))
-    # qs = qs.filter(size=zoom_grid_size_dict[zoom]).annotate(count=Count('GBIFOccurrence')).order_by()
     if not count:
         # return geojson format of queryset
-        # properties will contain 'pk'. annotate value could not be serialize.
+        # properties will contain 'pk'.
         results = serialize('geojson', qs, geometry_field='geom', srid=3031, fields=('pk', 'geom'))
         return Response(data=json.loads(results))
     else:
         # return json format which contains only 'pk' and 'count' as 'geom' needs to be serialized.
-        results = qs.values('pk', 'count')
-        return Response({'results': list(results)})
+        results = [{'pk': pk, 'count': grid_counts[pk]} for pk in qs.values_list('pk', flat=True)]
+        return Response({'results': results})
 
 
 @swagger_auto_schema(methods=['get'], auto_schema=None)
+@conditional_data_view
 @api_view(['GET'])
 @renderer_classes((TemplateHTMLRenderer, JSONRenderer))
+@query_budget
 def occurrence_search_view(request):
     """
     Search for GBIFOccurrences. *Will be deprecated in future version*
     if "format=json" is specified in url, JSON data will be returned. Otherwise response will be rendered using
     'templates/occurrence-table.html' template - according to the order in @renderer_classes decorator:
-    e.g. /api/search/occurrence/?q=cnidaria&type=occurrence&format=json
+    e.g. /api/search/occurrence/?q=cnidaria&sort=-year&format=json, then follow next_cursor/previous_cursor with
+    ?cursor=<cursor>. Sort options are the keys of OCCURRENCE_SORT_FIELDS.
     """
-    page_size = int(settings.REST_FRAMEWORK.get('PAGE_SIZE', '20'))
-    offset = int(request.GET.get('offset', '0'))
-    limit = int(request.GET.get('limit', offset + page_size))
+    paginator = KeysetPagination()
+    page_size = paginator.get_page_size(request)
+    sort = paginator.get_sort(request)
     qs, form, latitude_range, longitude_range = get_occurrence_queryset_from_form(request.GET)
-    has_previous_page = False
-    if offset == 0:  # if offset = 0, qs[offset-1] will throw AssertionError: Negative indexing is not supported.
-        has_previous_page = False
-    elif offset > 0:
-        if qs.only('id')[offset-1]:
-            has_previous_page = True
-        else:
-            has_previous_page = False
-    has_next_page = True
-    try:
-        qs.only('id')[limit+1]
-    except IndexError:
-        has_next_page = False
+    check_query_cost(qs, request, request.GET, legacy_download_url(request))
+    qs, count = get_occurrence_search_result(qs, request.GET)
     # use .only() to avoid select all other fields when executing SQL query
     qs = qs.only('id', 'scientificName', 'decimalLatitude', 'decimalLongitude', 'year', 'month',
                  'dataset_id', 'institutionCode', 'collectionCode', 'locality', 'dataset_title',
-                 'taxonKey', 'basisOfRecord')[offset:limit]
-    return Response({'limit': limit, 'offset': offset, 'page size': page_size, 'has_previous_page': has_previous_page,
-                     'has_next_page': has_next_page, 'occurrences': [x.toJSON() for x in qs]},
+                 'taxonKey', 'basisOfRecord')
+    try:
+        occurrences, next_cursor, previous_cursor = keyset_page(qs, sort, request.GET.get('cursor'), page_size)
+    except InvalidCursor:
+        raise NotFound(paginator.invalid_cursor_message)
+    return Response({'limit': page_size, 'sort': sort, 'page size': page_size,
+                     'has_previous_page': previous_cursor is not None, 'has_next_page': next_cursor is not None,
+                     'previous_cursor': previous_cursor, 'next_cursor': next_cursor,
+                     'occurrences': [x.toJSON() for x in occurrences]},
                     template_name='occurrence-table.html')
 
 
 @swagger_auto_schema(methods=['get'], auto_schema=None)
+@conditional_data_view
 @api_view(['GET'])
+@query_budget
 def occurrence_count(request):
     """
-    Count the total number of occurrences for given search parameters
-    """
-    cache_url = re.sub(r'\&offset\=\d+', '', request.META.get('QUERY_STRING'))
-    cache_key = 'occurrencecount-humanize-' + cache_url
-    logger.info('Cache key: {}'.format(cache_key))
-    results_count = cache.get(cache_key)
-    if not results_count:
-        qs, form, latitude_range, longitude_range = get_occurrence_queryset_from_form(request.GET)
-        results_count = "{:,}".format(qs.only('id').count())  # add comma to thousand
-        cache.set(cache_key, results_count)
-    return Response({
-        'count': results_count
+    Count the total number of occurrences for given search parameters. Large counts are estimated (`estimated` is true)
+    while the exact count is computed in the background, see get_occurrence_count()
+    """
+    qs, form, latitude_range, longitude_range = get_occurrence_queryset_from_form(request.GET)
+    check_query_cost(qs, request, request.GET, legacy_download_url(request))
+    qs, results_count = get_occurrence_search_result(qs, request.GET)
+    estimated = False
+    if results_count is None:  # too many occurrences to cache their ids
+        results_count, estimated = get_occurrence_count(qs, request.GET, 'form')
+    response = Response({
+        'count': "{:,}".format(results_count),  # add comma to thousand
+        'estimated': estimated
     })
+    return never_cache_estimate(response, estimated)
 
 
 class HarvestedDatasetViewSet(viewsets.ReadOnlyModelViewSet):
@@ -153,7 +180,7 @@ class HarvestedDatasetViewSet(viewsets.ReadOnlyModelViewSet):
     filterset_class = HarvestedDatasetFilter
 
 
-class DataTypeViewSet(viewsets.ReadOnlyModelViewSet):
+class DataTypeViewSet(ConditionalDataMixin, viewsets.ReadOnlyModelViewSet):
     """
     API endpoint of viewing DataTypes. Order by `data_type` field.
 
@@ -168,7 +195,7 @@ class DataTypeViewSet(viewsets.ReadOnlyModelViewSet):
     ordering_fields = ('data_type',)
 
 
-class KeywordViewSet(viewsets.ReadOnlyModelViewSet):
+class KeywordViewSet(ConditionalDataMixin, viewsets.ReadOnlyModelViewSet):
     """
     API endpoint for viewing Keywords.
 
@@ -184,7 +211,7 @@ class KeywordViewSet(viewsets.ReadOnlyModelViewSet):
     search_fields = ('keyword',)
 
 
-class ProjectViewSet(viewsets.ReadOnlyModelViewSet):
+class ProjectViewSet(ConditionalDataMixin, viewsets.ReadOnlyModelViewSet):
     """
     API endpoint for viewing Projects.
 
@@ -200,7 +227,7 @@ class ProjectViewSet(viewsets.ReadOnlyModelViewSet):
     search_fields = ('title',)
 
 
-class BasisOfRecordViewSet(viewsets.ReadOnlyModelViewSet):
+class BasisOfRecordViewSet(ConditionalDataMixin, viewsets.ReadOnlyModelViewSet):
     """
     API endpoint for viewing BasisOfRecords. Order by `basis_of_record` field.
 
@@ -216,7 +243,7 @@ class BasisOfRecordViewSet(viewsets.ReadOnlyModelViewSet):
     ordering_fields = ('basis_of_record',)
 
 
-class PublisherViewSet(viewsets.ReadOnlyModelViewSet):
+class PublisherViewSet(ConditionalDataMixin, viewsets.ReadOnlyModelViewSet):
     """
     API endpoint for viewing Publishers. Order by `publisher_name`.
 
@@ -233,7 +260,7 @@ class PublisherViewSet(viewsets.ReadOnlyModelViewSet):
     ordering_fields = ('publisher_name',)
 
 
-class DatasetViewSet(viewsets.ReadOnlyModelViewSet):
+class DatasetViewSet(ConditionalDataMixin, viewsets.ReadOnlyModelViewSet):
     """
     API endpoint for viewing Datasets. Order by `filtered_record_count`.
 
@@ -250,7 +277,7 @@ class DatasetViewSet(viewsets.ReadOnlyModelViewSet):
     ordering_fields = ('filtered_record_count',)
 
 
-class ProjectPersonnelViewSet(viewsets.ReadOnlyModelViewSet):
+class ProjectPersonnelViewSet(ConditionalDataMixin, viewsets.ReadOnlyModelViewSet):
     """
     API endpoint for viewing Project personnel.
 
@@ -260,27 +287,193 @@ class ProjectPersonnelViewSet(viewsets.ReadOnlyModelViewSet):
     retrieve:
     Return the given Project personnel.
     """
+    # annotate(count=Count('id')) for distinct record, project ids of a page are prefetched with one query
     queryset = Person.objects.filter(personTypeRole__person_type='personnel', personTypeRole__project__isnull=False)\
-        .annotate(count=Count('id'))  # annotate(count=Count('id')) for distinct record
+        .annotate(count=Count('id'))\
+        .prefetch_related(Prefetch('personTypeRole', queryset=PersonTypeRole.objects.only('person_id', 'project_id')))
     serializer_class = ProjectPersonnelSerializer
     filter_backends = (filters.SearchFilter,)
     search_fields = ('full_name',)
 
 
-class OccurrenceViewSet(viewsets.ReadOnlyModelViewSet):
+class OccurrenceViewSet(ConditionalDataMixin, viewsets.ReadOnlyModelViewSet):
     """
     API endpoint for viewing Occurrences.
 
     list:
-    Return a list of Occurrence instances.
+    Return a list of Occurrence instances. Use `sort` (`id`, `year` or `scientific_name`, prefix with `-` for
+    descending order) and follow the `next` and `previous` links to paginate. `count` of large results is estimated
+    (`countEstimated` is true) until the exact count is computed in the background. Use `fields` (e.g.
+    `fields=decimalLatitude,decimalLongitude,scientificName,year`) to return only these fields.
 
     retrieve:
-    Return the given Occurrence.
+    Return the given Occurrence. Use `fields` to return only these fields.
     """
     queryset = GBIFOccurrence.objects.all()
     serializer_class = OccurrenceSerializer
     filter_backends = (DjangoFilterBackend,)
     filterset_class = OccurrenceFilter
+    pagination_class = OccurrencePagination
+    renderer_classes = (CamelizedJSONRenderer, CamelCaseBrowsableAPIRenderer)
+
+    def get_fields(self):
+        """
+        Return the fields requested with the fields parameter, all OCCURRENCE_FIELDS by default
+        :return: a list of field names
+        """
+        if self.request is None:  # schema generation
+            return list(settings.OCCURRENCE_FIELDS)
+        return validate_occurrence_fields(self.request.query_params.get('fields', ''))
+
+    def get_queryset(self):
+        queryset = super(OccurrenceViewSet, self).get_queryset()
+        if self.action == 'retrieve':
+            queryset = queryset.only(*self.get_fields())
+        return queryset
+
+    def get_serializer(self, *args, **kwargs):
+        kwargs.setdefault('fields', self.get_fields())
+        return super(OccurrenceViewSet, self).get_serializer(*args, **kwargs)
+
+    def get_download(self):
+        """
+        Return how to request a Download of the occurrences of this search: POST query to url
+        :return: a dictionary
+        """
+        filter_fields = get_filter_field_name(OccurrenceFilter)
+        query = {param: values for param, values in self.request.query_params.lists()
+                 if param in filter_fields and any(values)}
+        return {'url': self.request.build_absolute_uri(reverse('v1.0:download-list')), 'query': query}
+
+    @method_decorator(query_budget)
+    def list(self, request, *args, **kwargs):
+        """
+        Same response as ListModelMixin.list, with rows selected by QuerySet.values() and serialized by
+        OccurrenceSerializer.serialize_values(), which is several times faster for large pages. Only the requested
+        fields are selected, with the id and the sort field needed by the pagination.
+        """
+        fields = self.get_fields()
+        sort_field = self.paginator.sort_fields[self.paginator.get_sort(request).lstrip('-')]
+        queryset = self.filter_queryset(self.get_queryset())
+        check_query_cost(queryset, request, request.query_params, self.get_download())
+        page = self.paginate_queryset(queryset.values(*OrderedDict.fromkeys(fields + ['id', sort_field])))
+        response = self.get_paginated_response(OccurrenceSerializer.serialize_values(page, fields))
+        return never_cache_estimate(response, self.paginator.count_estimated)
+
+
+class OccurrenceExportView(generics.GenericAPIView):
+    """
+    API endpoint for exporting Occurrences.
+
+    get:
+    Stream the Occurrences found by the filters of the occurrence list, as CSV (`output=csv`, default) or newline
+    delimited JSON (`output=ndjson`). Use `fields` to export only these columns. The response is gzip compressed if
+    the client accepts it. Searches that find more than `OCCURRENCE_EXPORT_MAX_RECORDS` Occurrences must be requested
+    as a Download.
+    """
+    queryset = GBIFOccurrence.objects.all()
+    permission_classes = [permissions.IsAuthenticated, ]
+    filter_backends = (DjangoFilterBackend,)
+    filterset_class = OccurrenceFilter
+    pagination_class = None
+    content_types = {'csv': 'text/csv; charset=utf-8', 'ndjson': 'application/x-ndjson; charset=utf-8'}
+
+    def get(self, request, *args, **kwargs):
+        output = request.query_params.get('output', 'csv')
+        if output not in self.content_types:
+            raise ValidationError({'output': 'Must be one of: {}'.format(', '.join(sorted(self.content_types)))})
+        fields = validate_occurrence_fields(request.query_params.get('fields', ''))
+        queryset = self.filter_queryset(self.get_queryset())
+        # count at most one row more than the limit
+        if queryset.order_by()[:settings.OCCURRENCE_EXPORT_MAX_RECORDS + 1].count() > \
+                settings.OCCURRENCE_EXPORT_MAX_RECORDS:
+            raise ValidationError('The search finds more than {} occurrences, narrow it or request a download.'.format(
+                settings.OCCURRENCE_EXPORT_MAX_RECORDS))
+        compress = 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+        response = StreamingHttpResponse(
+            stream_occurrences(queryset.order_by('id'), fields, output, compress),
+            content_type=self.content_types[output])
+        response['Content-Disposition'] = 'attachment; filename="occurrences.{}"'.format(output)
+        if compress:
+            response['Content-Encoding'] = 'gzip'
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return response
+
+
+class OccurrenceAggregateView(ConditionalDataMixin, generics.GenericAPIView):
+    """
+    API endpoint for occurrence statistics.
+
+    get:
+    Return the number of Occurrences (`count`) and of distinct species (`speciesCount`) found by the filters of the
+    occurrence list, per group of `group_by`: a comma separated list of `year`, `month`, `basis_of_record`, `dataset`,
+    `kingdom_key`, `phylum_key`, `class_key`, `order_key`, `family_key`, `genus_key`, `species_key` and `depth` (bins of
+    `OCCURRENCE_AGGREGATE_DEPTH_BIN` meters). `truncated` is true if there are more than
+    `OCCURRENCE_AGGREGATE_MAX_GROUPS` groups.
+    """
+    queryset = GBIFOccurrence.objects.all()
+    filter_backends = (DjangoFilterBackend,)
+    filterset_class = OccurrenceFilter
+    pagination_class = None
+
+    def get_group_by(self):
+        """
+        Return the dimensions of the group_by parameter
+        :return: a list of keys of OCCURRENCE_AGGREGATE_DIMENSIONS
+        """
+        group_by = [dimension.strip() for value in self.request.query_params.getlist('group_by')
+                    for dimension in value.split(',') if dimension.strip()]
+        if not group_by:
+            raise ValidationError({'group_by': 'This parameter is required.'})
+        invalid = [dimension for dimension in group_by if dimension not in OCCURRENCE_AGGREGATE_DIMENSIONS]
+        if invalid:
+            raise ValidationError({'group_by': 'Invalid dimension: {}'.format(', '.join(invalid))})
+        return list(OrderedDict.fromkeys(group_by))
+
+    @method_decorator(query_budget)
+    def get(self, request, *args, **kwargs):
+        group_by = self.get_group_by()
+        if occurrence_cube_applicable(request.query_params, group_by):
+            # OccurrenceCube has the fields of the filters it supports
+            queryset = self.filter_queryset(OccurrenceCube.objects.all())
+        else:
+            queryset = self.filter_queryset(self.get_queryset())
+            check_query_cost(queryset, request, request.query_params)
+        results, truncated = get_occurrence_aggregates(queryset, request.query_params, group_by)
+        return Response({'group_by': group_by, 'results': results, 'truncated': truncated})
+
+
+class OccurrenceLookupView(generics.GenericAPIView):
+    """
+    API endpoint for looking up Occurrences in bulk.
+
+    post:
+    Return the Occurrences of a list of GBIF ids (`gbifIds`) or of Occurrence ids (`ids`), at most
+    `OCCURRENCE_LOOKUP_MAX_IDS` at once, in the order of the list. Use `fields` to return only these fields. The ids
+    that are not found are listed in `notFound`.
+    """
+    queryset = GBIFOccurrence.objects.all()
+    serializer_class = OccurrenceLookupSerializer
+    pagination_class = None
+    renderer_classes = (CamelizedJSONRenderer, CamelCaseBrowsableAPIRenderer)
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        fields = data['fields']
+        lookup_field = 'gbifID' if 'gbif_ids' in data else 'id'
+        values = list(OrderedDict.fromkeys(data.get('gbif_ids', data.get('ids'))))
+        # a single query on the unique index of the lookup field
+        rows = self.get_queryset().filter(**{'{}__in'.format(lookup_field): values}).values(
+            *OrderedDict.fromkeys(fields + [lookup_field]))
+        found = {row[lookup_field]: row for row in rows}
+        results = [found[value] for value in values if value in found]
+        return Response({
+            'count': len(results),
+            'results': OccurrenceSerializer.serialize_values(results, fields),
+            'not_found': [value for value in values if value not in found],
+        })
 
 
 class DownloadListCreateAPIView(generics.ListCreateAPIView):
@@ -1,9 +1,11 @@
 import os
 from data_manager.filters import OccurrenceFilter
 from data_manager.models import HarvestedDataset, Dataset, Keyword, Project, BasisOfRecord, Publisher, GBIFOccurrence, \
-    Download, DataType, HexGrid, TaskResult, Person, PersonTypeRole
+    Download, DataType, HexGrid, TaskResult, Person
+from data_manager.renderers import CamelizedList, camelize_key
 from data_manager.tasks import prepare_download_file
 from django.conf import settings
+from django.db import models
 from django.urls import reverse
 from django_filters import filters
 from rest_framework import serializers
@@ -42,6 +44,7 @@ class HarvestedDatasetSerializer(serializers.ModelSerializer):
     class Meta:
         model = HarvestedDataset
         fields = "__all__"
+        read_only_fields = ['payload_hash']
 
 
 class DataTypeSerializer(serializers.ModelSerializer):
@@ -112,8 +115,8 @@ class BasisOfRecordSerializer(serializers.ModelSerializer):
 class ProjectPersonnelSerializer(serializers.Serializer):
 
     def to_representation(self, instance):
-        person_type_role = PersonTypeRole.objects.filter(person=instance)
-        projects = [entry.project_id for entry in person_type_role]
+        # prefetched by ProjectPersonnelViewSet
+        projects = [entry.project_id for entry in instance.personTypeRole.all()]
 
         representation = {
             'id': instance.id,
@@ -136,12 +139,153 @@ class OccurrenceSerializer(serializers.ModelSerializer):
         model = GBIFOccurrence
         fields = settings.OCCURRENCE_FIELDS
 
+    def __init__(self, *args, **kwargs):
+        """
+        :param fields: optional list of OCCURRENCE_FIELDS to serialize, see validate_occurrence_fields()
+        """
+        fields = kwargs.pop('fields', None)
+        super(OccurrenceSerializer, self).__init__(*args, **kwargs)
+        if fields is not None:
+            for field_name in set(self.fields) - set(fields):
+                self.fields.pop(field_name)
+
+    @staticmethod
+    def serialize_values(rows, field_names=None):
+        """
+        Serialize rows of GBIFOccurrence.objects.values(*OCCURRENCE_FIELDS) to the camelCase representation rendered by
+        CamelCaseJSONRenderer for OccurrenceSerializer, without instantiating models and serializer fields. All
+        OCCURRENCE_FIELDS are text or numbers, so their database values are their representation.
+        :param rows: an iterable of dictionaries
+        :param field_names: the fields to serialize, all OCCURRENCE_FIELDS by default. Rows may have other keys, e.g.
+        the sort field used by the pagination.
+        :return: CamelizedList of dictionaries
+        """
+        keys = [(field, OCCURRENCE_CAMELCASE_KEYS[field]) for field in field_names or settings.OCCURRENCE_FIELDS]
+        return CamelizedList({key: row[field] for field, key in keys} for row in rows)
+
+
+# key = field of OccurrenceSerializer, value = key rendered by CamelCaseJSONRenderer
+OCCURRENCE_CAMELCASE_KEYS = {field: camelize_key(field) for field in settings.OCCURRENCE_FIELDS}
+
+
+def validate_occurrence_fields(value):
+    """
+    Validate the fields parameter of the occurrence API and downloads, a projection of OCCURRENCE_FIELDS. Field names
+    are accepted as they are rendered (e.g. datasetId, class) or as they are declared (dataset_id, _class).
+    e.g. 'decimalLatitude,decimalLongitude,scientificName,year'
+    :param value: a comma separated string or a list of field names
+    :return: a list of OCCURRENCE_FIELDS, in the order of OCCURRENCE_FIELDS, all of them if value is empty
+    """
+    if isinstance(value, str):
+        value = value.split(',')
+    requested = {str(name).strip() for name in value or [] if str(name).strip()}
+    if not requested:
+        return list(settings.OCCURRENCE_FIELDS)
+    names = {key.lower(): field for field, key in OCCURRENCE_CAMELCASE_KEYS.items()}
+    names.update({field: field for field in settings.OCCURRENCE_FIELDS})
+    invalid = sorted(name for name in requested if names.get(name, names.get(name.lower())) is None)
+    if invalid:
+        raise serializers.ValidationError({'fields': 'Invalid field name: {}'.format(', '.join(invalid))})
+    fields = {names.get(name, names.get(name.lower())) for name in requested}
+    return [field for field in settings.OCCURRENCE_FIELDS if field in fields]
+
+
+class OccurrenceFieldsField(serializers.JSONField):
+    """
+    A projection of OCCURRENCE_FIELDS, a comma separated string or a list of field names, see
+    validate_occurrence_fields()
+    """
+
+    def __init__(self, all_if_empty=True, **kwargs):
+        """
+        :param all_if_empty: if False, an empty value is validated as None instead of all OCCURRENCE_FIELDS
+        """
+        self.all_if_empty = all_if_empty
+        super(OccurrenceFieldsField, self).__init__(**kwargs)
+
+    def to_internal_value(self, data):
+        if not data and not self.all_if_empty:
+            return None
+        if not isinstance(data, (str, list)):
+            raise serializers.ValidationError(detail='A comma separated string or a list of field names is expected')
+        try:
+            return validate_occurrence_fields(data)
+        except serializers.ValidationError as e:
+            raise serializers.ValidationError(detail=e.detail['fields'])
+
+
+class OccurrenceLookupSerializer(serializers.Serializer):
+    """
+    Validate a bulk lookup of occurrences by gbifID or by id, see OccurrenceLookupView
+    """
+    gbif_ids = serializers.ListField(child=serializers.CharField(), required=False)
+    ids = serializers.ListField(child=serializers.IntegerField(min_value=1), required=False)
+    fields = OccurrenceFieldsField(required=False)
+
+    def validate(self, attrs):
+        """
+        Ensure that either gbif_ids or ids is given, with at most OCCURRENCE_LOOKUP_MAX_IDS values
+        """
+        if ('gbif_ids' in attrs) == ('ids' in attrs):
+            raise serializers.ValidationError('Either gbifIds or ids is required')
+        values = attrs.get('gbif_ids', attrs.get('ids'))
+        if len(values) > settings.OCCURRENCE_LOOKUP_MAX_IDS:
+            raise serializers.ValidationError('At most {} ids can be looked up at once'.format(
+                settings.OCCURRENCE_LOOKUP_MAX_IDS))
+        attrs.setdefault('fields', list(settings.OCCURRENCE_FIELDS))
+        return attrs
+
+
+def get_task_statuses(downloads):
+    """
+    Return the status of the TaskResult of Download instances, with one query
+    :param downloads: a list of Download objects
+    :return: a dictionary with key = task_id, value = status
+    """
+    task_ids = {download.task_id for download in downloads if download.task_id}
+    if not task_ids:
+        return dict()
+    return dict(TaskResult.objects.filter(task_id__in=task_ids).values_list('task_id', 'status'))
+
+
+def get_existing_files(downloads):
+    """
+    Return the paths of the files of Download instances that exist, listing each directory once
+    :param downloads: a list of Download objects
+    :return: a set of paths
+    """
+    paths = {download.file.path for download in downloads if download.file}
+    files = set()
+    for directory in {os.path.dirname(path) for path in paths}:
+        try:
+            files.update(os.path.join(directory, name) for name in os.listdir(directory))
+        except OSError:  # directory does not exist
+            continue
+    return paths & files
+
+
+class DownloadListSerializer(serializers.ListSerializer):
+    """
+    Serialize a list of Download instances, with the status of their TaskResult and their files loaded at once
+    """
+
+    def to_representation(self, data):
+        downloads = list(data.all() if isinstance(data, models.Manager) else data)
+        self.child.task_statuses = get_task_statuses(downloads)
+        self.child.files = get_existing_files(downloads)
+        return super(DownloadListSerializer, self).to_representation(downloads)
+
 
 class DownloadSerializer(serializers.Serializer):
     """
     Serialize Download instance(s).
     """
+    # loaded by DownloadListSerializer
+    task_statuses = None
+    files = None
     query = serializers.JSONField(required=False)
+    # the columns of the download file, all OCCURRENCE_FIELDS are exported when it is empty
+    fields = OccurrenceFieldsField(required=False, all_if_empty=False)
 
     def validate_query(self, value):
         """
@@ -172,11 +316,12 @@ class DownloadSerializer(serializers.Serializer):
         :param instance: Download object
         :return: a Python dictionary
         """
+        # statuses and files are loaded for the whole list by DownloadListSerializer, or for this instance only
+        task_statuses, files = self.task_statuses, self.files
+        if task_statuses is None:
+            task_statuses, files = get_task_statuses([instance]), get_existing_files([instance])
         # Access the status of TaskResult using Download.task_id
-        if TaskResult.objects.filter(task_id=instance.task_id).exists():
-            status = TaskResult.objects.get(task_id=instance.task_id).status
-        else:
-            status = 'PENDING'
+        status = task_statuses.get(instance.task_id, 'PENDING')
         if isinstance(instance.query, str):
             query = instance.query_string_to_dict()
         else:
@@ -184,7 +329,7 @@ class DownloadSerializer(serializers.Serializer):
         # access request in context passed to serializer in views. Absolute uri can only be determined in views.
         download_link = ""  # leave empty if the file is not generated yet
         if instance.file:
-            if os.path.isfile(instance.file.path):
+            if instance.file.path in files:
                 request = self.context.get('request')
                 download_link = request.build_absolute_uri(reverse('my-download-file', args=(instance.id,)))
         representation = {
@@ -194,11 +339,13 @@ class DownloadSerializer(serializers.Serializer):
             'created': instance.created_at,
             'recordCount': instance.record_count,
             'query': query,
+            'fields': instance.fields or settings.OCCURRENCE_FIELDS,
         }
         return representation
 
     class Meta:
         model = Download
+        list_serializer_class = DownloadListSerializer
 
 
 class HexGridSerializer(serializers.ModelSerializer):
@@ -71,11 +71,11 @@ function getCount(queryParams) {
     // fire GET request of the page
     $.get(resultsCount, function(data, status){
         // put the data obtained into #results-container
-        div.innerHTML += `${data.count} records found`;
+        div.innerHTML += `${data.estimated ? 'About ' : ''}${data.count} records found`;
     });
 }
 
-/* To GET the GBIFOccurrence records from a search results page (with limit/offset) */
+/* To GET the GBIFOccurrence records from a search results page (paginated with a cursor) */
 function getPage(queryParams) {
     // get the #results-table div
     var div = document.getElementById('results-table');
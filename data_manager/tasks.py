@@ -3,11 +3,13 @@ from celery import shared_task
 from celery.utils.log import get_task_logger
 from data_manager.filters import OccurrenceFilter
 from data_manager.helpers import create_download_file, get_dataset_queryset_from_form, \
-    get_occurrence_queryset_from_form, write_file
+    get_occurrence_queryset_from_form, occurrence_count_cache_key, write_file
 from data_manager.models import GBIFOccurrence, Download
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from django.core.mail import send_mail
+from django.http import QueryDict
 
 logger = get_task_logger(__name__)
 
@@ -27,6 +29,27 @@ def debug_task():
     return 'Task accepted'
 
 
+@shared_task(name='tasks.count_occurrences')
+def count_occurrences(query_string, source='form'):
+    """
+    Count the occurrences of a search exactly and cache the count for get_occurrence_count().
+    :param query_string: query string of the search
+    :param source: 'form' to filter occurrences with get_occurrence_queryset_from_form, 'filter' with OccurrenceFilter
+    :return: number of occurrences
+    """
+    query_dict = QueryDict(query_string)
+    if source == 'filter':
+        queryset = OccurrenceFilter(query_dict, queryset=GBIFOccurrence.objects.all()).qs
+    else:
+        queryset, form, latitude_range, longitude_range = get_occurrence_queryset_from_form(query_dict)
+    cache_key = occurrence_count_cache_key(query_dict, source)  # before counting, the datasets may be re-imported
+    count = queryset.order_by().only('id').count()
+    cache.set(cache_key, count, settings.OCCURRENCE_COUNT_CACHE_TIMEOUT)
+    cache.delete(cache_key + ':pending')
+    logger.info('[COUNT]{} occurrences: {}'.format(count, query_string))
+    return count
+
+
 @shared_task(bind=True, name='tasks.prepare_download_file')
 def prepare_download_file(self, download_id, download_link):
     """
@@ -43,7 +66,8 @@ def prepare_download_file(self, download_id, download_link):
     record_count = queryset.count()
     Download.objects.filter(id=download_id).update(record_count=record_count, task_id=task_id)
     try:
-        write_file(queryset=queryset, field_names=settings.OCCURRENCE_FIELDS, download=download, prepare_download_id=task_id)
+        field_names = download.fields or settings.OCCURRENCE_FIELDS
+        write_file(queryset=queryset, field_names=field_names, download=download, prepare_download_id=task_id)
     except Exception as e:
         raise CouldNotCreateDownload(e)
     email_message = f'Hi {download.user.username}, your download is ready. Please go to {download_link} to download the ' \
@@ -79,7 +103,7 @@ def prepare_download(self, model, download_link, user_id, download_id):
         download.record_count = occurrence_queryset.count()
         download.save()
         download = create_download_file(
-            queryset=occurrence_queryset, field_names=settings.OCCURRENCE_FIELDS, download=download)
+            queryset=occurrence_queryset, field_names=download.fields or settings.OCCURRENCE_FIELDS, download=download)
         email_message = f'Hi {user.username}, your download is ready. Please go to {download_link} to download the ' \
                     f'file.\nThe download file will remain available online for ' \
                     f'{settings.DOWNLOAD_FILE_STORAGE_PERIOD} days.\n\nQuery: ' \
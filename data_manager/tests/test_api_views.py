@@ -1,12 +1,26 @@
+import csv
+import gzip
+import io
+import json
 import secrets
 import uuid
-from data_manager.models import DataType, Dataset, GBIFOccurrence, HexGrid, User, Download
+from data_manager.generations import bump_epoch
+from data_manager.models import DataType, Dataset, GBIFOccurrence, HexGrid, User, Download, OccurrenceCube, Person, \
+    PersonTypeRole, Project
+from data_manager.serializers import OccurrenceSerializer
+from data_manager.tasks import count_occurrences
 from django.apps import apps
 from django.conf import settings
+from django.core.cache import cache
 from django.contrib.gis.geos import GEOSGeometry
+from django.db import connection
 from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django_celery_results.models import TaskResult
+from djangorestframework_camel_case.render import CamelCaseJSONRenderer
 from rest_framework.test import APITestCase, APIClient
+from unittest.mock import patch
 
 
 TEST_USER = {'username': 'user@email.com', 'password': secrets.token_hex(16)}
@@ -601,6 +615,45 @@ class DatabaseStatisticsTests(APITestCase):
         self.assertEqual(response.data.get('number of datasets per data type'), {'Occurrence': 1})
 
 
+class SerializerQueryCountTests(APITestCase):
+    """Ensure that the list endpoints run a fixed number of queries per page, whatever the number of rows"""
+
+    def count_queries(self, url):
+        cache.clear()  # no conditional GET
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries.captured_queries)
+
+    def test_project_personnel_list(self):
+        """Ensure that the projects of all listed persons are prefetched"""
+        project = Project.objects.create(title='project')
+        counts = []
+        for i in range(2):
+            for j in range(3):
+                person = Person.objects.create(surname='surname {}{}'.format(i, j), full_name='person {}{}'.format(i, j))
+                PersonTypeRole.objects.create(person=person, project=project, person_type='personnel')
+            counts.append(self.count_queries(reverse('v1.0:projectpersonnel-list')))
+        self.assertEqual(counts[0], counts[1])
+        response = self.client.get(reverse('v1.0:projectpersonnel-list'))
+        self.assertEqual(response.data['results'][0]['project'], [project.id])
+
+    def test_download_list(self):
+        """Ensure that the TaskResult of all listed downloads are loaded with one query"""
+        user = User.objects.create_user(**TEST_USER)
+        self.client.force_authenticate(user=user)
+        counts = []
+        for i in range(2):
+            for j in range(3):
+                task_id = '{}'.format(uuid.uuid4())
+                Download.objects.create(user=user, task_id=task_id, query='{}')
+                TaskResult.objects.create(task_id=task_id, status='SUCCESS')
+            counts.append(self.count_queries(reverse('v1.0:download-list')))
+        self.assertEqual(counts[0], counts[1])
+        response = self.client.get(reverse('v1.0:download-list'))
+        self.assertEqual({download['status'] for download in response.data['results']}, {'SUCCESS'})
+
+
 @override_settings(URL_PREFIX=r'^data/')
 class OccurrenceSearchView(APITestCase):
     """Test for API occurrence search, pagination AND count"""
@@ -643,7 +696,7 @@ class OccurrenceSearchView(APITestCase):
         self.assertEqual(len(response.data.get('occurrences')), settings.REST_FRAMEWORK.get('PAGE_SIZE'))
 
     def test_occurrence_search_set_limit(self):
-        """Ensure limit offset works"""
+        """Ensure limit sets the page size"""
         url = reverse('api-occurrence-search')
         response = self.client.get(url, {'q': 'belgica antarctica', 'format': 'json', 'limit': 10})
         self.assertEqual(response.status_code, 200)
@@ -652,25 +705,107 @@ class OccurrenceSearchView(APITestCase):
         self.assertTemplateNotUsed(response, 'occurrence-table.html')
         self.assertEqual(len(response.data.get('occurrences')), 10)
 
-    def test_occurrence_search_set_offset(self):
-        """Ensure limit offset works"""
+    def test_occurrence_search_cursor(self):
+        """Ensure next and previous cursors walk through the pages without overlap"""
         url = reverse('api-occurrence-search')
-        response = self.client.get(url, {'q': 'belgica antarctica', 'format': 'json', 'offset': 20})
-        self.assertEqual(response.status_code, 200)
+        response = self.client.get(url, {'q': 'belgica antarctica', 'format': 'json'})
+        first_page = [occ['id'] for occ in response.data.get('occurrences')]
+        response = self.client.get(url, {'q': 'belgica antarctica', 'format': 'json',
+                                         'cursor': response.data.get('next_cursor')})
         self.assertFalse(response.data.get('has_next_page'))
         self.assertTrue(response.data.get('has_previous_page'))
-        self.assertTemplateNotUsed(response, 'occurrence-table.html')
         self.assertEqual(len(response.data.get('occurrences')), 10)
+        self.assertFalse(set(first_page) & set(occ['id'] for occ in response.data.get('occurrences')))
+        response = self.client.get(url, {'q': 'belgica antarctica', 'format': 'json',
+                                         'cursor': response.data.get('previous_cursor')})
+        self.assertEqual([occ['id'] for occ in response.data.get('occurrences')], first_page)
+        self.assertFalse(response.data.get('has_previous_page'))
 
-    def test_occurrence_search_set_limit_offset(self):
-        """Ensure limit offset works"""
+    def test_occurrence_search_sort(self):
+        """Ensure results are sorted by (sort field, id) across pages, NULL last in ascending order"""
+        GBIFOccurrence.objects.filter(gbifID__in=['31', '32']).update(year=2000)
+        GBIFOccurrence.objects.filter(gbifID='33').update(year=1990)
         url = reverse('api-occurrence-search')
-        response = self.client.get(url, {'q': 'belgica antarctica', 'format': 'json', 'offset': 20, 'limit': 30})
+        response = self.client.get(url, {'format': 'json', 'sort': 'year', 'limit': 2})
+        self.assertEqual([occ['year'] for occ in response.data.get('occurrences')], [1990, 2000])
+        response = self.client.get(url, {'format': 'json', 'sort': 'year', 'limit': 2,
+                                         'cursor': response.data.get('next_cursor')})
+        self.assertEqual([occ['year'] for occ in response.data.get('occurrences')], [2000, None])
+        response = self.client.get(url, {'format': 'json', 'sort': '-year', 'limit': 40})
+        years = [occ['year'] for occ in response.data.get('occurrences')]
+        self.assertEqual(years[-3:], [2000, 2000, 1990])
+        # cursor of another sort order
+        response = self.client.get(url, {'format': 'json', 'sort': '-year', 'limit': 2})
+        response = self.client.get(url, {'format': 'json', 'sort': 'year', 'cursor': response.data.get('next_cursor')})
+        self.assertEqual(response.status_code, 404)
+
+    def test_occurrence_viewset_keyset_pagination(self):
+        """Ensure REST occurrence list follows next links without count"""
+        url = reverse('v1.0:gbifoccurrence-list')
+        response = self.client.get(url, {'sort': '-scientific_name', 'limit': 20})
+        self.assertEqual(response.data.get('count'), 33)
+        self.assertFalse(response.data.get('count_estimated'))
+        ids = [occ['id'] for occ in response.data.get('results')]
+        self.assertEqual(response.data.get('results')[0]['scientificName'], 'gbif_3')
+        response = self.client.get(response.data.get('next'))
+        ids += [occ['id'] for occ in response.data.get('results')]
+        self.assertIsNone(response.data.get('next'))
+        self.assertIsNotNone(response.data.get('previous'))
+        self.assertEqual(sorted(ids), sorted(GBIFOccurrence.objects.values_list('id', flat=True)))
+
+    def test_occurrence_viewset_serialization(self):
+        """Ensure the REST occurrence list renders the same JSON as OccurrenceSerializer and CamelCaseJSONRenderer"""
+        url = reverse('v1.0:gbifoccurrence-list')
+        response = self.client.get(url, {'limit': 50})
+        occurrences = OccurrenceSerializer(GBIFOccurrence.objects.order_by('id'), many=True).data
+        expected = json.loads(CamelCaseJSONRenderer().render(occurrences).decode('utf-8'))
+        # json.dumps keeps the order of the keys
+        self.assertEqual(json.dumps(json.loads(response.content.decode('utf-8'))['results']), json.dumps(expected))
+
+    def test_occurrence_viewset_conditional_get(self):
+        """Ensure that the REST occurrence list returns 304 Not Modified until the data epoch changes"""
+        url = reverse('v1.0:gbifoccurrence-list')
+        response = self.client.get(url, {'limit': 5})
         self.assertEqual(response.status_code, 200)
-        self.assertFalse(response.data.get('has_next_page'))
-        self.assertTrue(response.data.get('has_previous_page'))
-        self.assertTemplateNotUsed(response, 'occurrence-table.html')
-        self.assertEqual(len(response.data.get('occurrences')), 10)
+        self.assertIn('max-age={}'.format(settings.API_CACHE_MAX_AGE), response['Cache-Control'])
+        response = self.client.get(url, {'limit': 5}, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.client.get(url, {'limit': 10}, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+
+    def test_occurrence_query_cost(self):
+        """Ensure that searches over the budget are rejected with the download of their occurrences"""
+        budget = {'anonymous': {'max_cost': 0, 'timeout': 10000}, 'authenticated': {'max_cost': 0, 'timeout': 10000}}
+        url = reverse('v1.0:gbifoccurrence-list')
+        with override_settings(OCCURRENCE_QUERY_BUDGET=budget):
+            response = self.client.get(url, {'scientific_name': 'belgica', 'limit': 5})
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.data['max_cost'], 0)
+            self.assertIsInstance(response.data['cost'], int)
+            self.assertEqual(response.data['download']['query'], {'scientific_name': ['belgica']})
+            self.assertTrue(response.data['download']['url'].endswith(reverse('v1.0:download-list')))
+            response = self.client.get(reverse('api-occurrence-count'), {'q': 'belgica', 'format': 'json'})
+            self.assertEqual(response.status_code, 400)
+            self.assertIn(reverse('occurrence-download'), response.data['download'])
+            response = self.client.get(reverse('v1.0:occurrence-aggregate'),
+                                       {'group_by': 'year', 'scientific_name': 'belgica'})
+            self.assertEqual(response.status_code, 400)
+            self.assertNotIn('download', response.data)
+            # searches without filters are read from indexes and precomputed counts
+            self.assertEqual(self.client.get(url, {'limit': 5}).status_code, 200)
+
+    def test_occurrence_viewset_fields(self):
+        """Ensure the REST occurrence API only returns the requested fields"""
+        url = reverse('v1.0:gbifoccurrence-list')
+        response = self.client.get(url, {'fields': 'scientificName,decimalLatitude,datasetId', 'sort': 'year'})
+        results = json.loads(response.content.decode('utf-8'))['results']
+        self.assertTrue(results)
+        for occurrence in results:
+            self.assertEqual(list(occurrence), ['decimalLatitude', 'scientificName', 'datasetId'])
+        occurrence = GBIFOccurrence.objects.first()
+        response = self.client.get(reverse('v1.0:gbifoccurrence-detail', args=(occurrence.id,)), {'fields': 'year'})
+        self.assertEqual(json.loads(response.content.decode('utf-8')), {'year': occurrence.year})
+        response = self.client.get(url, {'fields': 'scientificName,row_json_text'})
+        self.assertEqual(response.status_code, 400)
 
     def test_occurrence_list_view_results_count(self):
         """Ensure the number of results return is 3"""
@@ -685,6 +820,7 @@ class OccurrenceCountView(APITestCase):
     """Test for API occurrence count"""
 
     def setUp(self):
+        cache.clear()
         for i in range(1000):
             GBIFOccurrence.objects.create(gbifID=i, scientificName='belgica antarctica',
                                           decimalLatitude=-80, decimalLongitude=170,
@@ -695,7 +831,166 @@ class OccurrenceCountView(APITestCase):
         url = reverse('api-occurrence-count')
         response = self.client.get(url, {'q': 'belgica antarctica', 'format': 'json', 'offset': 20, 'limit': 30})
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.data, {'count': '1,000'})
+        self.assertEqual(response.data, {'count': '1,000', 'estimated': False})
+
+    @patch('data_manager.tasks.count_occurrences.apply_async')
+    def test_occurrence_count_estimated(self, mock_apply_async):
+        """Ensure large counts are estimated and counted exactly once in the background"""
+        url = reverse('api-occurrence-count')
+        params = {'q': 'belgica antarctica', 'format': 'json'}
+        with override_settings(OCCURRENCE_EXACT_COUNT_THRESHOLD=0, OCCURRENCE_RESULT_CACHE_MAX_IDS=0):
+            response = self.client.get(url, params)
+            self.assertTrue(response.data.get('estimated'))
+            self.client.get(url, dict(params, cursor='next-page'))  # same search
+            mock_apply_async.assert_called_once()
+            count_occurrences(*mock_apply_async.call_args[0][0])
+            response = self.client.get(url, params)
+        self.assertEqual(response.data, {'count': '1,000', 'estimated': False})
+
+    @patch('data_manager.tasks.count_occurrences.apply_async')
+    def test_occurrence_count_conditional_get(self, mock_apply_async):
+        """Ensure that an estimated count is not cached by the client, an exact count is until the data changes"""
+        url = reverse('api-occurrence-count')
+        params = {'q': 'belgica antarctica', 'format': 'json'}
+        with override_settings(OCCURRENCE_EXACT_COUNT_THRESHOLD=0, OCCURRENCE_RESULT_CACHE_MAX_IDS=0):
+            response = self.client.get(url, params)
+        self.assertFalse(response.has_header('ETag'))
+        self.assertIn('no-cache', response['Cache-Control'])
+        response = self.client.get(url, params)
+        self.assertIn('public', response['Cache-Control'])
+        with self.assertNumQueries(0):
+            not_modified = self.client.get(url, params, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+        bump_epoch()
+        self.assertEqual(self.client.get(url, params, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+
+    def test_occurrence_search_result_shared(self):
+        """Ensure that the count and the occurrences of a search are found by a single search query"""
+        params = {'q': 'belgica antarctica', 'format': 'json'}
+        response = self.client.get(reverse('api-occurrence-count'), params)
+        self.assertEqual(response.data, {'count': '1,000', 'estimated': False})
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('api-occurrence-search'), params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data.get('has_next_page'))
+        self.assertFalse([query for query in queries.captured_queries if 'search_document' in query['sql']])
+
+
+@override_settings(URL_PREFIX=r'^data/')
+class OccurrenceExportView(APITestCase):
+    """Test for API occurrence export"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(**TEST_USER)
+        self.client.force_authenticate(user=self.user)
+        self.url = reverse('v1.0:occurrence-export')
+        for i in range(5):
+            GBIFOccurrence.objects.create(gbifID=i, scientificName='belgica antarctica', year=2000 + i)
+
+    def test_export_csv(self):
+        """Ensure that the occurrences found by the filters are streamed as CSV"""
+        response = self.client.get(self.url, {'year_min': 2002})
+        self.assertEqual(response.status_code, 200)
+        rows = list(csv.reader(io.StringIO(b''.join(response.streaming_content).decode('utf-8'))))
+        self.assertEqual(rows[0], settings.OCCURRENCE_FIELDS)
+        self.assertEqual([row[settings.OCCURRENCE_FIELDS.index('year')] for row in rows[1:]], ['2002', '2003', '2004'])
+
+    def test_export_ndjson_gzip(self):
+        """Ensure that NDJSON has the keys of the occurrence API and is compressed when the client accepts gzip"""
+        with override_settings(OCCURRENCE_EXPORT_CHUNK_SIZE=2):
+            response = self.client.get(self.url, {'output': 'ndjson'}, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        lines = gzip.decompress(b''.join(response.streaming_content)).decode('utf-8').splitlines()
+        self.assertEqual(len(lines), 5)
+        occurrence = json.loads(lines[0])
+        self.assertEqual(occurrence['scientificName'], 'belgica antarctica')
+        self.assertIn('datasetId', occurrence)
+
+    def test_export_limit(self):
+        """Ensure that searches larger than OCCURRENCE_EXPORT_MAX_RECORDS and anonymous users are refused"""
+        with override_settings(OCCURRENCE_EXPORT_MAX_RECORDS=4):
+            self.assertEqual(self.client.get(self.url).status_code, 400)
+            self.assertEqual(self.client.get(self.url, {'year_min': 2001}).status_code, 200)
+        self.assertEqual(self.client.get(self.url, {'output': 'xml'}).status_code, 400)
+        self.client.force_authenticate(user=None)
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+
+
+@override_settings(URL_PREFIX=r'^data/')
+class OccurrenceLookupView(APITestCase):
+    """Test for API occurrence lookup"""
+
+    def setUp(self):
+        self.url = reverse('v1.0:occurrence-lookup')
+        for i in range(5):
+            GBIFOccurrence.objects.create(gbifID=i, scientificName='belgica antarctica', year=2000 + i)
+
+    def test_lookup_gbif_ids(self):
+        """Ensure that occurrences are returned in the order of the gbifIDs with the ids that are not found"""
+        response = self.client.post(self.url, {'gbifIds': ['3', 1, '42'], 'fields': ['year']}, format='json')
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(data, {'count': 2, 'results': [{'year': 2003}, {'year': 2001}], 'notFound': ['42']})
+
+    def test_lookup_ids(self):
+        """Ensure that occurrences are looked up by id in a single query"""
+        ids = list(GBIFOccurrence.objects.order_by('id').values_list('id', flat=True))
+        with self.assertNumQueries(1):
+            response = self.client.post(self.url, {'ids': ids[:2]}, format='json')
+        results = json.loads(response.content.decode('utf-8'))['results']
+        self.assertEqual([occurrence['id'] for occurrence in results], ids[:2])
+        self.assertEqual(len(results[0]), len(settings.OCCURRENCE_FIELDS))
+
+    def test_lookup_invalid(self):
+        """Ensure that a lookup needs either gbifIds or ids, within OCCURRENCE_LOOKUP_MAX_IDS"""
+        self.assertEqual(self.client.post(self.url, {}, format='json').status_code, 400)
+        self.assertEqual(self.client.post(self.url, {'ids': [1], 'gbifIds': ['1']}, format='json').status_code, 400)
+        with override_settings(OCCURRENCE_LOOKUP_MAX_IDS=2):
+            response = self.client.post(self.url, {'gbifIds': ['1', '2', '3']}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(URL_PREFIX=r'^data/')
+class OccurrenceAggregateView(APITestCase):
+    """Test for API occurrence aggregation"""
+
+    def setUp(self):
+        cache.clear()
+        self.url = reverse('v1.0:occurrence-aggregate')
+        self.dataset = Dataset.objects.create(dataset_key='aggregate', title='aggregate')
+        for i in range(6):
+            GBIFOccurrence.objects.create(gbifID=i, dataset=self.dataset, year=2000 + i % 2, speciesKey=str(i % 3),
+                                          depth=i * 60, scientificName='belgica antarctica')
+        OccurrenceCube.objects.rebuild([self.dataset.id])
+
+    def get_results(self, params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode('utf-8'))
+
+    def test_aggregate_from_cube(self):
+        """Ensure that an aggregation by cube dimensions is computed from OccurrenceCube and cached"""
+        GBIFOccurrence.objects.filter(dataset=self.dataset).delete()  # the cube is not rebuilt
+        data = self.get_results({'group_by': 'year', 'dataset': self.dataset.id})
+        self.assertEqual(data, {'groupBy': ['year'], 'truncated': False, 'results': [
+            {'year': 2000, 'count': 3, 'speciesCount': 3}, {'year': 2001, 'count': 3, 'speciesCount': 3}]})
+        OccurrenceCube.objects.all().delete()
+        self.assertEqual(self.get_results({'group_by': 'year', 'dataset': self.dataset.id}), data)
+
+    def test_aggregate_from_occurrences(self):
+        """Ensure that other aggregations are computed from GBIFOccurrence, depth by bins"""
+        data = self.get_results({'group_by': 'depth,species_key', 'scientific_name': 'belgica', 'depth_max': 250})
+        self.assertEqual([(row['depth'], row['speciesKey'], row['count']) for row in data['results']],
+                         [(0, '0', 1), (0, '1', 1), (100, '0', 1), (100, '2', 1), (200, '1', 1)])
+        with override_settings(OCCURRENCE_AGGREGATE_MAX_GROUPS=1):
+            data = self.get_results({'group_by': 'year', 'scientific_name': 'belgica'})
+        self.assertEqual(data['results'], [{'year': 2000, 'count': 3, 'speciesCount': 3}])
+        self.assertTrue(data['truncated'])
+
+    def test_aggregate_invalid(self):
+        """Ensure that group_by is required and limited to OCCURRENCE_AGGREGATE_DIMENSIONS"""
+        self.assertEqual(self.client.get(self.url).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {'group_by': 'scientific_name'}).status_code, 400)
 
 
 @override_settings(URL_PREFIX=r'^data/')
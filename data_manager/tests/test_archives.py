@@ -0,0 +1,169 @@
+from data_manager.archives import *
+from django.test import TestCase, override_settings
+from unittest.mock import patch, MagicMock
+import io
+import shutil
+import tempfile
+
+
+def make_zip():
+    """Return the bytes of a small zip file"""
+    content = io.BytesIO()
+    with zipfile.ZipFile(content, 'w') as archive:
+        archive.writestr('occurrence.txt', 'gbifID\tdatasetKey\n1\tdataset-a\n')
+    return content.getvalue()
+
+
+def mock_response(status_code, content):
+    """Return a mock of a streamed requests.Response"""
+    response = MagicMock()
+    response.__enter__.return_value = response
+    response.status_code = status_code
+    response.iter_content.return_value = [content]
+    return response
+
+
+class ArchiveDownloadTestCase(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.directory, 'key.zip')
+        self.content = make_zip()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @patch('data_manager.archives.requests.get')
+    def test_fetch_to_file_resume(self, mock_get):
+        """
+        Ensure that an existing .part file is resumed with an HTTP Range request
+        """
+        with open(self.file_path + '.part', 'wb') as handle:
+            handle.write(self.content[:10])
+        mock_get.return_value = mock_response(206, self.content[10:])
+        fetch_to_file('https://example.org/key.zip', self.file_path)
+        self.assertEqual(mock_get.call_args[1]['headers'], {'Range': 'bytes=10-'})
+        with open(self.file_path, 'rb') as handle:
+            self.assertEqual(handle.read(), self.content)
+        self.assertFalse(os.path.exists(self.file_path + '.part'))
+
+    @patch('data_manager.archives.requests.get')
+    def test_fetch_to_file_range_ignored(self, mock_get):
+        """
+        Ensure that the .part file is overwritten if the server does not support Range request
+        """
+        with open(self.file_path + '.part', 'wb') as handle:
+            handle.write(b'garbage')
+        mock_get.return_value = mock_response(200, self.content)
+        fetch_to_file('https://example.org/key.zip', self.file_path)
+        with open(self.file_path, 'rb') as handle:
+            self.assertEqual(handle.read(), self.content)
+
+    def test_verify_archive(self):
+        with open(self.file_path, 'wb') as handle:
+            handle.write(self.content)
+        verify_archive(self.file_path, len(self.content))
+        with self.assertRaises(ArchiveCorrupted):
+            verify_archive(self.file_path, len(self.content) + 1)
+        with open(self.file_path, 'wb') as handle:  # truncated zip
+            handle.write(self.content[:-30])
+        with self.assertRaises(ArchiveCorrupted):
+            verify_archive(self.file_path)
+
+    @patch('data_manager.archives.time.sleep')
+    @patch('data_manager.archives.requests.get')
+    def test_download_archive_retry(self, mock_get, mock_sleep):
+        """
+        Ensure that a dropped connection is retried and a failed archive raises ArchiveNotDownloaded
+        """
+        with override_settings(DOWNLOADS_DIR=self.directory, GBIF_DOWNLOAD_RETRIES=2):
+            mock_get.side_effect = [requests.exceptions.ConnectionError(), mock_response(200, self.content)]
+            archive = download_archive('key', 'https://example.org/key.zip', len(self.content))
+            self.assertEqual(archive, self.file_path)
+            mock_get.side_effect = requests.exceptions.ConnectionError()
+            with self.assertRaises(ArchiveNotDownloaded):
+                download_archive('other', 'https://example.org/other.zip')
+
+    @patch('data_manager.archives.time.sleep')
+    def test_bandwidth_limiter(self, mock_sleep):
+        limiter = BandwidthLimiter(1000)
+        limiter.consume(1000)  # within the bucket
+        mock_sleep.assert_not_called()
+        limiter.consume(500)
+        self.assertAlmostEqual(mock_sleep.call_args[0][0], 0.5, places=1)
+        BandwidthLimiter(0).consume(10 ** 9)  # no limit
+        self.assertEqual(mock_sleep.call_count, 1)
+
+
+class FakeRow(object):
+    def __init__(self, data):
+        self.data = data
+
+
+class FakeDwCAReader(object):
+    """Minimal stand-in of DwCAReader, iterate over rows of occurrence.txt"""
+    def __init__(self, dataset_uuids, rows):
+        self.source_metadata = {dataset_uuid: None for dataset_uuid in dataset_uuids}
+        self.descriptor = MagicMock()
+        self.descriptor.core.terms = set(term for row in rows for term in row)
+        self.rows = rows
+
+    def __iter__(self):
+        return iter(FakeRow(row) for row in self.rows)
+
+
+class PayloadCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        gbif_id = settings.GBIF_RESOURCE + 'gbifID'
+        dataset_key = settings.GBIF_RESOURCE + 'datasetKey'
+        last_crawled = settings.GBIF_RESOURCE + 'lastCrawled'
+        self.rows = [
+            {gbif_id: '1', dataset_key: 'dataset-a', last_crawled: '2021-01-01'},
+            {gbif_id: '2', dataset_key: 'dataset-a', last_crawled: '2021-01-01'},
+            {gbif_id: '3', dataset_key: 'dataset-b', last_crawled: '2021-01-01'},
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_payload_hashes(self):
+        """
+        Ensure that payload hash of a dataset does not depend on row order, crawl dates or the other datasets of the
+        archive but on its records
+        """
+        hashes = payload_hashes(FakeDwCAReader(['dataset-a', 'dataset-b'], self.rows))
+        self.assertEqual(set(hashes.keys()), {'dataset-a', 'dataset-b'})
+        recrawled = [dict(row, **{settings.GBIF_RESOURCE + 'lastCrawled': '2021-02-01'}) for row in self.rows]
+        self.assertEqual(hashes, payload_hashes(FakeDwCAReader(['dataset-a', 'dataset-b'], recrawled[::-1])))
+        edited = [dict(row) for row in self.rows]
+        edited[0][settings.GBIF_RESOURCE + 'gbifID'] = '4'
+        edited_hashes = payload_hashes(FakeDwCAReader(['dataset-a', 'dataset-b'], edited))
+        self.assertNotEqual(hashes['dataset-a'], edited_hashes['dataset-a'])
+        self.assertEqual(hashes['dataset-b'], edited_hashes['dataset-b'])
+        full_dataset_hashes = payload_hashes(FakeDwCAReader(['dataset-a', 'dataset-b'], self.rows),
+                                             {'dataset-a': True})
+        self.assertNotEqual(hashes['dataset-a'], full_dataset_hashes['dataset-a'])
+        self.assertEqual(hashes['dataset-b'], full_dataset_hashes['dataset-b'])
+        # the same dataset downloaded alone or with other datasets
+        alone = payload_hashes(FakeDwCAReader(['dataset-b'], self.rows[2:]))
+        self.assertEqual(alone, {'dataset-b': hashes['dataset-b']})
+
+    def test_cache_archive_eviction(self):
+        """
+        Ensure that archives are cached under each dataset and the least recently used archive is evicted first
+        """
+        archive = os.path.join(self.directory, 'key.zip')
+        other_archive = os.path.join(self.directory, 'other.zip')
+        for file_path in [archive, other_archive]:
+            with open(file_path, 'wb') as handle:
+                handle.write(b'0' * 100)
+        cache_dir = os.path.join(self.directory, 'cache')
+        with override_settings(ARCHIVE_CACHE_DIR=cache_dir, ARCHIVE_CACHE_MAX_SIZE=150):
+            old = cache_archive(archive, {'dataset-a': 'hash-1', 'dataset-b': 'hash-2'})
+            self.assertTrue(all(os.path.isfile(path) for path in old))
+            os.utime(old[0], (0, 0))  # links of the same archive
+            new = cache_archive(other_archive, {'dataset-a': 'hash-3'})  # 200 bytes in cache, evict the oldest
+            self.assertTrue(os.path.isfile(new[0]))
+            self.assertFalse(any(os.path.isfile(path) for path in old))
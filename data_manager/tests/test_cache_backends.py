@@ -0,0 +1,62 @@
+from data_manager.cache_backends import TwoTierCache, deserialize, serialize
+from django.core.cache import caches
+from django.test import TestCase
+from unittest import mock
+import threading
+import time
+
+
+class SerializeTestCase(TestCase):
+
+    def test_serialize(self):
+        """Ensure that integers are stored as text and large values are compressed"""
+        self.assertEqual(serialize(42), b'42')
+        large = ['occurrence'] * 1000
+        self.assertTrue(serialize(large).startswith(b'z'))
+        for value in [42, True, None, 'text', {'count': 1}, large]:
+            self.assertEqual(deserialize(serialize(value)), value)
+
+
+class TwoTierCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.cache = TwoTierCache('test', {'OPTIONS': {'SHARED': 'shared', 'LOCAL_MAX_ENTRIES': 2, 'LOCK_TIMEOUT': 5}})
+        self.cache.clear()
+
+    def test_local_tier(self):
+        """Ensure that reads are served by the local tier, which evicts the least recently used entry"""
+        self.cache.set('count:a', 1)
+        with mock.patch.object(caches['shared'], 'get') as shared_get:
+            self.assertEqual(self.cache.get('count:a'), 1)
+            shared_get.assert_not_called()
+        self.cache.set('count:b', 2)
+        self.cache.get('count:a')
+        self.cache.set('count:c', 3)  # evicts count:b from the local tier
+        self.assertEqual(self.cache.get('count:b'), 2)  # from the shared tier
+        self.assertEqual(self.cache.get('count:d'), None)
+        self.assertEqual(self.cache.metrics()['count'], (2, 1, 1))
+
+    def test_local_values_are_copies(self):
+        """Ensure that modifying a value returned by the cache does not modify the cached value"""
+        self.cache.set('facets', {'keyword': []})
+        self.cache.get('facets')['keyword'].append('penguin')
+        self.assertEqual(self.cache.get('facets'), {'keyword': []})
+
+    def test_get_or_set_single_flight(self):
+        """Ensure that a missing value is computed once by concurrent callers"""
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.3)
+            return 'value'
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.cache.get_or_set('slow', compute)))
+                   for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ['value'] * 3)
+        self.assertEqual(len(calls), 1)
@@ -0,0 +1,41 @@
+from data_manager.gbif_api import fetch_concurrently
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+import time
+
+
+CALLS = []
+
+
+def name_usage(key, timeout=None, **kwargs):
+    """Stand-in of species.name_usage"""
+    CALLS.append(key)
+    if key == 'slow':
+        time.sleep(0.5)
+    elif key == 'error':
+        raise ValueError('GBIF API error')
+    return {'key': key}
+
+
+class FetchConcurrentlyTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        CALLS.clear()
+
+    def test_fetch_concurrently_memoised(self):
+        """Ensure that responses are returned by name and cached calls are not sent again"""
+        calls = {'first': (name_usage, {'key': 1}, None), 'second': (name_usage, {'key': 2}, None)}
+        self.assertEqual(fetch_concurrently(calls), {'first': {'key': 1}, 'second': {'key': 2}})
+        self.assertEqual(fetch_concurrently(calls), {'first': {'key': 1}, 'second': {'key': 2}})
+        self.assertEqual(sorted(CALLS), [1, 2])
+
+    @override_settings(GBIF_API_PAGE_TIMEOUT=0.1)
+    def test_fetch_concurrently_default(self):
+        """Ensure that failed and slow calls return their default value and are not cached"""
+        calls = {'slow': (name_usage, {'key': 'slow'}, []), 'error': (name_usage, {'key': 'error'}, dict()),
+                 'ok': (name_usage, {'key': 'ok'}, None)}
+        self.assertEqual(fetch_concurrently(calls), {'slow': [], 'error': dict(), 'ok': {'key': 'ok'}})
+        fetch_concurrently(calls)
+        self.assertEqual(CALLS.count('error'), 2)
+        self.assertEqual(CALLS.count('ok'), 1)
@@ -0,0 +1,47 @@
+from data_manager.generations import bump_dataset_generations, bump_epoch, versioned_key
+from data_manager.helpers import occurrence_count_cache_key
+from django.core.cache import cache
+from django.http import QueryDict
+from django.test import TestCase
+
+
+class GenerationsTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_versioned_key_dataset_generations(self):
+        """Ensure that a key changes only when one of its datasets is bumped"""
+        key_1 = versioned_key('count', [1])
+        key_2 = versioned_key('count', [2])
+        self.assertEqual(versioned_key('count', [1]), key_1)
+        bump_dataset_generations([1])
+        self.assertNotEqual(versioned_key('count', [1]), key_1)
+        self.assertEqual(versioned_key('count', [2]), key_2)
+        self.assertNotEqual(versioned_key('count', [1, 2]), key_2)
+
+    def test_versioned_key_epoch(self):
+        """Ensure that keys built from all datasets change when any dataset is bumped"""
+        key = versioned_key('facets')
+        self.assertEqual(versioned_key('facets'), key)
+        bump_dataset_generations([1])
+        self.assertNotEqual(versioned_key('facets'), key)
+        key = versioned_key('facets')
+        bump_epoch()
+        self.assertNotEqual(versioned_key('facets'), key)
+
+    def test_evicted_generation(self):
+        """Ensure that a generation evicted from the cache does not restore the entries cached before"""
+        key = versioned_key('count', [1])
+        cache.delete('generation:dataset:1')
+        self.assertNotEqual(versioned_key('count', [1]), key)
+
+    def test_occurrence_count_cache_key(self):
+        """Ensure that the count of a search filtered by dataset is only invalidated by its datasets"""
+        by_dataset = occurrence_count_cache_key(QueryDict('dataset=1&page=2'))
+        by_year = occurrence_count_cache_key(QueryDict('start_year=2000'))
+        bump_dataset_generations([2])
+        self.assertEqual(occurrence_count_cache_key(QueryDict('dataset=1')), by_dataset)
+        self.assertNotEqual(occurrence_count_cache_key(QueryDict('start_year=2000')), by_year)
+        bump_dataset_generations([1])
+        self.assertNotEqual(occurrence_count_cache_key(QueryDict('dataset=1')), by_dataset)
@@ -1,4 +1,5 @@
-from data_manager.models import Download
+from data_manager.helpers import filter_occurrences_by_taxon, search_occurrences
+from data_manager.models import Dataset, Download, GBIFOccurrence
 from django.test import TestCase
 from django.http import QueryDict
 from json.decoder import JSONDecodeError
@@ -27,3 +28,38 @@ class DownloadClassMethodTestCase(TestCase):
             task_id='test-1', query='{"basisOfRecord": 1')  # lacks }
         with self.assertRaises(JSONDecodeError):
             download.get_query_dict()
+
+
+class GBIFOccurrenceSearchDocumentTestCase(TestCase):
+
+    def test_search_document(self):
+        """Ensure that search document is built on save and used for case insensitive partial match search"""
+        dataset = Dataset.objects.create(dataset_key='123', title='Antarctic Dataset')
+        occurrence = GBIFOccurrence.objects.create(gbifID=1, scientificName='Belgica antarctica', locality='Signy Island',
+                                                   dataset=dataset, dataset_title=dataset.title)
+        self.assertEqual(occurrence.search_document, 'belgica antarctica signy island antarctic dataset')
+        self.assertTrue(search_occurrences(GBIFOccurrence.objects.all(), 'BELGICA  Antarctica').exists())
+        self.assertTrue(search_occurrences(GBIFOccurrence.objects.all(), 'signy isl').exists())
+        self.assertFalse(search_occurrences(GBIFOccurrence.objects.all(), 'orca').exists())
+
+
+class GBIFOccurrenceTaxonAncestryTestCase(TestCase):
+
+    def test_taxon_ancestry(self):
+        """Ensure that taxon ancestry is built on save and selects the occurrences of a taxon of any rank"""
+        occurrence = GBIFOccurrence.objects.create(gbifID=1, kingdomKey='1', phylumKey='54', classKey='216',
+                                                   genusKey='1573', speciesKey='1573599', taxonKey='1573599')
+        GBIFOccurrence.objects.create(gbifID=2, kingdomKey='1', phylumKey='52', taxonKey='52')
+        self.assertEqual(occurrence.taxon_ancestry, [1, 54, 216, 1573, 1573599])
+        self.assertEqual(filter_occurrences_by_taxon(GBIFOccurrence.objects.all(), '1').count(), 2)
+        self.assertEqual(list(filter_occurrences_by_taxon(GBIFOccurrence.objects.all(), '1573')), [occurrence])
+        self.assertFalse(filter_occurrences_by_taxon(GBIFOccurrence.objects.all(), 'not a key').exists())
+
+    def test_taxon_ancestry_saved(self):
+        """Ensure that taxon ancestry is rebuilt and stored when an occurrence is saved"""
+        occurrence = GBIFOccurrence(gbifID=3, kingdomKey='1', phylumKey='54', taxonKey='not a key')
+        occurrence.save()
+        self.assertEqual(GBIFOccurrence.objects.get(gbifID=3).taxon_ancestry, [1, 54])
+        occurrence.speciesKey = '1573599'
+        occurrence.save()
+        self.assertEqual(GBIFOccurrence.objects.get(gbifID=3).taxon_ancestry, [1, 54, 1573599])
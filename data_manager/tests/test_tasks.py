@@ -51,6 +51,7 @@ class GenerateDownloadFile(TestCase):
     def setUp(self):
         user = User.objects.create_user(**TEST_USER_1)
         user.save()
+        Dataset.objects.update_search_vector()  # fixtures are not imported from EML
 
     def test_generate_occurrence_download_file_success(self):
         """Ensure download file is generated for Dataset query"""
@@ -94,3 +95,16 @@ class GenerateDownloadFile(TestCase):
                 content = byte_lines.splitlines()[1]  # second line
                 content_str = content.decode('utf-8')
                 self.assertEqual(content_str, '21,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,20.0,120.0,,,,belgica antarctica,,,,,,,,,,,,,,antarctic-dataset,2')
+
+    def test_generate_download_file_fields(self):
+        """Ensure that only the fields of the Download are written"""
+        user = User.objects.get(username=TEST_USER_1.get('username'))
+        query = {'q': ['antarctic dataset'], 'data_type': [2]}
+        download = Download.objects.create(user=user, query=query, fields=['decimalLongitude', 'scientificName'])
+        task_id = prepare_download('Dataset', user_id=user.id, download_link='http://testserver', download_id=download.id)
+        download = Download.objects.get(task_id=task_id, user=user, query=query)
+        self.assertEqual(list(download.dataset.values_list('dataset_key', flat=True)), ['antarctic-dataset'])
+        with zipfile.ZipFile(download.file) as myzip:
+            with myzip.open('None.csv', 'r') as myfile:
+                lines = myfile.read().decode('utf-8').splitlines()
+                self.assertEqual(lines, ['decimalLongitude,scientificName', '120.0,belgica antarctica'])
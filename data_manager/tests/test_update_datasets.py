@@ -1,7 +1,10 @@
 from data_manager.management.commands.update_datasets import *
 from data_manager.models import Dataset
 from django.test import TestCase, override_settings
+from unittest.mock import patch
+import datetime
 import os
+import requests
 import shutil
 import tempfile
 
@@ -68,3 +71,141 @@ class UpdateDatasetFunctionsTestCase(TestCase):
         dataset = Dataset.objects.get(dataset_key="7b5a19ba-f762-11e1-a439-00145eb45e9a")
         harvested_dataset = HarvestedDataset.objects.get(key="7b5a19ba-f762-11e1-a439-00145eb45e9a")
         self.assertEqual(harvested_dataset.dataset_id, dataset.id)
+
+    @patch('data_manager.management.commands.import_datasets.registry.datasets')
+    def test_detect_dataset_changes(self, mock_datasets):
+        """
+        Ensure that each dataset is classified as deleted, modified or unchanged with one registry request per dataset
+        and HarvestedDataset of deleted datasets are flagged.
+        """
+        registry_records = {
+            '7b5a19ba-f762-11e1-a439-00145eb45e9a': {'deleted': '2018-01-01T00:00:00.000+0000'},
+            'ebe73e19-11eb-48d2-9263-fb0caa3b7b5a': {'modified': '2020-01-01T00:00:00.000+0000'},
+            '5fd3c4e8-3f48-4f2e-9a2a-0b9b3b1a6c11': {'modified': '2000-01-01T00:00:00.000+0000'},
+        }
+        mock_datasets.side_effect = lambda uuid, **kwargs: registry_records[uuid]
+        Dataset.objects.filter(dataset_key='ebe73e19-11eb-48d2-9263-fb0caa3b7b5a')\
+            .update(download_on=datetime.datetime(2019, 1, 1))
+        Dataset.objects.create(title='Unchanged dataset', dataset_key='5fd3c4e8-3f48-4f2e-9a2a-0b9b3b1a6c11',
+                               download_on=datetime.datetime(2019, 1, 1))
+        changes = detect_dataset_changes(Dataset.objects.all())
+        self.assertEqual(mock_datasets.call_count, 3)
+        self.assertEqual(changes[Dataset.DELETED], {'7b5a19ba-f762-11e1-a439-00145eb45e9a'})
+        self.assertEqual(changes[Dataset.MODIFIED], {'ebe73e19-11eb-48d2-9263-fb0caa3b7b5a'})
+        self.assertEqual(changes[Dataset.UNCHANGED], {'5fd3c4e8-3f48-4f2e-9a2a-0b9b3b1a6c11'})
+        self.assertTrue(HarvestedDataset.objects.filter(key='7b5a19ba-f762-11e1-a439-00145eb45e9a',
+                                                        deleted_from_gbif=True, include_in_antabif=False).exists())
+        self.assertTrue(HarvestedDataset.objects.filter(key='ebe73e19-11eb-48d2-9263-fb0caa3b7b5a',
+                                                        deleted_from_gbif=False, include_in_antabif=True).exists())
+
+    @patch('data_manager.management.commands.import_datasets.registry.datasets')
+    def test_detect_dataset_changes_registry_error(self, mock_datasets):
+        """
+        Ensure that a dataset which registry record could not be retrieved is considered unchanged
+        """
+        mock_datasets.side_effect = requests.exceptions.HTTPError('503 Server Error')
+        changes = detect_dataset_changes(Dataset.objects.all())
+        self.assertEqual(changes[Dataset.UNCHANGED], {'7b5a19ba-f762-11e1-a439-00145eb45e9a',
+                                                      'ebe73e19-11eb-48d2-9263-fb0caa3b7b5a'})
+        self.assertFalse(HarvestedDataset.objects.filter(deleted_from_gbif=True).exists())
+
+    def test_import_archive_delete_archive(self):
+        """
+        Ensure that archive is deleted after import, even if it is not a valid darwin core archive
+        """
+        temp_dir = tempfile.mkdtemp()
+        archive = os.path.join(temp_dir, '0000000-000000000000000.zip')
+        with open(archive, 'w+') as f:
+            f.write('not a zip file')
+        import_archive(archive)
+        self.assertFalse(os.path.isfile(archive))
+        shutil.rmtree(temp_dir)
+
+    @override_settings(GBIF_MAX_CONCURRENT_DOWNLOADS=2)
+    @patch('data_manager.management.commands.update_datasets.connections')  # keep the connection of the test case
+    @patch('data_manager.management.commands.update_datasets.mp.Pool')
+    @patch('data_manager.management.commands.update_datasets.download_archive')
+    @patch('data_manager.management.commands.update_datasets.occurrences.download_meta')
+    @patch('data_manager.management.commands.update_datasets.get_download_key')
+    def test_download_and_import(self, mock_get_download_key, mock_download_meta, mock_download_archive, mock_pool,
+                                 mock_connections):
+        """
+        Ensure that a download is requested for every dataset and each archive is handed to the import pool once it is
+        downloaded
+        """
+        dataset_uuids = ['dataset-{}'.format(i) for i in range(5)]
+        mock_get_download_key.side_effect = lambda batch: 'key-' + '-'.join(batch)
+        mock_download_meta.side_effect = lambda key, **kwargs: \
+            {'status': 'SUCCEEDED', 'downloadLink': 'https://example.org/{}.zip'.format(key)}
+        mock_download_archive.side_effect = lambda key, link, size, limiter: key + '.zip'
+        pool = mock_pool.return_value.__enter__.return_value
+        with patch('data_manager.management.commands.update_datasets.time.sleep') as mock_sleep:
+            downloaded = download_and_import(dataset_uuids)
+        self.assertEqual(downloaded, 5)
+        self.assertEqual(mock_get_download_key.call_count, 5)
+        self.assertEqual(pool.apply_async.call_count, 5)
+        pool.apply_async.assert_any_call(import_archive, ('key-dataset-0.zip',))
+        mock_sleep.assert_not_called()  # all downloads succeeded at the first poll
+
+    @patch('data_manager.management.commands.update_datasets.connections')
+    @patch('data_manager.management.commands.update_datasets.mp.Pool')
+    @patch('data_manager.management.commands.update_datasets.download_archive')
+    @patch('data_manager.management.commands.update_datasets.occurrences.download_meta')
+    @patch('data_manager.management.commands.update_datasets.get_download_key')
+    def test_download_and_import_batches(self, mock_get_download_key, mock_download_meta, mock_download_archive,
+                                         mock_pool, mock_connections):
+        """
+        Ensure that datasets are grouped in a single download per batch
+        """
+        dataset_uuids = ['dataset-{}'.format(i) for i in range(5)]
+        mock_get_download_key.side_effect = lambda batch: 'key-' + batch[0]
+        mock_download_meta.side_effect = lambda key, **kwargs: \
+            {'status': 'SUCCEEDED', 'downloadLink': 'https://example.org/{}.zip'.format(key)}
+        mock_download_archive.side_effect = lambda key, link, size, limiter: key + '.zip'
+        pool = mock_pool.return_value.__enter__.return_value
+        with patch('data_manager.management.commands.update_datasets.time.sleep'):
+            downloaded = download_and_import(dataset_uuids, datasets_per_download=2)
+        self.assertEqual(downloaded, 3)
+        requested = [call[0][0] for call in mock_get_download_key.call_args_list]
+        self.assertEqual(requested, [['dataset-0', 'dataset-1'], ['dataset-2', 'dataset-3'], ['dataset-4']])
+        self.assertEqual(pool.apply_async.call_count, 3)
+
+    @patch('data_manager.management.commands.update_datasets.connections')
+    @patch('data_manager.management.commands.update_datasets.mp.Pool')
+    @patch('data_manager.management.commands.update_datasets.download_archive')
+    @patch('data_manager.management.commands.update_datasets.occurrences.download_meta')
+    @patch('data_manager.management.commands.update_datasets.get_download_key')
+    def test_download_and_import_failure(self, mock_get_download_key, mock_download_meta, mock_download_archive,
+                                         mock_pool, mock_connections):
+        """
+        Ensure that an archive which can not be written or fetched does not stop the other downloads
+        """
+        dataset_uuids = ['dataset-{}'.format(i) for i in range(3)]
+        mock_get_download_key.side_effect = lambda batch: 'key-' + batch[0]
+        mock_download_meta.side_effect = lambda key, **kwargs: \
+            {'status': 'SUCCEEDED', 'downloadLink': 'https://example.org/{}.zip'.format(key)}
+        errors = {'key-dataset-0': OSError('No space left on device'),
+                  'key-dataset-1': requests.ConnectionError('Connection reset')}
+
+        def download(key, link, size, limiter):
+            if key in errors:
+                raise errors[key]
+            return key + '.zip'
+        mock_download_archive.side_effect = download
+        pool = mock_pool.return_value.__enter__.return_value
+        with patch('data_manager.management.commands.update_datasets.time.sleep'):
+            downloaded = download_and_import(dataset_uuids)
+        self.assertEqual(downloaded, 1)
+        pool.apply_async.assert_called_once_with(import_archive, ('key-dataset-2.zip',))
+
+    @patch('data_manager.management.commands.update_datasets.occurrences.download')
+    def test_get_download_key_multiple_datasets(self, mock_download):
+        """
+        Ensure that multiple datasets are requested in a single download with "or" predicate
+        """
+        mock_download.return_value = ('0098562-160910150852091', {})
+        download_key = get_download_key({'dataset-b', 'dataset-a'})
+        self.assertEqual(download_key, '0098562-160910150852091')
+        args, kwargs = mock_download.call_args
+        self.assertEqual(args[0], ['datasetKey = dataset-a', 'datasetKey = dataset-b'])
+        self.assertEqual(kwargs['pred_type'], 'or')
@@ -1,13 +1,15 @@
 # -*- coding: utf-8 -*-
-from collections import defaultdict
 from data_manager.models import *
 from django.conf import settings
 from django.contrib.gis.geos import GEOSGeometry
 from django.contrib.messages import get_messages
 from django.core import mail
+from django.core.cache import cache
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase, tag, override_settings, Client
+from django.test.utils import CaptureQueriesContext
 from django.utils.six import StringIO
 from django.urls import reverse
 from django.contrib.auth import get_user_model
@@ -179,6 +181,7 @@ class DownloadDatasetAsyncTest(TestCase):
     def setUp(self):
         """Create Dataset, Occurrence and User objects for test"""
         User.objects.create_user(**TEST_USER_1)
+        Dataset.objects.update_search_vector()  # fixtures are not imported from EML
 
     def test_objects_created(self):
         """Ensure objects are created"""
@@ -299,6 +302,9 @@ class DatasetListViewTest(TestCase):
     """Ensure Dataset ListView returns correct QuerySet"""
     fixtures = ['datasetlistview_fixtures.json']
 
+    def setUp(self):
+        Dataset.objects.update_search_vector()  # fixtures are not imported from EML
+
     def test_person_objects_created(self):
         """Ensure that Person and PersonTypeRole objects are created correctly"""
         person_1 = Person.objects.get(full_name="Person 1", email="person1@email.com")
@@ -391,6 +397,40 @@ class DatasetListViewTest(TestCase):
         response = self.client.get(url, {'q': '', 'project_contact': project_contact.id}, follow=True)
         self.assertContains(response, '<input type="checkbox" name="project_contact" value="{}" id="id_project_contact_0" checked />'.format(project_contact.id), status_code=200, html=True)
 
+    def test_dataset_full_text_search(self):
+        """Ensure that web search syntax is supported and search terms are highlighted in abstract"""
+        url = reverse('dataset-search')
+        response = self.client.get(url, {'q': '"dataset abstract" -first'})
+        self.assertContains(response, "Second dataset title", status_code=200, html=True)
+        self.assertNotContains(response, "First dataset title", html=True)
+        self.assertContains(response, "Second <mark>dataset</mark> <mark>abstract</mark>")
+        # personnel and keyword are searchable
+        response = self.client.get(url, {'q': 'RBINS'})
+        self.assertContains(response, "Second dataset title", status_code=200, html=True)
+        response = self.client.get(url, {'q': '"Person 1"'})
+        self.assertContains(response, "First dataset title", status_code=200, html=True)
+        self.assertNotContains(response, "Second dataset title", html=True)
+
+    def test_dataset_list_view_query_budget(self):
+        """Ensure that the number of queries does not depend on the number of facets selected"""
+        dataset_1 = Dataset.objects.get(title="First dataset title")
+        project_contact = Person.objects.get(personTypeRole__person_type="personnel", personTypeRole__dataset=dataset_1)
+        url = reverse('dataset-search')
+        cache.clear()
+        with CaptureQueriesContext(connection) as one_facet:
+            self.client.get(url, {'data_type': dataset_1.data_type_id})
+        cache.clear()
+        with CaptureQueriesContext(connection) as all_facets:
+            response = self.client.get(url, {'data_type': dataset_1.data_type_id, 'keyword': 'Occurrence',
+                                             'publisher': dataset_1.publisher_id,
+                                             'project_contact': project_contact.id})
+        self.assertContains(response, "First dataset title", status_code=200, html=True)
+        self.assertEqual(len(one_facet), len(all_facets))
+        with CaptureQueriesContext(connection) as cached:  # facets are cached
+            self.client.get(url, {'data_type': dataset_1.data_type_id, 'keyword': 'Occurrence',
+                                  'publisher': dataset_1.publisher_id, 'project_contact': project_contact.id})
+        self.assertLess(len(cached), len(all_facets))
+
     def test_ensure_download_button_in_template(self):
         """Ensure that download button is in template"""
         url = reverse('dataset-search')
@@ -420,14 +460,29 @@ class DatasetDetailViewTest(TestCase):
         url = reverse('dataset-detail-view', args=(dataset.id,))
         response = self.client.get(url)
         self.assertEqual(response.context['doi'], '10.15468/gouexm')
-        self.assertQuerysetEqual(response.context['contacts'], ['<Person: Els De Bie>'])
-        self.assertQuerysetEqual(response.context['contributors'], ['<Person: Els De Bie>', '<Person: Dimitri Brosens>', '<Person: Peter Desmet>'], ordered=False)
+        self.assertEqual(response.context['contacts'], [{'full_name': 'Els De Bie'}])
+        self.assertCountEqual([person['full_name'] for person in response.context['contributors']], ['Els De Bie', 'Dimitri Brosens', 'Peter Desmet'])
         self.assertEqual(response.context['alternate_links'], ['http://data.inbo.be/ipt/resource?r=inboveg-niche-vlaanderen-events'])
         self.assertEqual(response.context['citation'], "De Bie E, Brosens D, Desmet P (2016). InboVeg - NICHE-Vlaanderen groundwater related vegetation relevés for Flanders, Belgium. Version 1.6. Research Institute for Nature and Forest (INBO). Sampling event dataset https://doi.org/10.15468/gouexm")
-        self.assertEqual(response.context['keywords'], defaultdict(None, {'GBIF Dataset Type Vocabulary: http://rs.gbif.org/vocabulary/gbif/dataset_type.xml': ['Samplingevent'], 'n/a': ['WATINA', 'groundwater dependent vegetation', 'relevés', 'terrestrial survey']}))
-        self.assertQuerysetEqual(response.context['organizations'], ["('Dimitri Brosens', 'Research Institute for Nature and Forest (INBO)')", "('Els De Bie', 'Research Institute for Nature and Forest (INBO)')", "('Peter Desmet', 'Research Institute for Nature and Forest (INBO)')"], ordered=False)
+        self.assertEqual(response.context['keywords'], {'GBIF Dataset Type Vocabulary: http://rs.gbif.org/vocabulary/gbif/dataset_type.xml': ['Samplingevent'], 'n/a': ['WATINA', 'groundwater dependent vegetation', 'relevés', 'terrestrial survey']})
+        for person in response.context['contributors']:
+            self.assertEqual(person['organizations'], ['Research Institute for Nature and Forest (INBO)'])
         self.assertTemplateUsed(response, 'dataset-detail.html')
 
+    def test_dataset_detail_built_at_import(self):
+        """
+        Ensure the detail document is built by the import and the page does not query contributors and keywords
+        """
+        dataset = Dataset.objects.get(dataset_key='3d1231e8-2554-45e6-b354-e590c56ce9a8')
+        self.assertEqual(dataset.detail, dataset.build_detail())
+        url = reverse('dataset-detail-view', args=(dataset.id,))
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        tables = ' '.join(query['sql'] for query in queries.captured_queries)
+        self.assertNotIn('data_manager_persontyperole', tables)
+        self.assertNotIn('data_manager_keyword', tables)
+        self.assertNotIn('data_manager_hexgrid', tables)
+
     def test_occurrence_dataset_template(self):
         """
         Ensure download button is rendered with the link to download for occurrence dataset
@@ -558,6 +613,20 @@ class HomePageViewTest(TestCase):
         self.assertEqual(response.context['total_occurrences'], 35)
         self.assertEqual(response.context['GEOSERVER_HOST'], settings.GEOSERVER_HOST)
 
+    def test_home_page_statistics_snapshot(self):
+        """Ensure home page serves the latest statistics snapshot without aggregate queries"""
+        statistics = Statistics.objects.compute()
+        self.assertEqual(statistics.datasets_per_data_type, {'Occurrence': 1, 'Metadata': 1, 'Sampling Event': 1,
+                                                             'Checklist': 1})
+        Dataset.objects.create(dataset_key=uuid.uuid4(), filtered_record_count=5)  # not in snapshot until next import
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('home'))
+        self.assertEqual(response.context['total_datasets'], 4)
+        self.assertEqual(response.context['total_occurrences'], 35)
+        self.assertEqual(response.context['last_updated'], statistics.created_at)
+        self.assertFalse([query for query in queries.captured_queries
+                          if 'COUNT(' in query['sql'] or 'SUM(' in query['sql']])
+
     def test_home_page_template(self):
         """Ensure that context are rendered in template"""
         url = reverse('home')
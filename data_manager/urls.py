@@ -91,8 +91,15 @@ api_download_url_patterns = [
     re_path(r'^download/(?P<pk>[0-9]+)/$', DownloadRetrieveDestroyAPIView.as_view(), name='download-detail'),
 ]
 
+api_export_url_patterns = [
+    re_path(r'^occurrence/export/$', OccurrenceExportView.as_view(), name='occurrence-export'),
+    re_path(r'^occurrence/lookup/$', OccurrenceLookupView.as_view(), name='occurrence-lookup'),
+    re_path(r'^occurrence/aggregate/$', OccurrenceAggregateView.as_view(), name='occurrence-aggregate'),
+]
+
 # v1.0 API url patterns
 api_v1_url_patterns = []
+api_v1_url_patterns += api_export_url_patterns  # before router.urls, which would match them as an occurrence id
 api_v1_url_patterns += router.urls
 api_v1_url_patterns += api_download_url_patterns
 
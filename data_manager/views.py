@@ -6,7 +6,6 @@ from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.sites.shortcuts import get_current_site
 from django.core.cache.utils import make_template_fragment_key
 from django.core.mail import EmailMessage
-from django.db.models import Count, Sum
 from django.http import HttpResponse, Http404
 from django.views import View
 from django.views.generic import ListView, TemplateView
@@ -20,11 +19,12 @@ from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode
 from data_manager.forms import *
 from data_manager.models import *
 from data_manager.helpers import get_dataset_queryset_from_form, get_occurrence_queryset_from_form, \
-    create_download_file
+    create_download_file, filter_occurrences_by_taxon, get_dataset_headlines
+from data_manager.gbif_api import fetch_concurrently
+from data_manager.generations import versioned_key
 from data_manager.tasks import prepare_download
 
 from data_manager.tokens import account_activation_token
-from collections import defaultdict
 from datetime import datetime, timedelta
 from pygbif import species, registry, occurrences
 import logging
@@ -57,9 +57,10 @@ class DatasetDownloadView(View):
         Asynchronous download - download will be put into queue (Redis)
         Login required. Celery will be used to execute the tasks.
         """
-        response = DatasetListView.as_view()(request)
         # !! Passing QuerySet to celery task will raise EncodeError: Object of type QuerySet is not JSON serializable
         dataset_qs, form = get_dataset_queryset_from_form(request.GET)
+        # render the search results without filtering the datasets again
+        response = DatasetListView.as_view(dataset_filter=(dataset_qs, form))(request)
         qs = GBIFOccurrence.objects.filter(dataset__in=dataset_qs)
         record_count = qs.count()
         if record_count == 0:
@@ -123,14 +124,25 @@ class DatasetListView(ListView):
     model = Dataset
     template_name = 'dataset-list.html'
     paginate_by = 20
+    dataset_filter = None  # (queryset, form) returned by get_dataset_queryset_from_form if already computed
 
     def get_queryset(self):
-        qs, self.form = get_dataset_queryset_from_form(self.request.GET)
+        if self.dataset_filter is not None:
+            qs, self.form = self.dataset_filter
+        else:
+            qs, self.form = get_dataset_queryset_from_form(self.request.GET)
         return qs.prefetch_related('data_type', 'project', 'publisher')
 
     def get_context_data(self, **kwargs):
         context = super(DatasetListView, self).get_context_data(**kwargs)
         context['form'] = self.form
+        # highlight search terms in the datasets displayed only
+        q = getattr(self.form, 'cleaned_data', dict()).get('q')
+        if q and context['page_obj'] is not None:
+            datasets = context['page_obj'].object_list
+            headlines = get_dataset_headlines([dataset.id for dataset in datasets], q)
+            for dataset in datasets:
+                dataset.headline = headlines.get(dataset.id)
         return context
 
 
@@ -158,14 +170,6 @@ class DatasetDetailView(DetailView):
         except AttributeError:
             context['doi'] = ''
             pass
-        try:
-            context['contacts'] = Person.objects.filter(personTypeRole__dataset_id=self.object.id, personTypeRole__person_type='contact')
-        except TypeError:
-            context['contact'] = None
-            pass
-        except AttributeError:
-            context['contacts'] = None
-            pass
         try:
             context['alternate_links'] = [link for link in self.object.alternate_identifiers if link.startswith('http')]
         except TypeError:
@@ -182,22 +186,16 @@ class DatasetDetailView(DetailView):
         except AttributeError:
             context['citation'] = None
             pass
-        context['keywords'] = defaultdict(list)
-        for keyword in Keyword.objects.filter(dataset__id=self.object.id):
-            try:
-                context['keywords'][keyword.thesaurus].append(keyword.keyword)
-            except AttributeError:
-                pass
-        # The template variable resolution algorithm in Django will attempt to resolve
-        # new_data.items as new_data['items'] first, which resolves to an empty list when using
-        # defaultdict(list). To disable the defaulting to an empty list and have Django fail on new_data['items']
-        # then continue the resolution attempts until calling new_data.items(),
-        # the default_factory attribute of defaultdict can be set to None.
-        context['keywords'].default_factory = None
-        context['contributors'] = Person.objects.filter(personTypeRole__dataset_id=self.object.id).annotate(field_count=Count('personTypeRole__person_type')).order_by('-field_count')
-        context['organizations'] = PersonTypeRole.objects.filter(dataset_id=self.object.id).values_list('person__full_name', 'organization').distinct()
+        # contacts, keywords and contributors do not change until the dataset is re-imported, see Dataset.detail
+        detail = self.object.detail
+        if detail is None:  # dataset created without import_eml()
+            detail = self.object.build_detail()
+            Dataset.objects.filter(pk=self.object.pk).update(detail=detail)
+        context['contacts'] = detail['contacts']
+        context['keywords'] = detail['keywords']
+        context['contributors'] = detail['contributors']
         context['GEOSERVER_HOST'] = settings.GEOSERVER_HOST
-        context['has_grid'] = HexGrid.objects.filter(GBIFOccurrence__dataset_id=self.object.id).exists()
+        context['has_grid'] = self.object.has_grid
         return context
 
 
@@ -212,7 +210,8 @@ def occurrence_list_view_async(request):
     # to avoid the form from re-querying for form.fields['basis_of_record'].queryset & form.fields['dataset'].queryset
     # for every page. See more: https://docs.djangoproject.com/en/1.11/topics/cache/#template-fragment-caching
     cache_url = re.sub(r'\&page\=\d+', '', request.META.get('QUERY_STRING'))
-    key = make_template_fragment_key('formcache', cache_url)
+    # form choices are built from all datasets
+    key = versioned_key(make_template_fragment_key('formcache', cache_url))
     qs, form, latitude_range, longitude_range = get_occurrence_queryset_from_form(request.GET)
     context['form'] = form
     context['key'] = key
@@ -228,15 +227,19 @@ class HomePageView(TemplateView):
         """
         Display statistics from database at home page
         """
-        all_datasets = Dataset.objects.all().prefetch_related('data_type')
+        statistics = Statistics.objects.current()  # computed at the end of import_datasets
+        datasets_per_data_type = statistics.datasets_per_data_type
 
         context = super(HomePageView, self).get_context_data(**kwargs)
-        context['total_datasets'] = all_datasets.count()
-        context['occurrence_datasets_count'] = all_datasets.filter(data_type__data_type='Occurrence').count()
-        context['checklists_count'] = all_datasets.filter(data_type__data_type='Checklist').count()
-        context['event_datasets_count'] = all_datasets.filter(data_type__data_type='Sampling Event').count()
-        context['metadata_datasets_count'] = all_datasets.filter(data_type__data_type='Metadata').count()
-        context['total_occurrences'] = all_datasets.aggregate(Sum('filtered_record_count'))['filtered_record_count__sum']
+        context['total_datasets'] = statistics.dataset_count
+        context['occurrence_datasets_count'] = datasets_per_data_type.get('Occurrence', 0)
+        context['checklists_count'] = datasets_per_data_type.get('Checklist', 0)
+        context['event_datasets_count'] = datasets_per_data_type.get('Sampling Event', 0)
+        context['metadata_datasets_count'] = datasets_per_data_type.get('Metadata', 0)
+        context['total_occurrences'] = statistics.occurrence_count
+        context['species_count'] = statistics.species_count
+        context['publisher_count'] = statistics.publisher_count
+        context['last_updated'] = statistics.created_at
         context['GEOSERVER_HOST'] = settings.GEOSERVER_HOST
 
         return context
@@ -267,18 +270,24 @@ def taxonListView(request):
         q = form.cleaned_data.get('q', '')
         backbone = form.cleaned_data.get('backbone', '')
         # datasetKey points to GBIF taxonomic backbone and WoRMS
-        if backbone:
-            r = species.name_lookup(q=q, limit=20, offset=offset, datasetKey=backbone)
-        else:
-            r = species.name_lookup(q=q, limit=20, offset=offset, datasetKey=['2d59e5db-57ad-41ff-97d6-11f5fb264527', 'd7dddbf4-2cf0-4f39-9b2a-bb099caae36c'])  # if q is '', API returns all taxa
+        dataset_key = backbone or ['2d59e5db-57ad-41ff-97d6-11f5fb264527', 'd7dddbf4-2cf0-4f39-9b2a-bb099caae36c']
+        r = fetch_concurrently({
+            'lookup': (species.name_lookup, {'q': q, 'limit': 20, 'offset': offset, 'datasetKey': dataset_key}, dict())
+        })['lookup']  # if q is '', API returns all taxa
         results = r.get('results', None)
         if results:
+            # title of the source datasets and parents of all results in a single round trip
+            calls = dict()
             for result in results:
                 source_uuid = result.get('datasetKey', '')
-                dataset_title = registry.datasets(uuid=source_uuid).get('title', '')
-                source_title_dict[source_uuid] = dataset_title
+                calls[('dataset', source_uuid)] = (registry.datasets, {'uuid': source_uuid}, dict())
                 key = result.get('key')
-                result['higherClassificationMap'] = species.name_usage(key=key, data='parents')
+                calls[('parents', key)] = (species.name_usage, {'key': key, 'data': 'parents'}, [])
+            responses = fetch_concurrently(calls)
+            for result in results:
+                source_uuid = result.get('datasetKey', '')
+                source_title_dict[source_uuid] = responses[('dataset', source_uuid)].get('title', '')
+                result['higherClassificationMap'] = responses[('parents', result.get('key'))]
     # context
     context = dict()
     context['form'] = form
@@ -300,14 +309,27 @@ def taxonDetailView(request, key):
     :param key: GBIF taxonKey of specific taxon
     :return: TemplateResponse with context of specific taxon
     """
-    taxon_result = species.name_usage(key=key)
+    # GBIF API calls are sent concurrently, in two round trips as the media and the source dataset depend on the taxon
+    responses = fetch_concurrently({
+        'taxon': (species.name_usage, {'key': key}, {'key': key}),
+        'parents': (species.name_usage, {'key': key, 'data': 'parents'}, []),  # return list of dicts
+        'children': (species.name_usage, {'key': key, 'data': 'children', 'limit': 20}, dict()),  # direct children
+    })
+    taxon_result = responses['taxon']
     source_uuid = taxon_result.get('datasetKey')
     references = taxon_result.get('references', '')
     gbif_taxon_key = taxon_result.get('nubKey', '')  # nubKey = key of the taxon in GBIF Taxonomy Backbone
+    calls = dict()
+    if source_uuid:
+        calls['dataset'] = (registry.datasets, {'uuid': source_uuid}, dict())
+    if gbif_taxon_key:
+        calls['media'] = (occurrences.search, {'country': 'AQ', 'taxonKey': gbif_taxon_key, 'mediatype': 'stillImage',
+                                               'limit': 10}, dict())
+    responses.update(fetch_concurrently(calls))
     media_links = None
     # MEDIA
     if gbif_taxon_key:
-        gbif_occ = occurrences.search(country='AQ', taxonKey=gbif_taxon_key, mediatype="stillImage", limit=10).get('results', None)
+        gbif_occ = responses['media'].get('results', None)
         media_links = set()
         if gbif_occ:
             for record in gbif_occ:
@@ -317,26 +339,19 @@ def taxonDetailView(request, key):
                     if len(media_links) != 10:
                         media_links.add(identifier)
     # PARENTS
-    parents_request = species.name_usage(key=key, data='parents')  # return list of dicts
+    parents_request = responses['parents']
     # DIRECT CHILDREN
-    children_request = species.name_usage(key=key, data='children', limit=20)
+    children_request = responses['children']
     children = children_request.get('results', None)
     end_of_records = children_request.get('endOfRecords', True)
     # AQ OCC
-    rank = taxon_result.get('rank', '')
-    if rank in ['KINGDOM', 'PHYLUM', 'CLASS', 'ORDER', 'FAMILY', 'GENUS', 'SUBGENUS', 'SPECIES']:
-        rank = rank.lower()
-        field = '{}Key'.format(rank)
-        kwargs = {'{}'.format(field): key}
-        has_occurrence = GBIFOccurrence.objects.filter(**kwargs).exists()
-    else:
-        has_occurrence = False
+    has_occurrence = filter_occurrences_by_taxon(GBIFOccurrence.objects.all(), key).exists()
     # CONTEXT
     context = dict()
     context['taxon'] = taxon_result
     context['parents'] = parents_request
     context['references'] = references
-    context['dataset'] = registry.datasets(uuid=source_uuid)  # dataset title of the taxonomic backbone
+    context['dataset'] = responses.get('dataset', dict())  # dataset title of the taxonomic backbone
     context['media'] = media_links
     context['children'] = children
     context['has_occurrence'] = has_occurrence